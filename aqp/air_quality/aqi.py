@@ -1,6 +1,7 @@
 import frappe
 from frappe import _
-from frappe.utils import cint, cstr, round_down, getdate
+from frappe.utils import cint, cstr, flt, round_down, getdate
+import numpy as np
 import aqi
 
 POLLUTANT_TO_AQI_POLLUTANT = {
@@ -31,6 +32,15 @@ POLLUTANT_MAX_RANGE = {
 }
 
 
+# Marks lookup table entries that python-aqi cannot calculate, these are calculated by python-aqi on every call
+AQI_NOT_IN_LOOKUP = -1
+
+# Distance from a precision step within which float scaling cannot be trusted to truncate correctly
+LOOKUP_STEP_TOLERANCE = 1e-6
+
+_aqi_lookup_tables = {}
+
+
 def calculate_aqi(pollutant_type, pollutant_value):
 	if pollutant_type not in POLLUTANT_TO_AQI_POLLUTANT:
 		frappe.throw(_("Pollutant Type {0} is not supported").format(pollutant_type))
@@ -41,6 +51,79 @@ def calculate_aqi(pollutant_type, pollutant_value):
 	if pollutant_value >= max_limit:
 		return limit_aqi
 
+	lookup_table = get_aqi_lookup_table(pollutant_type)
+	step = int(round(flt(pollutant_value) * 10 ** POLLUTANT_PRECISION[pollutant_type]))
+	if 0 <= step < len(lookup_table) and lookup_table[step] != AQI_NOT_IN_LOOKUP:
+		return int(lookup_table[step])
+
+	return _calculate_aqi(pollutant_type, pollutant_value)
+
+
+def calculate_aqi_batch(pollutant_type, pollutant_values):
+	"""
+	Vectorized calculate_aqi for a list or NumPy array of pollutant values.
+	Returns an array of AQI values for array input and a list otherwise
+	"""
+	if pollutant_type not in POLLUTANT_TO_AQI_POLLUTANT:
+		frappe.throw(_("Pollutant Type {0} is not supported").format(pollutant_type))
+
+	is_array = isinstance(pollutant_values, np.ndarray)
+	values = np.nan_to_num(pollutant_values.astype(float) if is_array else np.array([flt(v) for v in pollutant_values]))
+
+	lookup_table = get_aqi_lookup_table(pollutant_type)
+	max_limit, limit_aqi = POLLUTANT_MAX_RANGE[pollutant_type]
+
+	scale = 10 ** POLLUTANT_PRECISION[pollutant_type]
+	scaled = values * scale
+	rounded = np.round(scaled)
+
+	# Values already rounded to the pollutant's precision are exactly the float nearest to their step
+	on_step = rounded / scale == values
+	steps = np.where(on_step, rounded, np.floor(scaled)).astype(np.int64)
+	in_table = (steps >= 0) & (steps < len(lookup_table))
+
+	out = np.full(values.shape, limit_aqi, dtype=np.int64)
+	out[in_table] = lookup_table[steps[in_table]]
+
+	# Values just off a precision step may truncate differently than round_pollutant
+	# and values outside the table are calculated one by one
+	near_step = ~on_step & (np.abs(scaled - rounded) < LOOKUP_STEP_TOLERANCE)
+	scalar = near_step | (values < 0) | (out == AQI_NOT_IN_LOOKUP)
+	scalar &= values < max_limit
+	for i in np.flatnonzero(scalar):
+		out.flat[i] = calculate_aqi(pollutant_type, float(values.flat[i]))
+
+	return out if is_array else out.tolist()
+
+
+def get_aqi_lookup_table(pollutant_type):
+	"""
+	AQI of every precision step of a pollutant from 0 up to its max range, indexed by value * 10 ^ precision
+	"""
+	if pollutant_type not in _aqi_lookup_tables:
+		precision = POLLUTANT_PRECISION[pollutant_type]
+		max_limit = POLLUTANT_MAX_RANGE[pollutant_type][0]
+
+		lookup_table = []
+		step = 0
+		while True:
+			pollutant_value = round_pollutant(pollutant_type, step / 10 ** precision)
+			if pollutant_value >= max_limit:
+				break
+
+			try:
+				lookup_table.append(_calculate_aqi(pollutant_type, pollutant_value))
+			except Exception:
+				lookup_table.append(AQI_NOT_IN_LOOKUP)
+
+			step += 1
+
+		_aqi_lookup_tables[pollutant_type] = np.array(lookup_table, dtype=np.int64)
+
+	return _aqi_lookup_tables[pollutant_type]
+
+
+def _calculate_aqi(pollutant_type, pollutant_value):
 	return cint(aqi.to_iaqi(
 		POLLUTANT_TO_AQI_POLLUTANT[pollutant_type],
 		pollutant_value,
@@ -48,6 +131,34 @@ def calculate_aqi(pollutant_type, pollutant_value):
 	))
 
 
+def calculate_nowcast(hourly_values):
+	"""
+	EPA NowCast of PM2.5 from up to 12 hourly averages, most recent hour first, with None for missing hours.
+	Returns None unless at least 2 of the 3 most recent hours have an average
+	"""
+	hourly_values = list(hourly_values)[:12]
+	if len([v for v in hourly_values[:3] if v is not None]) < 2:
+		return None
+
+	available = [flt(v) for v in hourly_values if v is not None]
+	max_value = max(available)
+	if not max_value:
+		return 0
+
+	weight = max(min(available) / max_value, 0.5)
+
+	weighted_sum = 0
+	weight_sum = 0
+	for i, value in enumerate(hourly_values):
+		if value is None:
+			continue
+
+		weighted_sum += weight ** i * flt(value)
+		weight_sum += weight ** i
+
+	return round_pollutant("PM2.5", weighted_sum / weight_sum)
+
+
 def get_aqi_category(aqi_value):
 	aqi_value = cint(aqi_value)
 	if aqi_value <= 50:
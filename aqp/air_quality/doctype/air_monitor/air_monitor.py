@@ -2,9 +2,25 @@
 # For license information, please see license.txt
 
 import frappe
-from frappe.utils import clean_whitespace, cint
-from aqp.air_quality.utils import get_order_by
+from frappe.utils import clean_whitespace, cint, cstr, flt, get_datetime
+from aqp.air_quality.utils import (
+	get_order_by,
+	push_to_buffer,
+	pop_buffer,
+	invalidate_latest_readings_cache,
+	mark_latest_readings_changed,
+	invalidate_report_cache,
+)
+from aqp.air_quality.doctype.monitor_region.region_tree import invalidate_region_index
+from aqp.air_quality.doctype.reading_aggregate_queue.reading_aggregate_queue import get_aggregate_hour
+from aqp.air_quality.aqi import calculate_aqi, calculate_nowcast, get_aqi_category
 from frappe.model.document import Document
+import datetime
+import json
+
+FIRST_LAST_READING_BUFFER_KEY = "air_monitor_first_last_reading_updates"
+NOWCAST_BUFFER_KEY = "air_monitor_nowcast_updates"
+NOWCAST_HOURS = 12
 
 
 class AirMonitor(Document):
@@ -17,9 +33,18 @@ class AirMonitor(Document):
 
 	def on_update(self):
 		clear_monitors_cache()
+		invalidate_report_cache()
+
+		if self.has_value_changed("monitor_region") or self.has_value_changed("disabled"):
+			invalidate_region_index()
 
 	def on_trash(self):
 		clear_monitors_cache()
+		invalidate_report_cache()
+		invalidate_region_index()
+
+	def after_rename(self, old, new, merge=False):
+		invalidate_region_index()
 
 	def clean_fields(self):
 		fields = ["city", "serial_no"]
@@ -27,19 +52,7 @@ class AirMonitor(Document):
 			self.set(f, clean_whitespace(self.get(f)))
 
 	def set_first_last_reading(self, update=True, update_modified=False):
-		query = """
-			select reading_dt
-			from `tabMonitor Reading`
-			where air_monitor = %s
-			order by reading_dt {0}
-			limit 1
-		"""
-
-		first = frappe.db.sql(query.format("asc"), self.name)
-		last = frappe.db.sql(query.format("desc"), self.name)
-
-		self.first_reading_dt = first[0][0] if first else None
-		self.last_reading_dt = last[0][0] if last else None
+		self.first_reading_dt, self.last_reading_dt = get_first_last_reading_dt(self.name)
 
 		if update:
 			self.db_set({
@@ -68,6 +81,7 @@ def _get_monitors(filters=None, limit_start=None, limit_page_length=None, sort_b
 		"name", "monitor_name", "inactive",
 		"country", "city", "latitude", "longitude",
 		"online_since", "first_reading_dt", "last_reading_dt",
+		"nowcast_pm_2_5", "nowcast_aqi_us", "nowcast_aqi_category", "nowcast_dt",
 		"creation", "modified"
 	]
 
@@ -90,5 +104,247 @@ def _get_monitors(filters=None, limit_start=None, limit_page_length=None, sort_b
 	)
 
 
-def clear_monitors_cache():
-	pass
+def clear_monitors_cache(deferred=False):
+	# Latest reading time is derived from Air Monitor last_reading_dt
+	frappe.cache().delete_key("latest_monitor_reading_dt")
+
+	# Flushed reading updates are already committed and published with the other reading changes
+	if deferred:
+		mark_latest_readings_changed(committed=True)
+	else:
+		invalidate_latest_readings_cache()
+
+
+def get_first_last_reading_dt(air_monitor):
+	query = """
+		select reading_dt
+		from `tabMonitor Reading`
+		where air_monitor = %s
+		order by reading_dt {0}
+		limit 1
+	"""
+
+	first = frappe.db.sql(query.format("asc"), air_monitor)
+	last = frappe.db.sql(query.format("desc"), air_monitor)
+
+	return first[0][0] if first else None, last[0][0] if last else None
+
+
+def queue_first_last_reading_update(air_monitor, first_reading_dt, last_reading_dt=None):
+	queue_first_last_reading_updates({air_monitor: (first_reading_dt, last_reading_dt or first_reading_dt)})
+
+
+def queue_first_last_reading_updates(updates):
+	# Applied by flush_first_last_reading_updates, only once the readings are committed
+	entries = [
+		json.dumps([air_monitor, cstr(first_reading_dt), cstr(last_reading_dt)])
+		for air_monitor, (first_reading_dt, last_reading_dt) in updates.items()
+	]
+	if entries:
+		frappe.db.after_commit.add(lambda: push_to_buffer(FIRST_LAST_READING_BUFFER_KEY, entries))
+
+
+def flush_first_last_reading_updates():
+	entries = pop_buffer(FIRST_LAST_READING_BUFFER_KEY)
+	if not entries:
+		return
+
+	updates = {}
+	for entry in entries:
+		air_monitor, first_reading_dt, last_reading_dt = json.loads(entry)
+		first_reading_dt = get_datetime(first_reading_dt)
+		last_reading_dt = get_datetime(last_reading_dt)
+
+		if air_monitor in updates:
+			first_reading_dt = min(first_reading_dt, updates[air_monitor][0])
+			last_reading_dt = max(last_reading_dt, updates[air_monitor][1])
+
+		updates[air_monitor] = (first_reading_dt, last_reading_dt)
+
+	try:
+		for air_monitor, (first_reading_dt, last_reading_dt) in updates.items():
+			frappe.db.sql("""
+				update `tabAir Monitor`
+				set first_reading_dt = least(ifnull(first_reading_dt, %(first_reading_dt)s), %(first_reading_dt)s),
+					last_reading_dt = greatest(ifnull(last_reading_dt, %(last_reading_dt)s), %(last_reading_dt)s)
+				where name = %(air_monitor)s
+			""", {
+				"air_monitor": air_monitor,
+				"first_reading_dt": first_reading_dt,
+				"last_reading_dt": last_reading_dt,
+			})
+
+		frappe.db.commit()
+	except Exception:
+		frappe.db.rollback()
+		push_to_buffer(FIRST_LAST_READING_BUFFER_KEY, entries)
+		raise
+
+	clear_monitors_cache(deferred=True)
+
+
+def update_first_last_reading_on_remove(air_monitor, reading_dt):
+	# Only a removed boundary reading requires a full rescan
+	boundaries = frappe.db.get_value("Air Monitor", air_monitor, ["first_reading_dt", "last_reading_dt"])
+	if not boundaries or not reading_dt:
+		return
+
+	first_reading_dt, last_reading_dt = boundaries
+	reading_dt = get_datetime(reading_dt)
+
+	if (
+		(first_reading_dt and reading_dt <= get_datetime(first_reading_dt))
+		or (last_reading_dt and reading_dt >= get_datetime(last_reading_dt))
+	):
+		first_reading_dt, last_reading_dt = get_first_last_reading_dt(air_monitor)
+		frappe.db.set_value("Air Monitor", air_monitor, {
+			"first_reading_dt": first_reading_dt,
+			"last_reading_dt": last_reading_dt,
+		}, update_modified=False)
+
+
+def queue_nowcast_updates(readings):
+	"""
+	Add readings [(air_monitor, reading_dt, pm_2_5)] to their Air Monitor's NowCast state.
+	Applied by flush_nowcast_updates, only once the readings are committed
+	"""
+	entries = [
+		json.dumps([air_monitor, cstr(reading_dt), flt(pm_2_5)])
+		for air_monitor, reading_dt, pm_2_5 in readings
+		if flt(pm_2_5) > 0
+	]
+	if entries:
+		frappe.db.after_commit.add(lambda: push_to_buffer(NOWCAST_BUFFER_KEY, entries))
+
+
+def queue_nowcast_rebuild(air_monitors):
+	# Changed or removed readings cannot be taken out of the rolling state, so it is rebuilt from the readings
+	entries = [json.dumps([air_monitor, None, None]) for air_monitor in set(air_monitors) if air_monitor]
+	if entries:
+		frappe.db.after_commit.add(lambda: push_to_buffer(NOWCAST_BUFFER_KEY, entries))
+
+
+def flush_nowcast_updates():
+	entries = pop_buffer(NOWCAST_BUFFER_KEY)
+	if not entries:
+		return
+
+	readings_by_monitor = {}
+	rebuild = set()
+	for entry in entries:
+		air_monitor, reading_dt, pm_2_5 = json.loads(entry)
+		if reading_dt:
+			readings_by_monitor.setdefault(air_monitor, []).append((get_datetime(reading_dt), flt(pm_2_5)))
+		else:
+			rebuild.add(air_monitor)
+
+	try:
+		for air_monitor in set(readings_by_monitor) | rebuild:
+			state = frappe.db.sql("""
+				select nowcast_state
+				from `tabAir Monitor`
+				where name = %s
+				for update
+			""", air_monitor)
+			if not state:
+				continue
+
+			if air_monitor in rebuild:
+				# Buffered readings are already committed and included in the rebuilt state
+				state = get_nowcast_state_from_readings(air_monitor)
+			else:
+				state = parse_nowcast_state(state[0][0])
+				for reading_dt, pm_2_5 in readings_by_monitor[air_monitor]:
+					add_reading_to_nowcast_state(state, reading_dt, pm_2_5)
+
+			set_nowcast(air_monitor, state)
+
+		frappe.db.commit()
+	except Exception:
+		frappe.db.rollback()
+		push_to_buffer(NOWCAST_BUFFER_KEY, entries)
+		raise
+
+	clear_monitors_cache(deferred=True)
+
+
+def set_nowcast(air_monitor, state):
+	nowcast_pm_2_5 = calculate_nowcast(get_nowcast_hourly_values(state))
+	nowcast_aqi_us = calculate_aqi("PM2.5", nowcast_pm_2_5) if nowcast_pm_2_5 is not None else None
+
+	frappe.db.set_value("Air Monitor", air_monitor, {
+		"nowcast_pm_2_5": nowcast_pm_2_5,
+		"nowcast_aqi_us": nowcast_aqi_us,
+		"nowcast_aqi_category": get_aqi_category(nowcast_aqi_us) if nowcast_pm_2_5 else "Not Available",
+		"nowcast_dt": state.hour,
+		"nowcast_state": json.dumps(state) if state.hour else None,
+	}, update_modified=False)
+
+
+def parse_nowcast_state(state_json):
+	state = frappe._dict(json.loads(state_json) if state_json else {})
+	if not state.get("hour"):
+		state.hour = None
+		state.sums = [0.0] * NOWCAST_HOURS
+		state.counts = [0] * NOWCAST_HOURS
+
+	return state
+
+
+def add_reading_to_nowcast_state(state, reading_dt, pm_2_5):
+	"""
+	state.sums and state.counts hold the last 12 hours with index 0 for state.hour,
+	so adding a reading only shifts or updates a fixed-size window
+	"""
+	hour = get_aggregate_hour(reading_dt)
+	if not state.hour:
+		state.hour = cstr(hour)
+
+	shift = int((hour - get_datetime(state.hour)).total_seconds() // 3600)
+	if shift > 0:
+		shift = min(shift, NOWCAST_HOURS)
+		state.sums = [0.0] * shift + state.sums[:NOWCAST_HOURS - shift]
+		state.counts = [0] * shift + state.counts[:NOWCAST_HOURS - shift]
+		state.hour = cstr(hour)
+		shift = 0
+
+	index = -shift
+	if index < NOWCAST_HOURS:
+		state.sums[index] += flt(pm_2_5)
+		state.counts[index] += 1
+
+
+def get_nowcast_hourly_values(state):
+	return [
+		state.sums[i] / state.counts[i] if state.counts[i] else None
+		for i in range(NOWCAST_HOURS)
+	] if state.hour else []
+
+
+def get_nowcast_state_from_readings(air_monitor):
+	state = parse_nowcast_state(None)
+
+	last_reading_dt = frappe.db.sql("""
+		select max(reading_dt)
+		from `tabMonitor Reading`
+		where air_monitor = %s and pm_2_5 > 0
+	""", air_monitor)[0][0]
+	if not last_reading_dt:
+		return state
+
+	to_dt = get_aggregate_hour(last_reading_dt)
+	from_dt = to_dt - datetime.timedelta(hours=NOWCAST_HOURS)
+
+	readings = frappe.db.sql("""
+		select reading_dt, pm_2_5
+		from `tabMonitor Reading`
+		where air_monitor = %(air_monitor)s
+			and reading_dt > %(from_dt)s and reading_dt <= %(to_dt)s
+			and pm_2_5 > 0
+		order by reading_dt
+	""", {"air_monitor": air_monitor, "from_dt": from_dt, "to_dt": to_dt})
+
+	for reading_dt, pm_2_5 in readings:
+		add_reading_to_nowcast_state(state, reading_dt, pm_2_5)
+
+	return state
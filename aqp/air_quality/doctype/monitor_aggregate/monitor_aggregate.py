@@ -0,0 +1,280 @@
+# Copyright (c) 2024, ParaLogic and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe import _
+from frappe.utils import getdate, get_datetime, cint, now_datetime
+from frappe.model.document import Document
+from aqp.air_quality.utils import get_order_by, get_next_sequence_values, bulk_upsert, invalidate_report_cache
+from aqp.air_quality.aqi import aggregate_readings
+from aqp.air_quality.doctype.monitor_reading.monitor_reading import get_monitor_readings
+from aqp.air_quality.doctype.monitor_reading.reading_archive import is_archived
+from aqp.air_quality.doctype.reading_aggregate.reading_aggregate import (
+	AGGREGATE_VALUE_FIELDS,
+	get_aggregate_data_map,
+	get_reading_timerange,
+	get_reading_datetimes_for_timerange,
+	truncate_reading_dt,
+	set_aggregate_aqi,
+	has_aggregate_changed,
+)
+
+MONITOR_TIMESPANS = ["Hourly", "Daily"]
+
+MONITOR_AGGREGATE_INSERT_FIELDS = [
+	"name", "creation", "modified", "owner", "modified_by", "docstatus", "idx",
+	"air_monitor", "timespan", "reading_dt",
+] + AGGREGATE_VALUE_FIELDS
+
+MONITOR_AGGREGATE_UPSERT_FIELDS = ["modified", "modified_by"] + AGGREGATE_VALUE_FIELDS
+
+
+class MonitorAggregate(Document):
+	def validate(self):
+		validate_monitor_timespan(self.timespan)
+		if self.reading_dt:
+			self.reading_dt = truncate_reading_dt(self.reading_dt, self.timespan)
+
+	def show_unique_validation_message(self, e):
+		frappe.throw(_("{0} Monitor Aggregate of Air Monitor {1} at {2} already exists").format(
+			self.timespan,
+			frappe.bold(self.air_monitor),
+			frappe.bold(self.get_formatted("reading_dt")),
+		), exc=frappe.DuplicateEntryError)
+
+
+def on_doctype_update():
+	frappe.db.add_unique("Monitor Aggregate", ["air_monitor", "timespan", "reading_dt"],
+		constraint_name="unique_air_monitor_timespan_reading_dt")
+	frappe.db.add_index("Monitor Aggregate", ["reading_dt", "timespan"])
+
+
+def aggregate_monitors(reading_dt, timespan, air_monitors=None, update_existing=True):
+	"""
+	Compute the Hourly or Daily aggregates of enabled Air Monitors (all or air_monitors) at reading_dt in a single query.
+	Hourly aggregates follow the Reading Aggregate convention: the aggregate at hh:00 covers readings after (hh - 1):00
+	"""
+	validate_monitor_timespan(timespan)
+	reading_dt = truncate_reading_dt(reading_dt, timespan)
+
+	if air_monitors is not None:
+		air_monitors = list(air_monitors)
+		if not air_monitors:
+			return
+
+	if timespan == "Hourly":
+		aggregate_data = get_hourly_monitor_aggregate_data(reading_dt, air_monitors)
+	else:
+		aggregate_data = get_daily_monitor_aggregate_data(reading_dt, air_monitors)
+
+	existing_aggregates = get_existing_monitor_aggregates(reading_dt, reading_dt, timespan, air_monitors)
+	save_monitor_aggregates(timespan, aggregate_data, existing_aggregates, update_existing=update_existing)
+
+
+def aggregate_queued_monitors(queued):
+	# queued: rows of Monitor Aggregate Queue, the Hourly and Daily aggregates of the queued Air Monitors are updated
+	monitors_by_hour = {}
+	for d in queued:
+		monitors_by_hour.setdefault(get_datetime(d.reading_dt), set()).add(d.air_monitor)
+
+	monitors_by_date = {}
+	for reading_dt in sorted(monitors_by_hour):
+		air_monitors = monitors_by_hour[reading_dt]
+		aggregate_monitors(reading_dt, "Hourly", air_monitors=air_monitors)
+		monitors_by_date.setdefault(getdate(reading_dt), set()).update(air_monitors)
+
+	for reading_date in sorted(monitors_by_date):
+		aggregate_monitors(reading_date, "Daily", air_monitors=monitors_by_date[reading_date])
+
+
+def backfill_monitor_aggregates(from_dt, to_dt, update_existing=True, autocommit=True, verbose=False):
+	"""
+	Compute Hourly and Daily Monitor Aggregates of all enabled Air Monitors one hour at a time,
+	including hours of archived readings.
+	Usage: bench --site {site} execute aqp.air_quality.doctype.monitor_aggregate.monitor_aggregate.backfill_monitor_aggregates
+		--kwargs "{'from_dt': '2024-01-01', 'to_dt': '2024-01-07'}"
+	"""
+	for reading_date in get_reading_datetimes_for_timerange(from_dt, to_dt, "Daily"):
+		if verbose:
+			print(f"Processing Monitor aggregation for {frappe.format(getdate(reading_date))}")
+
+		for reading_dt in get_reading_datetimes_for_timerange(reading_date, reading_date.replace(hour=23), "Hourly"):
+			aggregate_monitors(reading_dt, "Hourly", update_existing=update_existing)
+
+		aggregate_monitors(reading_date, "Daily", update_existing=update_existing)
+
+		if autocommit:
+			frappe.db.commit()
+
+
+def get_hourly_monitor_aggregate_data(reading_dt, air_monitors=None):
+	reading_dt = truncate_reading_dt(reading_dt, "Hourly")
+	from_dt, to_dt = get_reading_timerange(reading_dt, "Hourly")
+
+	# The grouped query only reads the hot table, archived readings are read through get_monitor_readings
+	if is_archived(from_dt):
+		readings_by_monitor = {}
+		for d in get_monitor_readings(from_dt, to_dt, air_monitor=air_monitors):
+			readings_by_monitor.setdefault(d.air_monitor, []).append(d)
+
+		aggregate_data = {}
+		for air_monitor, readings in readings_by_monitor.items():
+			agg = aggregate_readings(readings)
+			if agg.pm_2_5_count:
+				aggregate_data[(air_monitor, reading_dt)] = agg
+
+		return aggregate_data
+
+	monitor_condition = " and r.air_monitor in %(air_monitors)s" if air_monitors is not None else ""
+
+	data = frappe.db.sql(f"""
+		select r.air_monitor,
+			sum(r.pm_2_5) as pm_2_5_sum,
+			count(r.pm_2_5) as pm_2_5_count,
+			max(r.pm_2_5) as pm_2_5_max,
+			min(r.pm_2_5) as pm_2_5_min
+		from `tabMonitor Reading` r
+		inner join `tabAir Monitor` m on m.name = r.air_monitor
+		where r.reading_dt between %(from_dt)s and %(to_dt)s
+			and r.pm_2_5 > 0
+			and m.disabled = 0
+			{monitor_condition}
+		group by r.air_monitor
+	""", {"from_dt": from_dt, "to_dt": to_dt, "air_monitors": air_monitors}, as_dict=1)
+
+	return get_aggregate_data_map(data, reading_dt, key_field="air_monitor")
+
+
+def get_daily_monitor_aggregate_data(reading_dt, air_monitors=None):
+	reading_dt = truncate_reading_dt(reading_dt, "Daily")
+	from_dt, to_dt = get_reading_timerange(reading_dt, "Daily")
+
+	monitor_condition = " and ma.air_monitor in %(air_monitors)s" if air_monitors is not None else ""
+
+	data = frappe.db.sql(f"""
+		select ma.air_monitor,
+			sum(ma.pm_2_5_sum) as pm_2_5_sum,
+			sum(ma.pm_2_5_count) as pm_2_5_count,
+			max(ma.pm_2_5_max) as pm_2_5_max,
+			min(ma.pm_2_5_min) as pm_2_5_min
+		from `tabMonitor Aggregate` ma
+		inner join `tabAir Monitor` m on m.name = ma.air_monitor
+		where ma.reading_dt between %(from_dt)s and %(to_dt)s
+			and ma.timespan = 'Hourly'
+			and ma.pm_2_5 > 0
+			and m.disabled = 0
+			{monitor_condition}
+		group by ma.air_monitor
+	""", {"from_dt": from_dt, "to_dt": to_dt, "air_monitors": air_monitors}, as_dict=1)
+
+	return get_aggregate_data_map(data, reading_dt, key_field="air_monitor")
+
+
+def get_existing_monitor_aggregates(from_dt, to_dt, timespan, air_monitors=None):
+	filters = {
+		"reading_dt": ["between", [from_dt, to_dt]],
+		"timespan": timespan,
+	}
+	if air_monitors is not None:
+		filters["air_monitor"] = ["in", air_monitors]
+
+	existing = frappe.get_all("Monitor Aggregate", filters=filters,
+		fields=["name", "air_monitor", "reading_dt"] + AGGREGATE_VALUE_FIELDS)
+
+	return {(d.air_monitor, get_datetime(d.reading_dt)): d for d in existing}
+
+
+def save_monitor_aggregates(timespan, aggregate_data, existing_aggregates, update_existing=True, autocommit=False):
+	# aggregate_data and existing_aggregates are keyed by (air_monitor, reading_dt),
+	# existing aggregates without data any more are reset
+	to_upsert = []
+	for key in sorted(set(aggregate_data) | set(existing_aggregates)):
+		agg = aggregate_data.get(key) or aggregate_readings([])
+		set_aggregate_aqi(agg)
+
+		existing = existing_aggregates.get(key)
+		if existing:
+			if not update_existing or not has_aggregate_changed(existing, agg):
+				continue
+		elif not agg.pm_2_5_count:
+			continue
+
+		agg.air_monitor, agg.reading_dt = key
+		agg.timespan = timespan
+		to_upsert.append(agg)
+
+	upsert_monitor_aggregates(to_upsert, update_existing=update_existing, autocommit=autocommit)
+
+
+def upsert_monitor_aggregates(rows, update_existing=True, batch_size=1000, autocommit=False):
+	if not rows:
+		return
+
+	batch_size = cint(batch_size) or 1000
+	now = now_datetime()
+	user = frappe.session.user
+
+	# Names reserved for rows that turn out to be updates are left unused in the sequence
+	names = get_next_sequence_values("Monitor Aggregate", len(rows))
+	values = [
+		(name, now, now, user, user, 0, 0, row.air_monitor, row.timespan, row.reading_dt)
+		+ tuple(row.get(f) for f in AGGREGATE_VALUE_FIELDS)
+		for name, row in zip(names, rows)
+	]
+
+	for i in range(0, len(values), batch_size):
+		bulk_upsert("Monitor Aggregate", MONITOR_AGGREGATE_INSERT_FIELDS, values[i:i + batch_size],
+			update_fields=MONITOR_AGGREGATE_UPSERT_FIELDS if update_existing else None,
+			ignore_duplicates=not update_existing,
+			chunk_size=batch_size,
+		)
+
+		if autocommit:
+			frappe.db.commit()
+
+	invalidate_report_cache([row.reading_dt for row in rows])
+
+
+def get_monitor_aggregates(from_dt, to_dt, timespan, air_monitor=None, sort_order="asc"):
+	if not from_dt or not to_dt:
+		frappe.throw(_("From Datetime and To Datetime is required"))
+
+	validate_monitor_timespan(timespan)
+
+	order_by = get_order_by("Monitor Aggregate", "reading_dt", sort_order)
+
+	args = frappe._dict({
+		"from_dt": from_dt,
+		"to_dt": to_dt,
+		"timespan": timespan,
+		"air_monitor": air_monitor,
+	})
+
+	monitor_condition = ""
+	if isinstance(air_monitor, (list, tuple)):
+		if not air_monitor:
+			return []
+
+		monitor_condition = " and ma.air_monitor in %(air_monitor)s"
+
+	elif air_monitor:
+		monitor_condition = " and ma.air_monitor = %(air_monitor)s"
+
+	return frappe.db.sql(f"""
+		select ma.name, ma.timespan, ma.reading_dt,
+			ma.air_monitor,
+			ma.pm_2_5, ma.pm_2_5_sum, ma.pm_2_5_count, ma.pm_2_5_max, ma.pm_2_5_min,
+			ma.aqi_us, ma.aqi_category
+		from `tabMonitor Aggregate` ma
+		inner join `tabAir Monitor` m on m.name = ma.air_monitor
+		where ma.reading_dt between %(from_dt)s and %(to_dt)s
+			and ma.timespan = %(timespan)s
+			and m.disabled = 0
+			{monitor_condition}
+		order by {order_by}
+	""", args, as_dict=1)
+
+
+def validate_monitor_timespan(timespan):
+	if timespan not in MONITOR_TIMESPANS:
+		frappe.throw(_("Timespan must be either Hourly or Daily"))
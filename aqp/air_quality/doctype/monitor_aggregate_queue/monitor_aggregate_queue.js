@@ -0,0 +1,8 @@
+// Copyright (c) 2024, ParaLogic and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on('Monitor Aggregate Queue', {
+	// refresh: function(frm) {
+
+	// }
+});
@@ -0,0 +1,64 @@
+# Copyright (c) 2024, ParaLogic and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.utils import now_datetime
+from frappe.model.document import Document
+from aqp.air_quality.utils import (
+	bulk_upsert,
+	get_next_sequence_values,
+	claim_queue_rows,
+	complete_queue_claim,
+	release_queue_claim,
+)
+
+QUEUE_FIELDS = [
+	"name", "creation", "modified", "owner", "modified_by", "docstatus", "idx",
+	"air_monitor", "reading_dt", "claim_token", "claimed_at",
+]
+
+# Claims older than the job timeout belong to a job that was killed
+QUEUE_CLAIM_STALE_AFTER = 60 * 15
+
+
+class MonitorAggregateQueue(Document):
+	pass
+
+
+def on_doctype_update():
+	frappe.db.add_unique("Monitor Aggregate Queue", ["air_monitor", "reading_dt"],
+		constraint_name="unique_air_monitor_reading_dt")
+	frappe.db.add_index("Monitor Aggregate Queue", ["claim_token"])
+
+
+def queue_monitor_aggregation(monitor_hours):
+	# monitor_hours: iterable of (air_monitor, hourly reading_dt), Air Monitors without a region are queued too
+	monitor_hours = sorted(set(monitor_hours))
+	if not monitor_hours:
+		return
+
+	now = now_datetime()
+	user = frappe.session.user
+
+	names = get_next_sequence_values("Monitor Aggregate Queue", len(monitor_hours))
+	values = [
+		(name, now, now, user, user, 0, 0, air_monitor, reading_dt, None, None)
+		for name, (air_monitor, reading_dt) in zip(names, monitor_hours)
+	]
+
+	# A row queued again while it is being recomputed has its claim reset, so that it is recomputed once more
+	bulk_upsert("Monitor Aggregate Queue", QUEUE_FIELDS, values, update_fields=["claim_token", "claimed_at"])
+
+
+def claim_queued_monitor_aggregation(limit, claim_token):
+	return claim_queue_rows("Monitor Aggregate Queue", ["name", "air_monitor", "reading_dt"], limit, claim_token,
+		QUEUE_CLAIM_STALE_AFTER)
+
+
+def complete_queued_monitor_aggregation(claim_token):
+	# Not committed, the claimed rows are removed in the same transaction as the recomputed aggregates
+	complete_queue_claim("Monitor Aggregate Queue", claim_token)
+
+
+def release_queued_monitor_aggregation(claim_token):
+	release_queue_claim("Monitor Aggregate Queue", claim_token)
@@ -0,0 +1,327 @@
+import frappe
+from frappe import _
+from frappe.utils import cint, cstr, get_datetime, now_datetime
+from werkzeug.wrappers import Response
+from aqp.air_quality.utils import LATEST_READINGS_VERSION_KEY, get_cache_counter
+from aqp.air_quality.doctype.monitor_reading.monitor_reading import (
+	get_latest_readings,
+	get_latest_reading_dt,
+	set_nowcast_for_readings,
+)
+import datetime
+import hashlib
+import gzip
+import json
+import os
+
+LATEST_READINGS_CACHE_EXPIRY = 60 * 60
+LATEST_READINGS_MAX_AGE = 60
+
+RESPONSE_FORMATS = ("json", "columnar")
+
+COLUMNAR_ENCODED_FIELDS = {
+	"monitors": ["name", "country", "city", "nowcast_aqi_category"],
+	"regions": ["name", "parent_monitor_region", "type", "timezone"],
+	"readings": ["air_monitor", "aqi_category", "nowcast_aqi_category"],
+	"aggregates": ["monitor_region", "timespan", "aqi_category"],
+}
+
+# Rows committed up to this long after their modified time are still returned by the next delta
+DELTA_CURSOR_OVERLAP = datetime.timedelta(seconds=60)
+# Clients with an older cursor get the full state instead of a delta
+DELTA_MAX_AGE = datetime.timedelta(days=1)
+# Clients get the full state instead of a delta with more changed readings or regions than this
+DELTA_MAX_ROWS = 5000
+
+MAP_SNAPSHOT_FILE_NAME = "map_snapshot.json"
+MAP_SNAPSHOT_VERSION_KEY = "map_snapshot_version"
+
+
+@frappe.whitelist(allow_guest=True, methods=["GET"])
+def get_latest_readings_response(for_datetime=None, window_minutes=60, response_format=None):
+	"""
+	get_latest_readings as a cacheable response. The serialized response is cached per data version
+	and its ETag only depends on the data version and arguments, so unchanged data is answered with 304
+	without computing anything.
+	response_format=columnar returns parallel arrays per section instead of a dict per row, see get_columnar_latest_readings.
+	Requests pass it as the format argument
+	"""
+	response_format = response_format or frappe.form_dict.get("format")
+	if response_format and response_format not in RESPONSE_FORMATS:
+		frappe.throw(_("format must be one of {0}").format(", ".join(RESPONSE_FORMATS)))
+
+	use_gzip = bool(frappe.request and "gzip" in cstr(frappe.request.headers.get("Accept-Encoding")))
+
+	version = get_cache_counter(LATEST_READINGS_VERSION_KEY)
+	args_key = f"{cstr(for_datetime)}|{cint(window_minutes)}|{cstr(response_format)}|{cint(use_gzip)}"
+	etag = hashlib.sha1(f"{version}|{args_key}".encode()).hexdigest()
+
+	headers = {
+		"Cache-Control": f"public, max-age={LATEST_READINGS_MAX_AGE}",
+		"Vary": "Accept-Encoding",
+	}
+	if use_gzip:
+		headers["Content-Encoding"] = "gzip"
+
+	if frappe.request and frappe.request.if_none_match.contains(etag):
+		response = Response(status=304, headers={k: v for k, v in headers.items() if k != "Content-Encoding"})
+		response.set_etag(etag)
+		return response
+
+	cache_key = f"latest_readings_response|{version}|{args_key}"
+	body = frappe.cache().get_value(cache_key)
+	if not body:
+		data = get_latest_readings(for_datetime, window_minutes)
+		if response_format == "columnar":
+			data = get_columnar_latest_readings(data)
+
+		body = frappe.as_json({"message": data}, indent=None).encode()
+		if use_gzip:
+			body = gzip.compress(body)
+
+		frappe.cache().set_value(cache_key, body, expires_in_sec=LATEST_READINGS_CACHE_EXPIRY)
+
+	response = Response(body, headers=headers, content_type="application/json; charset=utf-8")
+	response.set_etag(etag)
+	return response
+
+
+def get_columnar_latest_readings(data):
+	"""
+	Each section becomes {"fields": [...], "columns": [[...], ...]} with one column per field.
+	Repetitive string fields hold indexes into a single "strings" list shared by all sections,
+	so that names of regions, monitors, countries and AQI categories are sent once
+	"""
+	strings = []
+	string_index = {}
+
+	def encode_string(value):
+		if value is None:
+			return None
+
+		if value not in string_index:
+			string_index[value] = len(strings)
+			strings.append(value)
+
+		return string_index[value]
+
+	def to_columns(section, rows):
+		encoded_fields = COLUMNAR_ENCODED_FIELDS[section]
+
+		fields = []
+		for row in rows:
+			for f in row:
+				if f not in fields:
+					fields.append(f)
+
+		columns = []
+		for f in fields:
+			values = [row.get(f) for row in rows]
+			if f in encoded_fields:
+				values = [encode_string(v) for v in values]
+
+			columns.append(values)
+
+		return {
+			"fields": fields,
+			"encoded_fields": [f for f in fields if f in encoded_fields],
+			"count": len(rows),
+			"columns": columns,
+		}
+
+	out = frappe._dict({
+		"format": "columnar",
+		"monitors": to_columns("monitors", list(data.monitors.values())),
+		"regions": to_columns("regions", data.regions),
+		"readings": to_columns("readings", data.readings),
+		"aggregates": to_columns("aggregates", data.aggregates),
+		"latest_reading_dt": data.latest_reading_dt,
+		"from_dt": data.from_dt,
+		"to_dt": data.to_dt,
+	})
+	out.strings = strings
+
+	return out
+
+
+@frappe.whitelist(allow_guest=True, methods=["GET"])
+def get_latest_readings_delta(cursor=None, window_minutes=60):
+	"""
+	Returns the full state of get_latest_readings without a cursor, and otherwise only what changed since the cursor:
+	the latest changed reading of each Air Monitor, the latest Hourly aggregate of each region with changed aggregates
+	and changed monitors and regions, with disabled or deleted ones in removed_monitors / removed_regions.
+	Only readings and aggregates in the window of get_latest_readings count as changes, so historical rows
+	written by imports or backfills do not replace current values.
+	Pass the returned cursor to the next call. Deltas overlap slightly, so rows may be repeated
+	"""
+	from aqp.air_quality.doctype.air_monitor.air_monitor import _get_monitors
+	from aqp.air_quality.doctype.monitor_region.monitor_region import _get_regions
+	from aqp.air_quality.doctype.reading_aggregate.reading_aggregate import get_latest_hourly_aggregates
+
+	window_minutes = cint(window_minutes)
+	if window_minutes <= 0:
+		frappe.throw(_("window_minutes must be a positive integer"))
+	if window_minutes > 1440:
+		frappe.throw(_("window_minutes cannot be greater than 1440 minutes"))
+
+	new_cursor = now_datetime() - DELTA_CURSOR_OVERLAP
+
+	if cursor:
+		try:
+			cursor = get_datetime(cursor)
+		except Exception:
+			cursor = None
+
+		if not isinstance(cursor, datetime.datetime):
+			frappe.throw(_("Invalid cursor"))
+
+	def get_full_state():
+		out = get_latest_readings(window_minutes=window_minutes)
+		out.full = True
+		out.cursor = cstr(new_cursor)
+		return out
+
+	if not cursor or cursor < now_datetime() - DELTA_MAX_AGE:
+		return get_full_state()
+
+	latest_reading_dt = get_latest_reading_dt()
+	if not latest_reading_dt:
+		return get_full_state()
+
+	from_dt = latest_reading_dt - datetime.timedelta(minutes=window_minutes)
+
+	out = frappe._dict({
+		"full": False,
+		"cursor": cstr(new_cursor),
+		"readings": [],
+		"aggregates": [],
+		"monitors": [],
+		"regions": [],
+		"removed_monitors": [],
+		"removed_regions": [],
+	})
+
+	# Metadata
+	changed_monitors = frappe.get_all("Air Monitor", filters={"modified": [">", cursor]}, pluck="name")
+	if changed_monitors:
+		out.monitors = _get_monitors(filters={"name": ["in", changed_monitors]})
+		enabled_monitors = {d.name for d in out.monitors}
+		out.removed_monitors = [name for name in changed_monitors if name not in enabled_monitors]
+
+	changed_regions = frappe.get_all("Monitor Region", filters={"modified": [">", cursor]}, pluck="name")
+	if changed_regions:
+		out.regions = _get_regions(filters={"name": ["in", changed_regions]})
+		enabled_regions = {d.name for d in out.regions}
+		out.removed_regions = [name for name in changed_regions if name not in enabled_regions]
+
+	out.removed_monitors += get_deleted_names("Air Monitor", cursor)
+	out.removed_regions += get_deleted_names("Monitor Region", cursor)
+
+	# Readings and Hourly aggregates. Readings older than their Air Monitor's latest reading are not changes of the latest
+	readings = frappe.db.sql("""
+		select r.name, r.reading_dt,
+			r.air_monitor,
+			r.pm_2_5, r.aqi_us, r.aqi_category,
+			r.temperature, r.relative_humidity, r.co2
+		from `tabMonitor Reading` r
+		inner join `tabAir Monitor` m on m.name = r.air_monitor
+		where r.modified > %(cursor)s
+			and r.reading_dt >= %(from_dt)s
+			and r.reading_dt >= ifnull(m.last_reading_dt, r.reading_dt)
+			and m.disabled = 0
+		order by r.reading_dt desc
+		limit %(limit)s
+	""", {"cursor": cursor, "from_dt": from_dt, "limit": DELTA_MAX_ROWS + 1}, as_dict=1)
+	if len(readings) > DELTA_MAX_ROWS:
+		return get_full_state()
+
+	out.readings = get_latest_per_entity(readings, "air_monitor")
+
+	if out.readings:
+		reading_monitors = _get_monitors(filters={"name": ["in", [d.air_monitor for d in out.readings]]})
+		set_nowcast_for_readings(out.readings, {d.name: d for d in reading_monitors})
+
+	# A changed aggregate of the current hour also means the previous hour is complete,
+	# so regions are returned with their latest complete Hourly aggregate as in get_latest_readings
+	changed_aggregate_regions = frappe.db.sql_list("""
+		select distinct ra.monitor_region
+		from `tabReading Aggregate` ra
+		where ra.modified > %(cursor)s
+			and ra.timespan = 'Hourly'
+			and ra.reading_dt >= %(from_dt)s
+		limit %(limit)s
+	""", {"cursor": cursor, "from_dt": from_dt, "limit": DELTA_MAX_ROWS + 1})
+	if len(changed_aggregate_regions) > DELTA_MAX_ROWS:
+		return get_full_state()
+
+	out.aggregates = get_latest_hourly_aggregates(from_dt, latest_reading_dt, monitor_regions=changed_aggregate_regions)
+
+	return out
+
+
+def get_latest_per_entity(rows, entity_field):
+	# rows are sorted latest first
+	visited = set()
+	out = []
+	for d in rows:
+		if d[entity_field] not in visited:
+			visited.add(d[entity_field])
+			out.append(d)
+
+	return out
+
+
+def get_deleted_names(doctype, cursor):
+	return frappe.get_all("Deleted Document", filters={
+		"deleted_doctype": doctype,
+		"creation": [">", cursor],
+	}, pluck="deleted_name")
+
+
+def update_map_snapshot(force=False):
+	"""
+	Write the latest readings payload of the /map page to a static file in public files.
+	Scheduled every minute, only rewritten if readings, aggregates, monitors or regions changed since the last snapshot
+	"""
+	version = get_cache_counter(LATEST_READINGS_VERSION_KEY)
+	snapshot_path = get_map_snapshot_path()
+
+	if (
+		not force
+		and os.path.exists(snapshot_path)
+		and frappe.cache().get_value(MAP_SNAPSHOT_VERSION_KEY) == version
+	):
+		return
+
+	payload = frappe.as_json(get_latest_readings(), indent=None)
+
+	# Written to a temporary file and renamed so that readers never see a partial snapshot
+	temp_path = f"{snapshot_path}.{frappe.generate_hash(length=8)}.tmp"
+	with open(temp_path, "w") as f:
+		f.write(payload)
+	os.replace(temp_path, snapshot_path)
+
+	frappe.cache().set_value(MAP_SNAPSHOT_VERSION_KEY, version)
+	return payload
+
+
+def get_map_snapshot():
+	snapshot_path = get_map_snapshot_path()
+
+	payload = None
+	if os.path.exists(snapshot_path):
+		with open(snapshot_path) as f:
+			payload = f.read()
+
+	if not payload:
+		payload = update_map_snapshot(force=True)
+
+	return frappe._dict(json.loads(payload))
+
+
+def get_map_snapshot_path():
+	return frappe.get_site_path("public", "files", MAP_SNAPSHOT_FILE_NAME)
+
+
+def get_map_snapshot_url():
+	return f"/files/{MAP_SNAPSHOT_FILE_NAME}"
@@ -3,40 +3,49 @@
 
 import frappe
 from frappe import _
-from frappe.utils import get_datetime, getdate, combine_datetime, cint
+from frappe.utils import get_datetime, getdate, combine_datetime, cint, cstr
 from frappe.model.document import Document
-from aqp.air_quality.aqi import calculate_aqi, get_aqi_category, get_daily_aggregates
-from aqp.air_quality.utils import get_order_by
+from aqp.air_quality.aqi import calculate_aqi, get_aqi_category, aggregate_readings
+from aqp.air_quality.utils import get_order_by, mark_latest_readings_changed
+from aqp.air_quality.doctype.air_monitor.air_monitor import (
+	queue_first_last_reading_update,
+	update_first_last_reading_on_remove,
+	queue_nowcast_updates,
+	queue_nowcast_rebuild,
+)
+from aqp.air_quality.doctype.reading_aggregate_queue.reading_aggregate_queue import (
+	queue_reading_aggregation,
+	get_aggregate_hour,
+)
+from aqp.air_quality.doctype.monitor_reading.reading_realtime import queue_realtime_readings
+from aqp.air_quality.doctype.monitor_reading.reading_archive import get_archived_until, get_archived_readings
 from datetime import timedelta
 import datetime
 
 
 class MonitorReading(Document):
 	def validate(self):
-		self.validate_duplicate()
 		self.set_aqi()
 
 	def on_update(self):
 		clear_readings_cache()
+		self.queue_aggregation()
 		self.update_air_monitor()
+		self.update_nowcast()
+		queue_realtime_readings([(self.air_monitor, self.reading_dt)])
 
-	def on_trash(self):
+	def after_delete(self):
 		clear_readings_cache()
-		self.update_air_monitor()
-
-	def validate_duplicate(self):
-		existing = frappe.db.get_value("Monitor Reading", {
-			"air_monitor": self.air_monitor,
-			"reading_dt": self.reading_dt,
-			"name": ["!=", self.name]
-		})
+		queue_reading_aggregation([(self.air_monitor, self.reading_dt)])
+		update_first_last_reading_on_remove(self.air_monitor, self.reading_dt)
+		queue_nowcast_rebuild([self.air_monitor])
 
-		if existing:
-			frappe.throw(_("Monitor Reading for Air Monitor {0} at {1} already exists ({2})").format(
-				frappe.bold(self.air_monitor),
-				frappe.bold(self.get_formatted("reading_dt")),
-				frappe.utils.get_link_to_form("Monitor Reading", existing)
-			))
+	def show_unique_validation_message(self, e):
+		# Duplicates are rejected by the unique (air_monitor, reading_dt) key instead of a lookup in validate
+		frappe.throw(_("Monitor Reading for Air Monitor {0} at {1} already exists").format(
+			frappe.bold(self.air_monitor),
+			frappe.bold(self.get_formatted("reading_dt")),
+		), exc=frappe.UniqueValidationError)
 
 	def set_aqi(self, update=False, update_modified=True):
 		self.aqi_us = calculate_aqi("PM2.5", self.pm_2_5)
@@ -52,13 +61,35 @@ class MonitorReading(Document):
 				"aqi_category": self.aqi_category,
 			}, update_modified=update_modified)
 
+	def queue_aggregation(self):
+		readings = [(self.air_monitor, self.reading_dt)]
+
+		previous = self.get_doc_before_save()
+		if previous:
+			readings.append((previous.air_monitor, previous.reading_dt))
+
+		queue_reading_aggregation(readings)
+
 	def update_air_monitor(self):
-		air_monitor = frappe.get_doc("Air Monitor", self.air_monitor)
-		air_monitor.set_first_last_reading(update=True)
+		previous = self.get_doc_before_save()
+		if previous:
+			if previous.air_monitor == self.air_monitor and get_datetime(previous.reading_dt) == get_datetime(self.reading_dt):
+				return
+
+			update_first_last_reading_on_remove(previous.air_monitor, previous.reading_dt)
+
+		queue_first_last_reading_update(self.air_monitor, get_datetime(self.reading_dt))
+
+	def update_nowcast(self):
+		previous = self.get_doc_before_save()
+		if previous:
+			queue_nowcast_rebuild([previous.air_monitor, self.air_monitor])
+		else:
+			queue_nowcast_updates([(self.air_monitor, get_datetime(self.reading_dt), self.pm_2_5)])
 
 
 def on_doctype_update():
-	frappe.db.add_index("Monitor Reading", ["air_monitor", "reading_dt"])
+	frappe.db.add_unique("Monitor Reading", ["air_monitor", "reading_dt"], constraint_name="unique_air_monitor_reading_dt")
 
 
 def clear_readings_cache():
@@ -66,15 +97,18 @@ def clear_readings_cache():
 	for key in cache_keys:
 		frappe.cache().delete_key(key)
 
+	mark_latest_readings_changed()
+
 
 @frappe.whitelist(allow_guest=True)
 def get_latest_readings(for_datetime=None, window_minutes=60):
 	from aqp.air_quality.doctype.air_monitor.air_monitor import _get_monitors
 	from aqp.air_quality.doctype.monitor_region.monitor_region import _get_regions
-	from aqp.air_quality.doctype.reading_aggregate.reading_aggregate import get_reading_aggregates
+	from aqp.air_quality.doctype.reading_aggregate.reading_aggregate import get_latest_hourly_aggregates
 
+	latest_reading_dt = get_latest_reading_dt()
 	if not for_datetime:
-		for_datetime = get_latest_reading_dt()
+		for_datetime = latest_reading_dt
 
 	monitors = _get_monitors(filters={"first_reading_dt": ["<=", for_datetime]}, sort_by="creation", sort_order="asc")
 	monitors_map = {}
@@ -111,28 +145,25 @@ def get_latest_readings(for_datetime=None, window_minutes=60):
 	out.to_dt = for_datetime
 	out.from_dt = out.to_dt - timedelta(minutes=window_minutes)
 
-	readings = get_monitor_readings(out.from_dt, out.to_dt, sort_order="desc")
-	if readings:
-		out.latest_reading_dt = readings[0].reading_dt
+	# No monitor has a reading after the latest reading time, so the maintained latest reading
+	# of each Air Monitor and latest Hourly aggregate of each region can be read directly
+	materialized = bool(latest_reading_dt and for_datetime >= latest_reading_dt)
 
-	aggregates = get_reading_aggregates(out.from_dt, out.to_dt, "Hourly", sort_order="desc")
+	out.readings = get_latest_monitor_readings(out.from_dt, out.to_dt, materialized=materialized)
+	if out.readings:
+		out.latest_reading_dt = out.readings[0].reading_dt
 
-	air_monitors_visited = set()
-	for d in readings:
-		if d.air_monitor not in air_monitors_visited:
-			air_monitors_visited.add(d.air_monitor)
-			out.readings.append(d)
+	out.aggregates = get_latest_hourly_aggregates(out.from_dt, out.to_dt, materialized=materialized)
 
-	regions_visited = set()
-	for d in aggregates:
-		if d.monitor_region not in regions_visited:
-			regions_visited.add(d.monitor_region)
-			out.aggregates.append(d)
+	air_monitors_visited = {d.air_monitor for d in out.readings}
+	regions_visited = {d.monitor_region for d in out.aggregates}
 
 	for monitor in air_monitors_visited:
 		if monitors_map.get(monitor):
 			monitors_map[monitor].has_reading = True
 
+	set_nowcast_for_readings(out.readings, monitors_map)
+
 	for region in regions_visited:
 		if regions_map.get(region):
 			regions_map[region].has_reading = True
@@ -140,6 +171,20 @@ def get_latest_readings(for_datetime=None, window_minutes=60):
 	return out
 
 
+def set_nowcast_for_readings(readings, monitors_map):
+	# NowCast is only maintained for the latest hour of each Air Monitor, so historical readings do not get one
+	for d in readings:
+		monitor = monitors_map.get(d.air_monitor)
+		if monitor and monitor.nowcast_dt and get_datetime(monitor.nowcast_dt) == get_aggregate_hour(d.reading_dt):
+			d.nowcast_pm_2_5 = monitor.nowcast_pm_2_5
+			d.nowcast_aqi_us = monitor.nowcast_aqi_us
+			d.nowcast_aqi_category = monitor.nowcast_aqi_category
+		else:
+			d.nowcast_pm_2_5 = None
+			d.nowcast_aqi_us = None
+			d.nowcast_aqi_category = None
+
+
 @frappe.whitelist(allow_guest=True)
 def get_latest_reading_dt():
 	lastest_reading_dt = frappe.cache().get_value("latest_monitor_reading_dt", _get_latest_reading_dt)
@@ -148,26 +193,72 @@ def get_latest_reading_dt():
 
 def _get_latest_reading_dt():
 	latest = frappe.db.sql("""
-		select reading_dt
-		from `tabMonitor Reading`
-		order by reading_dt desc
-		limit 1
+		select max(last_reading_dt)
+		from `tabAir Monitor`
 	""")
 
 	return latest[0][0] if latest else None
 
 
+def get_latest_monitor_readings(from_dt, to_dt, materialized=True):
+	"""
+	Latest reading of each enabled Air Monitor between from_dt and to_dt, latest first.
+	materialized reads the reading at each Air Monitor's last_reading_dt,
+	otherwise the latest reading in the range is found with a loose index scan on the unique key
+	"""
+	args = {"from_dt": from_dt, "to_dt": to_dt}
+
+	if materialized:
+		latest_join = """
+			inner join `tabAir Monitor` m on m.name = r.air_monitor and r.reading_dt = m.last_reading_dt
+		"""
+		latest_condition = "m.last_reading_dt between %(from_dt)s and %(to_dt)s"
+	else:
+		latest_join = """
+			inner join (
+				select air_monitor, max(reading_dt) as reading_dt
+				from `tabMonitor Reading`
+				where reading_dt between %(from_dt)s and %(to_dt)s
+				group by air_monitor
+			) latest on latest.air_monitor = r.air_monitor and latest.reading_dt = r.reading_dt
+			inner join `tabAir Monitor` m on m.name = r.air_monitor
+		"""
+		latest_condition = "r.reading_dt between %(from_dt)s and %(to_dt)s"
+
+	return frappe.db.sql(f"""
+		select r.name, r.reading_dt,
+			r.air_monitor,
+			r.pm_2_5, r.aqi_us, r.aqi_category,
+			r.temperature, r.relative_humidity, r.co2
+		from `tabMonitor Reading` r
+		{latest_join}
+		where {latest_condition}
+			and m.disabled = 0
+		order by r.reading_dt desc, r.air_monitor
+	""", args, as_dict=1)
+
+
 def get_daily_average_readings(from_date=None, to_date=None, air_monitor=None):
 	if not from_date:
 		from_date = getdate()
 	if not to_date:
 		to_date = getdate()
 
+	from aqp.air_quality.doctype.monitor_aggregate.monitor_aggregate import get_monitor_aggregates
+
 	from_dt = combine_datetime(from_date, datetime.time.min)
 	to_dt = combine_datetime(to_date, datetime.time.max)
 
-	all_readings = get_monitor_readings(from_dt, to_dt, air_monitor=air_monitor, sort_order="asc")
-	daily_aggregates = get_daily_aggregates(all_readings)
+	# Daily Monitor Aggregates of the selected monitors are merged into a single aggregate per day
+	monitor_aggregates_by_date = {}
+	for d in get_monitor_aggregates(from_dt, to_dt, "Daily", air_monitor=air_monitor):
+		monitor_aggregates_by_date.setdefault(cstr(getdate(d.reading_dt)), []).append(d)
+
+	daily_aggregates = {}
+	for reading_date, monitor_aggregates in monitor_aggregates_by_date.items():
+		agg = aggregate_readings(monitor_aggregates, use_accumulated_values=True)
+		if agg.pm_2_5_count:
+			daily_aggregates[reading_date] = agg
 
 	return daily_aggregates
 
@@ -194,7 +285,7 @@ def get_monitor_readings(from_dt, to_dt, air_monitor=None, sort_order="asc"):
 	elif air_monitor:
 		monitor_condition = " and r.air_monitor = %(air_monitor)s"
 
-	return frappe.db.sql(f"""
+	readings = frappe.db.sql(f"""
 		select r.name, r.reading_dt,
 			r.air_monitor,
 			r.pm_2_5, r.aqi_us, r.aqi_category,
@@ -206,3 +297,19 @@ def get_monitor_readings(from_dt, to_dt, air_monitor=None, sort_order="asc"):
 			{monitor_condition}
 		order by {order_by}
 	""", args, as_dict=1)
+
+	# Older readings are moved to the reading archive, late readings of archived months may still be in the table
+	archived_until = get_archived_until()
+	if archived_until and get_datetime(from_dt) < archived_until:
+		enabled_monitors = frappe.local_cache("enabled_air_monitors", "",
+			lambda: frappe.get_all("Air Monitor", filters={"disabled": 0}, pluck="name"))
+		archived_to_dt = min(get_datetime(to_dt), archived_until - timedelta(microseconds=1))
+		archived_readings = get_archived_readings(from_dt, archived_to_dt, air_monitor=air_monitor,
+			enabled_monitors=enabled_monitors)
+
+		if archived_readings:
+			visited = {(d.air_monitor, d.reading_dt) for d in readings}
+			readings += [d for d in archived_readings if (d.air_monitor, d.reading_dt) not in visited]
+			readings.sort(key=lambda d: d.reading_dt, reverse=cstr(sort_order).lower() == "desc")
+
+	return readings
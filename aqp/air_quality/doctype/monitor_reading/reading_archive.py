@@ -0,0 +1,288 @@
+import frappe
+from frappe import _
+from frappe.utils import cint, cstr, get_datetime, getdate, add_days, add_months, get_first_day
+import numpy as np
+import datetime
+import os
+
+ARCHIVE_FOLDER = "reading_archive"
+ARCHIVED_UNTIL_KEY = "monitor_reading_archived_until"
+
+ARCHIVE_VALUE_FIELDS = ["pm_2_5", "temperature", "relative_humidity", "co2", "aqi_us"]
+ARCHIVE_INT_FIELDS = ["aqi_us"]
+
+# Loaded months kept in memory for the current request or job, re-aggregation reads the same month hour after hour
+ARCHIVE_CACHE_MONTHS = 2
+
+
+def archive_readings(archive_after_days=None, chunk_size=10000, verbose=False):
+	"""
+	Move raw Monitor Readings older than archive_after_days (site config reading_archive_after_days)
+	into compressed columnar files, one per month sorted by Air Monitor and time.
+	Only whole months are archived. Readings that arrive later for an archived month are merged on the next run
+	"""
+	archive_after_days = cint(archive_after_days or frappe.conf.get("reading_archive_after_days"))
+	if archive_after_days <= 0:
+		return
+
+	archive_before = get_first_day(add_days(getdate(), -archive_after_days))
+	archive_before = datetime.datetime.combine(archive_before, datetime.time.min)
+
+	first_reading_dt = frappe.db.sql("""
+		select min(reading_dt)
+		from `tabMonitor Reading`
+		where reading_dt < %s
+	""", archive_before)[0][0]
+	if not first_reading_dt:
+		return
+
+	month_start = datetime.datetime.combine(get_first_day(first_reading_dt), datetime.time.min)
+	while month_start < archive_before:
+		month_end = datetime.datetime.combine(add_months(month_start, 1), datetime.time.min)
+		archive_month(month_start, month_end, chunk_size=chunk_size, verbose=verbose)
+		month_start = month_end
+
+
+def archive_month(month_start, month_end, chunk_size=10000, verbose=False):
+	# Readings are read and encoded one Air Monitor at a time using the (air_monitor, reading_dt) key,
+	# so that only the compact columns of the month are held in memory
+	monitor_columns = []
+	names = []
+	for air_monitor in frappe.get_all("Air Monitor", pluck="name", order_by="name"):
+		readings = frappe.db.sql("""
+			select name, air_monitor, reading_dt, pm_2_5, temperature, relative_humidity, co2, aqi_us, aqi_category
+			from `tabMonitor Reading`
+			where air_monitor = %(air_monitor)s and reading_dt >= %(from_dt)s and reading_dt < %(to_dt)s
+		""", {"air_monitor": air_monitor, "from_dt": month_start, "to_dt": month_end}, as_dict=1)
+		if not readings:
+			continue
+
+		columns = readings_to_columns(readings)
+		monitor_columns.append(columns)
+		names.append(columns["name"])
+
+	if not monitor_columns:
+		return
+
+	names = np.concatenate(names)
+	if verbose:
+		print(f"Archiving {len(names)} readings of {month_start.strftime('%Y-%m')}")
+
+	# The file is complete before any reading is deleted.
+	# Rows of the table replace archived rows of the same Air Monitor and time, e.g. late readings or a rerun after an interruption
+	existing = load_archive_file(month_start)
+	columns = merge_columns(([existing] if existing else []) + monitor_columns)
+
+	write_archive_file(month_start, columns)
+
+	# Reads of the month are served from the archive before its readings are deleted
+	archived_until = get_archived_until()
+	if not archived_until or archived_until < month_end:
+		frappe.db.set_global(ARCHIVED_UNTIL_KEY, cstr(month_end))
+		frappe.db.commit()
+
+	chunk_size = cint(chunk_size) or 10000
+	for i in range(0, len(names), chunk_size):
+		frappe.db.sql("""
+			delete from `tabMonitor Reading`
+			where name in %s
+		""", [names[i:i + chunk_size].tolist()])
+		frappe.db.commit()
+
+
+def get_archived_until():
+	archived_until = frappe.db.get_global(ARCHIVED_UNTIL_KEY)
+	return get_datetime(archived_until) if archived_until else None
+
+
+def get_archived_readings(from_dt, to_dt, air_monitor=None, enabled_monitors=None):
+	"""
+	Readings between from_dt and to_dt from the archive files, as rows with the fields of get_monitor_readings
+	"""
+	from_dt = get_datetime(from_dt)
+	to_dt = get_datetime(to_dt)
+
+	if isinstance(air_monitor, str):
+		air_monitor = [air_monitor]
+
+	out = []
+	month_start = datetime.datetime.combine(get_first_day(from_dt), datetime.time.min)
+	while month_start <= to_dt:
+		columns = load_archive_file(month_start)
+		if columns:
+			out += filter_archive_columns(columns, from_dt, to_dt, air_monitor, enabled_monitors)
+
+		month_start = datetime.datetime.combine(add_months(month_start, 1), datetime.time.min)
+
+	return out
+
+
+def filter_archive_columns(columns, from_dt, to_dt, air_monitors=None, enabled_monitors=None):
+	reading_dt = columns["reading_dt"]
+	monitor_codes = columns["air_monitor"]
+
+	monitor_names = columns["monitors"]
+	allowed_monitors = None
+	if air_monitors is not None:
+		allowed_monitors = set(air_monitors)
+	if enabled_monitors is not None:
+		allowed_monitors = set(enabled_monitors) if allowed_monitors is None else allowed_monitors & set(enabled_monitors)
+
+	allowed_codes = [i for i, name in enumerate(monitor_names.tolist())
+		if allowed_monitors is None or name in allowed_monitors]
+
+	# Rows are sorted by Air Monitor and time, so each monitor's rows in the range are found by binary search
+	from_dt = np.datetime64(from_dt, "us")
+	to_dt = np.datetime64(to_dt, "us")
+	indexes = []
+	for code in allowed_codes:
+		monitor_start = np.searchsorted(monitor_codes, code, side="left")
+		monitor_end = np.searchsorted(monitor_codes, code, side="right")
+		monitor_reading_dt = reading_dt[monitor_start:monitor_end]
+
+		start = monitor_start + np.searchsorted(monitor_reading_dt, from_dt, side="left")
+		end = monitor_start + np.searchsorted(monitor_reading_dt, to_dt, side="right")
+		if start < end:
+			indexes.append(np.arange(start, end))
+
+	aqi_categories = columns["aqi_categories"]
+
+	out = []
+	for i in (np.concatenate(indexes) if indexes else []):
+		row = frappe._dict({
+			"name": int(columns["name"][i]),
+			"reading_dt": reading_dt[i].astype(datetime.datetime),
+			"air_monitor": cstr(monitor_names[columns["air_monitor"][i]]),
+			"aqi_category": cstr(aqi_categories[columns["aqi_category"][i]]) or None,
+		})
+		for f in ARCHIVE_VALUE_FIELDS:
+			value = columns[f][i].item()
+			if np.isnan(value):
+				value = None
+			elif f in ARCHIVE_INT_FIELDS:
+				value = int(value)
+
+			row[f] = value
+
+		out.append(row)
+
+	return out
+
+
+def readings_to_columns(readings):
+	monitors = sorted({d.air_monitor for d in readings})
+	monitor_codes = {name: i for i, name in enumerate(monitors)}
+
+	aqi_categories = sorted({cstr(d.aqi_category) for d in readings})
+	aqi_category_codes = {name: i for i, name in enumerate(aqi_categories)}
+
+	columns = {
+		"monitors": np.array(monitors, dtype=str),
+		"aqi_categories": np.array(aqi_categories, dtype=str),
+		"name": np.array([cint(d.name) for d in readings], dtype=np.int64),
+		"air_monitor": np.array([monitor_codes[d.air_monitor] for d in readings], dtype=np.int32),
+		"reading_dt": np.array([get_datetime(d.reading_dt) for d in readings], dtype="datetime64[us]"),
+		"aqi_category": np.array([aqi_category_codes[cstr(d.aqi_category)] for d in readings], dtype=np.int8),
+	}
+	# Missing values are stored as NaN
+	for f in ARCHIVE_VALUE_FIELDS:
+		columns[f] = np.array([np.nan if d.get(f) is None else d.get(f) for d in readings], dtype=np.float64)
+
+	return sort_columns(columns)
+
+
+def merge_columns(columns_list):
+	"""
+	Combine archive columns into one, keeping a single row per Air Monitor and time.
+	Rows of later columns in columns_list replace rows of earlier ones with the same Air Monitor and time
+	"""
+	# Strings are re-encoded against a combined dictionary
+	monitors = sorted(set().union(*[columns["monitors"].tolist() for columns in columns_list]))
+	aqi_categories = sorted(set().union(*[columns["aqi_categories"].tolist() for columns in columns_list]))
+
+	def recode(columns, field, dictionary_field, dictionary):
+		codes = {name: i for i, name in enumerate(dictionary)}
+		mapping = np.array([codes[name] for name in columns[dictionary_field].tolist()], dtype=columns[field].dtype)
+		return mapping[columns[field]] if len(mapping) else columns[field]
+
+	merged = {
+		"monitors": np.array(monitors, dtype=str),
+		"aqi_categories": np.array(aqi_categories, dtype=str),
+		"air_monitor": np.concatenate([recode(c, "air_monitor", "monitors", monitors) for c in columns_list]),
+		"aqi_category": np.concatenate([recode(c, "aqi_category", "aqi_categories", aqi_categories) for c in columns_list]),
+	}
+	for f in ["name", "reading_dt"] + ARCHIVE_VALUE_FIELDS:
+		merged[f] = np.concatenate([c[f] for c in columns_list])
+
+	priority = np.concatenate([np.full(len(c["name"]), i, dtype=np.int32) for i, c in enumerate(columns_list)])
+
+	# The last row of each Air Monitor and time in (air_monitor, reading_dt, priority) order is kept
+	order = np.lexsort((priority, merged["reading_dt"], merged["air_monitor"]))
+	air_monitor = merged["air_monitor"][order]
+	reading_dt = merged["reading_dt"][order]
+	is_last = np.ones(len(order), dtype=bool)
+	is_last[:-1] = (air_monitor[1:] != air_monitor[:-1]) | (reading_dt[1:] != reading_dt[:-1])
+
+	keep = order[is_last]
+	return {f: (values if f in ("monitors", "aqi_categories") else values[keep]) for f, values in merged.items()}
+
+
+def sort_columns(columns):
+	order = np.lexsort((columns["reading_dt"], columns["air_monitor"]))
+	return {f: (values if f in ("monitors", "aqi_categories") else values[order]) for f, values in columns.items()}
+
+
+def load_archive_file(month_start):
+	"""
+	Columns of the archive file of a month, cached for the current request or job until the file changes.
+	The returned arrays are shared, so they must not be modified
+	"""
+	file_path = get_archive_file_path(month_start)
+	if not os.path.exists(file_path):
+		return None
+
+	mtime = os.path.getmtime(file_path)
+
+	if not hasattr(frappe.local, "reading_archive_cache"):
+		frappe.local.reading_archive_cache = {}
+	archive_cache = frappe.local.reading_archive_cache
+
+	cached = archive_cache.get(file_path)
+	if cached and cached[0] == mtime:
+		return cached[1]
+
+	with np.load(file_path, allow_pickle=False) as data:
+		columns = {f: data[f] for f in data.files}
+
+	archive_cache.pop(file_path, None)
+	archive_cache[file_path] = (mtime, columns)
+	while len(archive_cache) > ARCHIVE_CACHE_MONTHS:
+		archive_cache.pop(next(iter(archive_cache)))
+
+	return columns
+
+
+def write_archive_file(month_start, columns):
+	file_path = get_archive_file_path(month_start)
+	os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+	# Written to a temporary file and renamed so that readers never see a partial archive
+	temp_path = f"{file_path}.{frappe.generate_hash(length=8)}.tmp.npz"
+	np.savez_compressed(temp_path, **columns)
+	os.replace(temp_path, file_path)
+
+
+def get_archive_file_path(month_start):
+	return frappe.get_site_path("private", ARCHIVE_FOLDER, f"{getdate(month_start).strftime('%Y-%m')}.npz")
+
+
+def is_archived(from_dt):
+	archived_until = get_archived_until()
+	return bool(archived_until and get_datetime(from_dt) < archived_until)
+
+
+def validate_not_archived(from_dt):
+	if is_archived(from_dt):
+		frappe.throw(_("Monitor Readings before {0} are archived. Raw readings of archived months can only be aggregated one hour at a time").format(
+			frappe.format(get_archived_until())
+		))
@@ -0,0 +1,186 @@
+import frappe
+from frappe import _
+from frappe.utils import cint, cstr
+from aqp.air_quality.doctype.monitor_reading.reading_ingest import _insert_readings
+import hashlib
+import json
+import csv
+import os
+
+FILE_FORMATS = ("csv", "ndjson")
+MAX_LOGGED_ERRORS = 100
+
+
+def import_readings(
+	file_path,
+	file_format=None,
+	chunk_size=1000,
+	on_duplicate="Ignore",
+	restart=False,
+	aggregate=True,
+	verbose=False,
+	publish_realtime=False,
+):
+	file_path = os.path.abspath(file_path)
+	if not os.path.isfile(file_path):
+		frappe.throw(_("File {0} does not exist").format(file_path))
+
+	file_format = file_format or get_file_format(file_path)
+	if file_format not in FILE_FORMATS:
+		frappe.throw(_("File format must be one of {0}").format(", ".join(FILE_FORMATS)))
+
+	chunk_size = cint(chunk_size) or 1000
+	file_size = os.path.getsize(file_path)
+
+	checkpoint_key = get_checkpoint_key(file_path)
+	if restart:
+		clear_checkpoint(checkpoint_key)
+
+	checkpoint = get_checkpoint(checkpoint_key)
+	if verbose and checkpoint.offset:
+		print(f"Resuming import of {file_path} from byte {checkpoint.offset}")
+
+	with open(file_path, "rb") as f:
+		header = None
+		if file_format == "csv":
+			header = [cstr(h).strip() for h in next(csv.reader([f.readline().decode("utf-8-sig")]), [])]
+
+		if checkpoint.offset:
+			f.seek(checkpoint.offset)
+
+		while True:
+			lines = read_lines(f, chunk_size)
+			if not lines:
+				break
+
+			readings = parse_lines(lines, file_format, header)
+			result = _insert_readings(readings, on_duplicate=on_duplicate)
+
+			for d in result.results:
+				if d.status == "Rejected" and len(checkpoint.errors) < MAX_LOGGED_ERRORS:
+					checkpoint.errors.append(_("Line {0}: {1}").format(checkpoint.lines + d.index + 1, d.error))
+
+			checkpoint.lines += len(lines)
+			checkpoint.accepted += result.accepted
+			checkpoint.rejected += result.rejected
+			checkpoint.offset = f.tell()
+
+			# Checkpoint is committed with the readings and their queued aggregation hours
+			# so that an interrupted import resumes after the last chunk
+			save_checkpoint(checkpoint_key, checkpoint)
+			frappe.db.commit()
+
+			if verbose:
+				print(f"Imported {checkpoint.lines} lines ({checkpoint.accepted} accepted, {checkpoint.rejected} rejected)")
+
+			if publish_realtime:
+				publish_import_progress(checkpoint.offset, file_size, checkpoint)
+
+	if aggregate:
+		enqueue_aggregation(checkpoint, verbose=verbose)
+
+	clear_checkpoint(checkpoint_key)
+	frappe.db.commit()
+
+	if publish_realtime:
+		publish_import_progress(file_size, file_size, checkpoint)
+
+	return checkpoint
+
+
+def get_file_format(file_path):
+	extension = os.path.splitext(file_path)[1].lower().lstrip(".")
+	if extension in ("json", "jsonl"):
+		return "ndjson"
+
+	return extension
+
+
+def read_lines(f, count):
+	lines = []
+	while len(lines) < count:
+		line = f.readline()
+		if not line:
+			break
+
+		if line.strip():
+			lines.append(line)
+
+	return lines
+
+
+def parse_lines(lines, file_format, header=None):
+	readings = []
+	for line in lines:
+		line = line.decode("utf-8")
+		try:
+			if file_format == "csv":
+				values = next(csv.reader([line]))
+				readings.append(dict(zip(header, values)))
+			else:
+				readings.append(json.loads(line))
+		except Exception:
+			# Not a dict, rejected by _insert_readings with the line number preserved
+			readings.append(None)
+
+	return readings
+
+
+def enqueue_aggregation(checkpoint, verbose=False):
+	"""
+	Imported readings queue their hours in Reading Aggregate Queue. The queue is shared with live ingest,
+	so it is left to the time bound queue processing job instead of being drained by the import
+	"""
+	from aqp.air_quality.doctype.reading_aggregate.reading_aggregate import (
+		enqueue_reading_aggregate_queue,
+		get_pending_aggregation_hours,
+	)
+
+	enqueue_reading_aggregate_queue()
+	checkpoint.pending_aggregation_hours = get_pending_aggregation_hours()
+
+	if verbose:
+		print(f"Aggregation enqueued, {checkpoint.pending_aggregation_hours} hours pending")
+
+
+def get_checkpoint_key(file_path):
+	return "reading_import_checkpoint:" + hashlib.sha1(file_path.encode()).hexdigest()
+
+
+def get_checkpoint(checkpoint_key):
+	checkpoint = frappe.parse_json(frappe.db.get_global(checkpoint_key) or "{}")
+	checkpoint.setdefault("offset", 0)
+	checkpoint.setdefault("lines", 0)
+	checkpoint.setdefault("accepted", 0)
+	checkpoint.setdefault("rejected", 0)
+	checkpoint.setdefault("errors", [])
+	return checkpoint
+
+
+def save_checkpoint(checkpoint_key, checkpoint):
+	frappe.db.set_global(checkpoint_key, json.dumps(checkpoint))
+
+
+def clear_checkpoint(checkpoint_key):
+	frappe.defaults.clear_default(key=checkpoint_key, parent="__global")
+
+
+def publish_import_progress(progress, total, checkpoint):
+	finished = progress == total
+
+	message = _("Imported {0} lines ({1} accepted, {2} rejected)").format(
+		checkpoint.lines, checkpoint.accepted, checkpoint.rejected
+	)
+	if finished:
+		message = _("Finished: {0}").format(message)
+		if checkpoint.get("pending_aggregation_hours"):
+			message += ". " + _("Aggregation of {0} hours pending").format(checkpoint.pending_aggregation_hours)
+
+	progress_data = {
+		"progress": progress,
+		"total": total,
+		"message": message,
+		"errors": checkpoint.errors if finished else [],
+	}
+	frappe.publish_realtime("import_readings_progress", progress_data,
+		doctype="Reading Update Tool", docname="Reading Update Tool")
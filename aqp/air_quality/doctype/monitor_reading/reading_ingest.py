@@ -0,0 +1,274 @@
+import frappe
+from frappe import _
+from frappe.utils import get_datetime, flt, cint, cstr, now_datetime
+from aqp.air_quality.aqi import calculate_aqi_batch, get_aqi_category
+from aqp.air_quality.utils import get_next_sequence_values, bulk_upsert
+from aqp.air_quality.doctype.monitor_reading.monitor_reading import clear_readings_cache
+from aqp.air_quality.doctype.air_monitor.air_monitor import (
+	queue_first_last_reading_updates,
+	queue_nowcast_updates,
+	queue_nowcast_rebuild,
+)
+from aqp.air_quality.doctype.reading_aggregate_queue.reading_aggregate_queue import queue_reading_aggregation
+from aqp.air_quality.doctype.monitor_reading.reading_realtime import queue_realtime_readings
+import datetime
+import time
+
+MAX_BATCH_SIZE = 10000
+
+READING_VALUE_FIELDS = ["pm_2_5", "temperature", "relative_humidity", "co2"]
+NON_NEGATIVE_FIELDS = ["pm_2_5", "co2"]
+
+INSERT_FIELDS = [
+	"name", "creation", "modified", "owner", "modified_by", "docstatus", "idx",
+	"air_monitor", "reading_dt",
+	"pm_2_5", "temperature", "relative_humidity", "co2",
+	"aqi_us", "aqi_category",
+]
+
+UPSERT_FIELDS = [
+	"modified", "modified_by",
+	"pm_2_5", "temperature", "relative_humidity", "co2",
+	"aqi_us", "aqi_category",
+]
+
+ON_DUPLICATE_OPTIONS = ("Reject", "Ignore", "Update")
+
+
+@frappe.whitelist(methods=["POST"])
+def insert_readings(readings, on_duplicate="Reject"):
+	frappe.has_permission("Monitor Reading", "create", throw=True)
+	if on_duplicate == "Update":
+		frappe.has_permission("Monitor Reading", "write", throw=True)
+
+	readings = frappe.parse_json(readings)
+	if not isinstance(readings, list):
+		frappe.throw(_("readings must be a list of Monitor Readings"))
+	if len(readings) > MAX_BATCH_SIZE:
+		frappe.throw(_("Cannot insert more than {0} readings in a single batch").format(MAX_BATCH_SIZE))
+
+	return _insert_readings(readings, on_duplicate=on_duplicate)
+
+
+def _insert_readings(readings, on_duplicate="Reject", chunk_size=1000):
+	if on_duplicate not in ON_DUPLICATE_OPTIONS:
+		frappe.throw(_("on_duplicate must be one of {0}").format(", ".join(ON_DUPLICATE_OPTIONS)))
+
+	results = [None] * len(readings)
+	to_insert = []
+
+	air_monitors = get_enabled_air_monitors(readings)
+
+	seen = set()
+	for i, d in enumerate(readings):
+		try:
+			row = parse_reading(d, air_monitors)
+		except frappe.ValidationError as e:
+			results[i] = get_rejected_result(i, cstr(e))
+			continue
+
+		key = (row.air_monitor, row.reading_dt)
+		if key in seen:
+			results[i] = get_rejected_result(i, _("Duplicate reading in batch"))
+			continue
+
+		seen.add(key)
+		row.idx = i
+		to_insert.append(row)
+
+	set_aqi_for_readings(to_insert)
+	bulk_insert_readings(to_insert, update_existing=on_duplicate == "Update", chunk_size=chunk_size)
+
+	# Rows that hit the unique (air_monitor, reading_dt) key were not inserted under their reserved name
+	inserted = get_inserted_names(to_insert)
+
+	written = []
+	updated = []
+	for row in to_insert:
+		if row.name in inserted:
+			results[row.idx] = frappe._dict({"index": row.idx, "status": "Accepted", "name": row.name})
+			written.append(row)
+		elif on_duplicate == "Update":
+			results[row.idx] = frappe._dict({"index": row.idx, "status": "Updated"})
+			written.append(row)
+			updated.append(row)
+		elif on_duplicate == "Ignore":
+			results[row.idx] = frappe._dict({"index": row.idx, "status": "Ignored"})
+		else:
+			results[row.idx] = get_rejected_result(row.idx, _("Monitor Reading for Air Monitor {0} at {1} already exists").format(
+				row.air_monitor, row.reading_dt
+			))
+
+	if written:
+		clear_readings_cache()
+		update_air_monitors(written, updated)
+		queue_reading_aggregation([(row.air_monitor, row.reading_dt) for row in written])
+		queue_realtime_readings([(row.air_monitor, row.reading_dt) for row in written])
+
+	return frappe._dict({
+		"accepted": len(written),
+		"rejected": len([d for d in results if d.status == "Rejected"]),
+		"results": results,
+	})
+
+
+def parse_reading(data, air_monitors):
+	if not isinstance(data, dict):
+		raise frappe.ValidationError(_("Reading must be an object"))
+
+	air_monitor = cstr(data.get("air_monitor"))
+	if not air_monitor:
+		raise frappe.ValidationError(_("Air Monitor is required"))
+	if air_monitor not in air_monitors:
+		raise frappe.ValidationError(_("Air Monitor {0} does not exist or is disabled").format(air_monitor))
+
+	if not data.get("reading_dt"):
+		raise frappe.ValidationError(_("Reading Time is required"))
+
+	try:
+		reading_dt = get_datetime(data.get("reading_dt"))
+	except Exception:
+		reading_dt = None
+
+	if not isinstance(reading_dt, datetime.datetime):
+		raise frappe.ValidationError(_("Reading Time {0} is invalid").format(data.get("reading_dt")))
+
+	row = frappe._dict({
+		"air_monitor": air_monitor,
+		"reading_dt": reading_dt,
+	})
+
+	for f in READING_VALUE_FIELDS:
+		row[f] = flt(data.get(f))
+
+	for f in NON_NEGATIVE_FIELDS:
+		if row[f] < 0:
+			raise frappe.ValidationError(_("{0} cannot be negative").format(f))
+
+	return row
+
+
+def get_rejected_result(index, error):
+	return frappe._dict({"index": index, "status": "Rejected", "error": error})
+
+
+def get_enabled_air_monitors(readings):
+	air_monitors = {cstr(d.get("air_monitor")) for d in readings if isinstance(d, dict) and d.get("air_monitor")}
+	if not air_monitors:
+		return set()
+
+	return set(frappe.get_all("Air Monitor", filters={
+		"name": ["in", list(air_monitors)],
+		"disabled": 0,
+	}, pluck="name"))
+
+
+def get_inserted_names(rows):
+	if not rows:
+		return set()
+
+	return {cint(name) for name in frappe.get_all("Monitor Reading", filters={
+		"name": ["in", [row.name for row in rows]],
+	}, pluck="name")}
+
+
+def set_aqi_for_readings(rows):
+	aqi_values = calculate_aqi_batch("PM2.5", [row.pm_2_5 for row in rows])
+	for row, aqi_us in zip(rows, aqi_values):
+		row.aqi_us = aqi_us
+		row.aqi_category = get_aqi_category(row.aqi_us) if row.pm_2_5 else "Not Available"
+
+
+def bulk_insert_readings(rows, update_existing=False, chunk_size=1000):
+	if not rows:
+		return
+
+	now = now_datetime()
+	user = frappe.session.user
+
+	names = get_next_sequence_values("Monitor Reading", len(rows))
+	for row, name in zip(rows, names):
+		row.name = name
+
+	values = [(
+		row.name, now, now, user, user, 0, 0,
+		row.air_monitor, row.reading_dt,
+		row.pm_2_5, row.temperature, row.relative_humidity, row.co2,
+		row.aqi_us, row.aqi_category,
+	) for row in rows]
+
+	bulk_upsert("Monitor Reading", INSERT_FIELDS, values,
+		update_fields=UPSERT_FIELDS if update_existing else None,
+		ignore_duplicates=True,
+		chunk_size=chunk_size,
+	)
+
+
+def update_air_monitors(rows, updated_rows=None):
+	updates = {}
+	for row in rows:
+		if row.air_monitor in updates:
+			first_reading_dt, last_reading_dt = updates[row.air_monitor]
+			updates[row.air_monitor] = (min(first_reading_dt, row.reading_dt), max(last_reading_dt, row.reading_dt))
+		else:
+			updates[row.air_monitor] = (row.reading_dt, row.reading_dt)
+
+	queue_first_last_reading_updates(updates)
+
+	rebuild = {row.air_monitor for row in updated_rows or []}
+	queue_nowcast_updates([(row.air_monitor, row.reading_dt, row.pm_2_5) for row in rows if row.air_monitor not in rebuild])
+	queue_nowcast_rebuild(rebuild)
+
+
+def benchmark_insert_readings(air_monitor, count=1000, chunk_size=1000):
+	"""
+	Compare one-doc-at-a-time insertion against the bulk path. All inserted readings are rolled back.
+	Usage: bench --site {site} execute aqp.air_quality.doctype.monitor_reading.reading_ingest.benchmark_insert_readings
+		--kwargs "{'air_monitor': 'Monitor Name', 'count': 1000}"
+	"""
+	count = cint(count)
+	last_reading_dt = frappe.db.get_value("Air Monitor", air_monitor, "last_reading_dt")
+	start_dt = get_datetime(last_reading_dt or now_datetime()) + datetime.timedelta(days=1)
+
+	def make_readings(offset):
+		return [{
+			"air_monitor": air_monitor,
+			"reading_dt": start_dt + datetime.timedelta(minutes=offset + i),
+			"pm_2_5": (i % 5000) / 10,
+			"temperature": 25,
+			"relative_humidity": 50,
+			"co2": 400,
+		} for i in range(count)]
+
+	def run(name, fn):
+		frappe.db.savepoint(name)
+		start = time.monotonic()
+		fn()
+		elapsed = time.monotonic() - start
+		frappe.db.rollback(save_point=name)
+		frappe.db.after_commit.reset()
+		clear_readings_cache()
+
+		rows_per_sec = count / elapsed if elapsed else 0
+		print(f"{name}: {count} readings in {elapsed:.2f}s ({rows_per_sec:.0f} rows/sec)")
+		return rows_per_sec
+
+	def insert_docs():
+		for d in make_readings(0):
+			doc = frappe.new_doc("Monitor Reading")
+			doc.update(d)
+			doc.insert()
+
+	def insert_bulk():
+		readings = make_readings(count)
+		for i in range(0, len(readings), chunk_size):
+			_insert_readings(readings[i:i + chunk_size], chunk_size=chunk_size)
+
+	out = frappe._dict({
+		"doc_rows_per_sec": run("benchmark_insert_docs", insert_docs),
+		"bulk_rows_per_sec": run("benchmark_insert_bulk", insert_bulk),
+	})
+	out.speedup = out.bulk_rows_per_sec / out.doc_rows_per_sec if out.doc_rows_per_sec else 0
+
+	print(f"Speedup: {out.speedup:.1f}x")
+	return out
@@ -0,0 +1,127 @@
+import frappe
+from frappe.utils import cstr, get_datetime
+from aqp.air_quality.utils import push_to_buffer, pop_buffer
+import datetime
+import json
+
+REALTIME_EVENT = "latest_readings_update"
+REALTIME_ROOM = "website"
+# Same as the default window of get_latest_readings
+REALTIME_WINDOW_MINUTES = 60
+REALTIME_BUFFER_KEY = "latest_readings_realtime_updates"
+REALTIME_PENDING_KEY = "latest_readings_realtime_pending"
+# Lets changes enqueue a publish job again if a job died without clearing the pending key
+REALTIME_PENDING_EXPIRY = 60
+
+
+def queue_realtime_readings(readings):
+	# readings: [(air_monitor, reading_dt)]
+	queue_realtime_entries([json.dumps(["reading", air_monitor, cstr(reading_dt)]) for air_monitor, reading_dt in readings])
+
+
+def queue_realtime_aggregates(aggregates):
+	# aggregates: [(monitor_region, reading_dt)] of Hourly aggregates
+	queue_realtime_entries([json.dumps(["aggregate", monitor_region, cstr(reading_dt)]) for monitor_region, reading_dt in aggregates])
+
+
+def queue_realtime_entries(entries):
+	if entries:
+		frappe.db.after_commit.add(lambda: push_realtime_entries(entries))
+
+
+def push_realtime_entries(entries):
+	push_to_buffer(REALTIME_BUFFER_KEY, entries)
+	enqueue_realtime_publish()
+
+
+def enqueue_realtime_publish():
+	# Only one publish job is pending at a time, changes buffered until it runs are coalesced into it
+	cache = frappe.cache()
+	if cache.set(cache.make_key(REALTIME_PENDING_KEY), 1, nx=True, ex=REALTIME_PENDING_EXPIRY):
+		frappe.enqueue(publish_realtime_updates, queue="short", pending=True)
+
+
+def publish_realtime_updates(pending=False):
+	"""
+	Publish the latest buffered reading of each Air Monitor and Hourly aggregate of each region as a single message.
+	Also scheduled every minute as a fallback
+	"""
+	cache = frappe.cache()
+
+	try:
+		entries = pop_buffer(REALTIME_BUFFER_KEY)
+		if entries:
+			publish_realtime_entries(entries)
+	finally:
+		if pending:
+			cache.delete(cache.make_key(REALTIME_PENDING_KEY))
+
+			# Changes buffered while this job was publishing did not enqueue a job of their own
+			if cache.llen(cache.make_key(REALTIME_BUFFER_KEY)):
+				enqueue_realtime_publish()
+
+
+def publish_realtime_entries(entries):
+	from aqp.air_quality.doctype.monitor_reading.monitor_reading import get_latest_reading_dt
+
+	latest_readings = {}
+	latest_aggregates = {}
+	for entry in entries:
+		entry_type, name, reading_dt = json.loads(entry)
+		reading_dt = get_datetime(reading_dt)
+
+		latest = latest_readings if entry_type == "reading" else latest_aggregates
+		if name not in latest or reading_dt > latest[name]:
+			latest[name] = reading_dt
+
+	message = frappe._dict({
+		"readings": get_readings(latest_readings),
+		"aggregates": get_hourly_aggregates(latest_aggregates, get_latest_reading_dt()),
+	})
+
+	if message.readings or message.aggregates:
+		frappe.publish_realtime(REALTIME_EVENT, message, room=REALTIME_ROOM)
+
+
+def get_readings(latest_readings):
+	from aqp.air_quality.doctype.air_monitor.air_monitor import _get_monitors
+	from aqp.air_quality.doctype.monitor_reading.monitor_reading import set_nowcast_for_readings
+
+	if not latest_readings:
+		return []
+
+	# Historical readings, e.g. of an import, are older than their Air Monitor's latest reading and are not published
+	readings = frappe.db.sql("""
+		select r.name, r.reading_dt,
+			r.air_monitor,
+			r.pm_2_5, r.aqi_us, r.aqi_category,
+			r.temperature, r.relative_humidity, r.co2
+		from `tabMonitor Reading` r
+		inner join `tabAir Monitor` m on m.name = r.air_monitor
+		where (r.air_monitor, r.reading_dt) in %(keys)s
+			and r.reading_dt >= ifnull(m.last_reading_dt, r.reading_dt)
+			and m.disabled = 0
+	""", {"keys": tuple(latest_readings.items())}, as_dict=1)
+
+	if readings:
+		monitors = _get_monitors(filters={"name": ["in", [d.air_monitor for d in readings]]})
+		set_nowcast_for_readings(readings, {d.name: d for d in monitors})
+
+	return readings
+
+
+def get_hourly_aggregates(latest_aggregates, latest_reading_dt):
+	"""
+	Latest complete Hourly aggregate of the regions with changed aggregates, as in get_latest_readings.
+	A changed aggregate of the current hour also means the previous hour is complete.
+	Regions whose changed aggregates are all before the latest aggregate shown, e.g. of an import, are not published
+	"""
+	from aqp.air_quality.doctype.reading_aggregate.reading_aggregate import get_latest_hourly_aggregates
+
+	if not latest_aggregates or not latest_reading_dt:
+		return []
+
+	from_dt = latest_reading_dt - datetime.timedelta(minutes=REALTIME_WINDOW_MINUTES)
+	monitor_regions = [name for name, reading_dt in latest_aggregates.items() if reading_dt >= from_dt]
+
+	return get_latest_hourly_aggregates(from_dt, latest_reading_dt, monitor_regions=monitor_regions)
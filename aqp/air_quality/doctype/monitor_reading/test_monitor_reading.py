@@ -1,9 +1,58 @@
 # Copyright (c) 2023, ParaLogic and Contributors
 # See license.txt
 
-# import frappe
+import frappe
 from frappe.tests.utils import FrappeTestCase
+from aqp.air_quality.aqi import calculate_aqi
+from aqp.air_quality.doctype.monitor_reading.reading_ingest import _insert_readings
+from aqp.air_quality.doctype.reading_aggregate.test_reading_aggregate import make_test_monitor
 
 
 class TestMonitorReading(FrappeTestCase):
-	pass
+	@classmethod
+	def setUpClass(cls):
+		super().setUpClass()
+		cls.air_monitor = make_test_monitor("_Test Ingest Monitor")
+
+	def get_readings(self, reading_dt):
+		return frappe.get_all("Monitor Reading", filters={"air_monitor": self.air_monitor, "reading_dt": reading_dt},
+			fields=["name", "pm_2_5", "aqi_us"])
+
+	def test_insert_readings_on_duplicate(self):
+		reading = {"air_monitor": self.air_monitor, "reading_dt": "2023-03-14 10:05:00", "pm_2_5": 20}
+		duplicate = dict(reading, pm_2_5=40)
+
+		result = _insert_readings([reading])
+		self.assertEqual(result.accepted, 1)
+		self.assertEqual(result.results[0].status, "Accepted")
+		name = result.results[0].name
+
+		result = _insert_readings([duplicate], on_duplicate="Reject")
+		self.assertEqual((result.accepted, result.rejected), (0, 1))
+		self.assertEqual(result.results[0].status, "Rejected")
+
+		result = _insert_readings([duplicate], on_duplicate="Ignore")
+		self.assertEqual((result.accepted, result.rejected), (0, 0))
+		self.assertEqual(result.results[0].status, "Ignored")
+
+		readings = self.get_readings(reading["reading_dt"])
+		self.assertEqual(len(readings), 1)
+		self.assertEqual(readings[0].pm_2_5, 20)
+
+		result = _insert_readings([duplicate], on_duplicate="Update")
+		self.assertEqual((result.accepted, result.rejected), (1, 0))
+		self.assertEqual(result.results[0].status, "Updated")
+
+		# Updated in place, keeping the name of the original reading
+		readings = self.get_readings(reading["reading_dt"])
+		self.assertEqual(len(readings), 1)
+		self.assertEqual(readings[0].name, name)
+		self.assertEqual(readings[0].pm_2_5, 40)
+		self.assertEqual(readings[0].aqi_us, calculate_aqi("PM2.5", 40))
+
+	def test_insert_readings_duplicate_in_batch(self):
+		reading = {"air_monitor": self.air_monitor, "reading_dt": "2023-03-14 10:10:00", "pm_2_5": 20}
+
+		result = _insert_readings([reading, dict(reading, pm_2_5=40)], on_duplicate="Update")
+		self.assertEqual([d.status for d in result.results], ["Accepted", "Rejected"])
+		self.assertEqual(self.get_readings(reading["reading_dt"])[0].pm_2_5, 20)
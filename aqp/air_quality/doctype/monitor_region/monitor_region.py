@@ -6,23 +6,35 @@ from frappe import _
 from frappe.utils import cint
 from frappe.utils.nestedset import NestedSet, get_root_of
 from aqp.air_quality.doctype.air_monitor.air_monitor import _get_monitors
-from aqp.air_quality.utils import get_order_by
-from aqp.air_quality.doctype.monitor_region.region_tree import get_region_tree
+from aqp.air_quality.utils import get_order_by, invalidate_latest_readings_cache, invalidate_report_cache
+from aqp.air_quality.doctype.monitor_region.region_tree import get_region_index, invalidate_region_index
 
 
 class MonitorRegion(NestedSet):
 	def on_update(self):
 		super().on_update()
 		self.validate_one_root()
+		invalidate_latest_readings_cache()
+		invalidate_report_cache()
+		invalidate_region_index()
+
+	def on_trash(self):
+		super().on_trash()
+		invalidate_latest_readings_cache()
+		invalidate_report_cache()
+		invalidate_region_index()
+
+	def after_rename(self, old, new, merge=False):
+		invalidate_region_index()
 
 	def get_direct_air_monitors(self):
-		return _get_monitors(filters={"monitor_region": self.name}, pluck="name")
+		return list(get_region_index().monitors.get(self.name) or [])
 
 	def get_all_air_monitors(self):
 		return _get_monitors(filters={"monitor_region": ["subtree of", self.name]}, pluck="name")
 
 	def get_child_regions(self):
-		return _get_regions(filters={"parent_monitor_region": self.name}, pluck="name")
+		return list(get_region_index().children.get(self.name) or [])
 
 
 @frappe.whitelist()
@@ -44,7 +56,7 @@ def _get_regions(filters=None, limit_start=None, limit_page_length=None, sort_by
 	fields = [
 		"name", "monitor_region_name", "parent_monitor_region",
 		"type", "timezone",
-		"lft", "rgt",
+		"lft", "rgt", "last_hourly_aggregate_dt",
 		"creation", "modified",
 	]
 
@@ -68,18 +80,7 @@ def _get_regions(filters=None, limit_start=None, limit_page_length=None, sort_by
 
 
 def get_regions_bottom_up():
-	def generator():
-		region_tree = get_region_tree()
-
-		levels = region_tree.level_order_traversal()
-		bottom_up_list = []
-		for level in reversed(levels):
-			for name in level:
-				bottom_up_list.append(name)
-
-		return bottom_up_list
-
-	return frappe.local_cache("get_regions_bottom_up", "", generator)
+	return get_region_index().bottom_up
 
 
 def get_root_region():
@@ -1,8 +1,13 @@
 import frappe
 from frappe import _
 from frappe.utils import cstr
+from aqp.air_quality.utils import get_cache_counter, increment_cache_counter
 from collections import deque
 
+REGION_INDEX_VERSION_KEY = "monitor_region_index_version"
+REGION_INDEX_CACHE_KEY = "monitor_region_index"
+REGION_INDEX_CACHE_EXPIRY = 60 * 60 * 24
+
 
 class RegionNode:
 	def __init__(self, name):
@@ -28,26 +33,108 @@ class RegionNode:
 
 
 def get_region_tree():
-	def add_children(node):
-		children = regions_by_parent.get(node.name) or []
-		for ch in children:
+	regions = frappe.get_all("Monitor Region", fields=["name", "parent_monitor_region"])
+	regions_by_parent = get_regions_by_parent(regions)
+
+	root_node = RegionNode(get_root_name(regions_by_parent))
+
+	# Built with an explicit stack so that deep trees do not hit the recursion limit
+	stack = [root_node]
+	while stack:
+		node = stack.pop()
+		for ch in regions_by_parent.get(node.name) or []:
 			child_node = RegionNode(ch.name)
 			node.children.append(child_node)
-			add_children(child_node)
+			stack.append(child_node)
 
-	regions = frappe.get_all("Monitor Region", fields=["name", "parent_monitor_region"])
+	return root_node
+
+
+def get_region_index():
+	"""
+	Region tree and membership shared by all processes, rebuilt only after Monitor Regions or Air Monitors change:
+	bottom_up (all regions, deepest level first), parent, children (enabled children), ancestors (nearest first),
+	monitors (enabled Air Monitors directly in a region) and disabled regions
+	"""
+	version = get_cache_counter(REGION_INDEX_VERSION_KEY)
+
+	def generator():
+		cache_key = f"{REGION_INDEX_CACHE_KEY}|{version}"
+
+		region_index = frappe.cache().get_value(cache_key)
+		if region_index is None:
+			region_index = build_region_index()
+			frappe.cache().set_value(cache_key, region_index, expires_in_sec=REGION_INDEX_CACHE_EXPIRY)
+
+		return region_index
+
+	return frappe.local_cache("monitor_region_index", version, generator)
+
+
+def build_region_index():
+	regions = frappe.get_all("Monitor Region", fields=["name", "parent_monitor_region", "disabled"], order_by="lft asc")
+	regions_by_parent = get_regions_by_parent(regions)
+	disabled_regions = {d.name for d in regions if d.disabled}
+
+	root = get_root_name(regions_by_parent)
 
+	parent = {}
+	children = {}
+	ancestors = {root: []}
+	levels = []
+
+	# Level order traversal
+	current_level = [root]
+	while current_level:
+		levels.append(current_level)
+		next_level = []
+
+		for name in current_level:
+			region_children = [d.name for d in regions_by_parent.get(name) or []]
+			children[name] = [child for child in region_children if child not in disabled_regions]
+
+			for child in region_children:
+				parent[child] = name
+				ancestors[child] = [name] + ancestors[name]
+				next_level.append(child)
+
+		current_level = next_level
+
+	monitors = {}
+	for d in frappe.get_all("Air Monitor", filters={"disabled": 0, "monitor_region": ["is", "set"]},
+			fields=["name", "monitor_region"], order_by="name"):
+		monitors.setdefault(d.monitor_region, []).append(d.name)
+
+	return frappe._dict({
+		"root": root,
+		"bottom_up": [name for level in reversed(levels) for name in level],
+		"parent": parent,
+		"children": children,
+		"ancestors": ancestors,
+		"monitors": monitors,
+		"disabled": disabled_regions,
+	})
+
+
+def invalidate_region_index():
+	# Bumped right away for changes that are already committed and again once the current transaction commits
+	increment_cache_counter(REGION_INDEX_VERSION_KEY)
+	frappe.db.after_commit.add(lambda: increment_cache_counter(REGION_INDEX_VERSION_KEY))
+
+
+def get_regions_by_parent(regions):
 	regions_by_parent = {}
 	for d in regions:
 		regions_by_parent.setdefault(cstr(d.parent_monitor_region), []).append(d)
 
-	root_regions = regions_by_parent[""]
+	return regions_by_parent
+
+
+def get_root_name(regions_by_parent):
+	root_regions = regions_by_parent.get("") or []
 	if len(root_regions) == 0:
 		frappe.throw(_("Root Monitor Region not found"))
 	elif len(root_regions) != 1:
 		frappe.throw(_("Multiple root Monitor Regions found"))
 
-	root_node = RegionNode(root_regions[0].name)
-	add_children(root_node)
-
-	return root_node
+	return root_regions[0].name
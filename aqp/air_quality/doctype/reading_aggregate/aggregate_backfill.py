@@ -0,0 +1,340 @@
+import frappe
+from frappe import _
+from frappe.utils import getdate, get_datetime, add_days, flt, cint, cstr
+from aqp.air_quality.aqi import aggregate_readings, round_pollutant
+from aqp.air_quality.doctype.reading_aggregate.reading_aggregate import (
+	get_hourly_aggregate_data,
+	get_daily_aggregate_data,
+	get_existing_aggregates,
+	save_reading_aggregates,
+	aggregate_rollups_for_timerange,
+	publish_aggregation_progress,
+	truncate_reading_dt,
+)
+from aqp.air_quality.doctype.monitor_aggregate.monitor_aggregate import (
+	get_existing_monitor_aggregates,
+	save_monitor_aggregates,
+)
+from aqp.air_quality.doctype.monitor_reading.reading_archive import validate_not_archived
+import numpy as np
+import datetime
+import random
+
+HOUR = np.timedelta64(3600 * 10 ** 6, "us")
+
+
+def backfill_reading_aggregates(
+	from_dt,
+	to_dt,
+	update_existing=True,
+	window_days=7,
+	chunk_size=100000,
+	autocommit=False,
+	verbose=False,
+	publish_realtime=False,
+	rollups=True,
+):
+	"""
+	Compute Hourly and Daily Reading Aggregates of all regions and Monitor Aggregates of all enabled Air Monitors
+	for whole days between from_dt and to_dt, reading the raw readings only once. Weekly, Monthly and Yearly aggregates are updated after the last window
+	"""
+	# The first Hourly aggregate covers readings after the previous day's 23:00
+	validate_not_archived(get_datetime(getdate(from_dt)) - datetime.timedelta(hours=1))
+
+	region_index = get_backfill_region_index()
+	windows = get_backfill_windows(from_dt, to_dt, window_days)
+
+	for i, (from_date, to_date) in enumerate(windows):
+		if verbose:
+			print(f"Processing Region aggregation from {from_date} to {to_date}")
+
+		window_data = compute_window_aggregates(from_date, to_date, region_index, chunk_size=chunk_size)
+		# Large windows are written in committed batches
+		write_window_aggregates(from_date, to_date, window_data, update_existing=update_existing, autocommit=autocommit)
+
+		if autocommit:
+			frappe.db.commit()
+
+		if publish_realtime:
+			publish_aggregation_progress(i + 1, len(windows), "Hourly and Daily", get_datetime(to_date))
+
+	if rollups and windows:
+		aggregate_rollups_for_timerange(windows[0][0], windows[-1][1], update_existing=update_existing)
+
+		if autocommit:
+			frappe.db.commit()
+
+
+def get_backfill_windows(from_dt, to_dt, window_days):
+	from_date = getdate(from_dt)
+	to_date = getdate(to_dt)
+	window_days = max(cint(window_days), 1)
+
+	windows = []
+	while from_date <= to_date:
+		window_to_date = min(add_days(from_date, window_days - 1), to_date)
+		windows.append((from_date, window_to_date))
+		from_date = add_days(window_to_date, 1)
+
+	return windows
+
+
+def get_backfill_region_index():
+	"""
+	Index of enabled Air Monitors and all regions, with (monitor, region) pairs for every region a monitor's
+	readings accumulate into: its own region and its ancestors up to the first disabled region on the way.
+	Air Monitors without a region have no pairs but still get Monitor Aggregates
+	"""
+	regions = frappe.get_all("Monitor Region", fields=["name", "parent_monitor_region", "disabled"])
+	regions_map = {d.name: d for d in regions}
+
+	air_monitors = frappe.get_all("Air Monitor", filters={"disabled": 0}, fields=["name", "monitor_region"])
+
+	region_names = [d.name for d in regions]
+	region_idx = {name: i for i, name in enumerate(region_names)}
+	monitor_idx = {d.name: i for i, d in enumerate(air_monitors)}
+
+	pair_monitors = []
+	pair_regions = []
+	for d in air_monitors:
+		region = regions_map.get(d.monitor_region)
+		visited = set()
+		while region and region.name not in visited:
+			visited.add(region.name)
+			pair_monitors.append(monitor_idx[d.name])
+			pair_regions.append(region_idx[region.name])
+
+			if region.disabled:
+				break
+
+			region = regions_map.get(region.parent_monitor_region)
+
+	return frappe._dict({
+		"monitors": [d.name for d in air_monitors],
+		"regions": region_names,
+		"disabled_regions": np.array([cint(d.disabled) for d in regions], dtype=bool),
+		"monitor_idx": monitor_idx,
+		"pair_monitors": np.array(pair_monitors, dtype=np.int64),
+		"pair_regions": np.array(pair_regions, dtype=np.int64),
+	})
+
+
+def compute_window_aggregates(from_date, to_date, region_index, chunk_size=100000):
+	# Hour index 0 is the Hourly aggregate at from_date 00:00, covering readings after the previous day's 23:00
+	base_dt = datetime.datetime.combine(getdate(from_date), datetime.time.min)
+	days = (getdate(to_date) - getdate(from_date)).days + 1
+	hours = days * 24
+
+	num_monitors = len(region_index.monitor_idx)
+	num_regions = len(region_index.regions)
+
+	monitor_sum = np.zeros((hours, num_monitors))
+	monitor_count = np.zeros((hours, num_monitors), dtype=np.int64)
+	monitor_max = np.full((hours, num_monitors), -np.inf)
+	monitor_min = np.full((hours, num_monitors), np.inf)
+
+	from_dt = base_dt - datetime.timedelta(hours=1)
+	to_dt = base_dt + datetime.timedelta(hours=hours - 1)
+
+	for readings in iter_reading_chunks(from_dt, to_dt, chunk_size):
+		monitors = np.array([region_index.monitor_idx.get(d[1], -1) for d in readings], dtype=np.int64)
+		reading_datetimes = np.array([d[2] for d in readings], dtype="datetime64[us]")
+		values = np.array([flt(d[3]) for d in readings])
+
+		# Ceil to hour, a reading exactly at hh:00 belongs to the aggregate at hh:00
+		hour_idx = -((np.datetime64(base_dt, "us") - reading_datetimes) // HOUR)
+
+		mask = (monitors >= 0) & (hour_idx >= 0) & (hour_idx < hours)
+		index = (hour_idx[mask], monitors[mask])
+		values = values[mask]
+
+		np.add.at(monitor_sum, index, values)
+		np.add.at(monitor_count, index, 1)
+		np.maximum.at(monitor_max, index, values)
+		np.minimum.at(monitor_min, index, values)
+
+	# Reduce monitors to every region they accumulate into
+	pair_monitors = region_index.pair_monitors
+	pair_regions = region_index.pair_regions
+
+	region_sum = np.zeros((num_regions, hours))
+	region_count = np.zeros((num_regions, hours), dtype=np.int64)
+	region_max = np.full((num_regions, hours), -np.inf)
+	region_min = np.full((num_regions, hours), np.inf)
+
+	if len(pair_monitors):
+		np.add.at(region_sum, pair_regions, monitor_sum.T[pair_monitors])
+		np.add.at(region_count, pair_regions, monitor_count.T[pair_monitors])
+		np.maximum.at(region_max, pair_regions, monitor_max.T[pair_monitors])
+		np.minimum.at(region_min, pair_regions, monitor_min.T[pair_monitors])
+
+	hourly_data = {}
+	# Daily aggregates only accumulate Hourly aggregates with a non-zero average
+	hourly_valid = np.zeros((num_regions, hours), dtype=bool)
+
+	for r, h in zip(*np.nonzero(region_count)):
+		agg = make_aggregate(region_sum[r, h], region_count[r, h], region_max[r, h], region_min[r, h])
+		hourly_data[(region_index.regions[r], base_dt + datetime.timedelta(hours=int(h)))] = agg
+		hourly_valid[r, h] = bool(agg.pm_2_5)
+
+	# Hourly aggregates of disabled regions are not accumulated into their Daily aggregates
+	hourly_valid[region_index.disabled_regions, :] = False
+
+	daily_data = get_daily_data(region_index.regions, base_dt, days, hourly_valid,
+		region_sum, region_count, region_max, region_min)
+
+	# Monitor Aggregates
+	monitor_hourly_data = {}
+	monitor_hourly_valid = np.zeros((num_monitors, hours), dtype=bool)
+
+	for m, h in zip(*np.nonzero(monitor_count.T)):
+		agg = make_aggregate(monitor_sum[h, m], monitor_count[h, m], monitor_max[h, m], monitor_min[h, m])
+		monitor_hourly_data[(region_index.monitors[m], base_dt + datetime.timedelta(hours=int(h)))] = agg
+		monitor_hourly_valid[m, h] = bool(agg.pm_2_5)
+
+	monitor_daily_data = get_daily_data(region_index.monitors, base_dt, days, monitor_hourly_valid,
+		monitor_sum.T, monitor_count.T, monitor_max.T, monitor_min.T)
+
+	return frappe._dict({
+		"hourly": hourly_data,
+		"daily": daily_data,
+		"monitor_hourly": monitor_hourly_data,
+		"monitor_daily": monitor_daily_data,
+	})
+
+
+def get_daily_data(keys, base_dt, days, hourly_valid, hourly_sum, hourly_count, hourly_max, hourly_min):
+	# Hourly arrays are shaped (keys, hours), Daily aggregates only accumulate valid Hourly aggregates
+	num_keys = len(keys)
+
+	daily_sum = np.where(hourly_valid, hourly_sum, 0).reshape(num_keys, days, 24).sum(axis=2)
+	daily_count = np.where(hourly_valid, hourly_count, 0).reshape(num_keys, days, 24).sum(axis=2)
+	daily_max = np.where(hourly_valid, hourly_max, -np.inf).reshape(num_keys, days, 24).max(axis=2)
+	daily_min = np.where(hourly_valid, hourly_min, np.inf).reshape(num_keys, days, 24).min(axis=2)
+
+	daily_data = {}
+	for k, d in zip(*np.nonzero(daily_count)):
+		agg = make_aggregate(daily_sum[k, d], daily_count[k, d], daily_max[k, d], daily_min[k, d])
+		daily_data[(keys[k], base_dt + datetime.timedelta(days=int(d)))] = agg
+
+	return daily_data
+
+
+def iter_reading_chunks(from_dt, to_dt, chunk_size):
+	last = None
+	while True:
+		args = {
+			"from_dt": from_dt,
+			"to_dt": to_dt,
+			"chunk_size": cint(chunk_size),
+		}
+
+		keyset_condition = ""
+		if last:
+			args["last_dt"] = last[2]
+			args["last_name"] = last[0]
+			keyset_condition = """ and (r.reading_dt > %(last_dt)s
+				or (r.reading_dt = %(last_dt)s and r.name > %(last_name)s))"""
+
+		readings = frappe.db.sql(f"""
+			select r.name, r.air_monitor, r.reading_dt, r.pm_2_5
+			from `tabMonitor Reading` r
+			where r.reading_dt > %(from_dt)s and r.reading_dt <= %(to_dt)s
+				and r.pm_2_5 > 0
+				{keyset_condition}
+			order by r.reading_dt, r.name
+			limit %(chunk_size)s
+		""", args)
+
+		if not readings:
+			break
+
+		yield readings
+
+		if len(readings) < chunk_size:
+			break
+
+		last = readings[-1]
+
+
+def make_aggregate(pm_2_5_sum, pm_2_5_count, pm_2_5_max, pm_2_5_min):
+	agg = aggregate_readings([])
+	agg.pm_2_5_sum = float(pm_2_5_sum)
+	agg.pm_2_5_count = int(pm_2_5_count)
+	agg.pm_2_5_max = float(pm_2_5_max)
+	agg.pm_2_5_min = float(pm_2_5_min)
+	agg.pm_2_5 = round_pollutant("PM2.5", agg.pm_2_5_sum / agg.pm_2_5_count)
+	return agg
+
+
+def write_window_aggregates(from_date, to_date, window_data, update_existing=True, autocommit=False):
+	from_dt = datetime.datetime.combine(getdate(from_date), datetime.time.min)
+	to_dt = datetime.datetime.combine(getdate(to_date), datetime.time.max)
+
+	hourly_datetimes = [from_dt + datetime.timedelta(hours=h) for h in range(((to_dt - from_dt).days + 1) * 24)]
+	daily_datetimes = hourly_datetimes[::24]
+
+	for timespan, reading_datetimes, aggregate_data in (
+		("Hourly", hourly_datetimes, window_data.hourly),
+		("Daily", daily_datetimes, window_data.daily),
+	):
+		existing_aggregates = get_existing_aggregates(from_dt, to_dt, timespan)
+		save_reading_aggregates(timespan, reading_datetimes, aggregate_data, existing_aggregates,
+			update_existing=update_existing, autocommit=autocommit)
+
+	for timespan, aggregate_data in (
+		("Hourly", window_data.monitor_hourly),
+		("Daily", window_data.monitor_daily),
+	):
+		existing_aggregates = get_existing_monitor_aggregates(from_dt, to_dt, timespan)
+		save_monitor_aggregates(timespan, aggregate_data, existing_aggregates, update_existing=update_existing,
+			autocommit=autocommit)
+
+
+def verify_backfill(from_dt, to_dt, sample_hours=5, tolerance=1e-6):
+	"""
+	Compare the in-memory engine with get_hourly_aggregate_data / get_daily_aggregate_data on random sample hours.
+	Both read stored child and Hourly aggregates, so run this after the range has been aggregated.
+	Usage: bench --site {site} execute aqp.air_quality.doctype.reading_aggregate.aggregate_backfill.verify_backfill
+		--kwargs "{'from_dt': '2024-01-01', 'to_dt': '2024-01-07'}"
+	"""
+	region_index = get_backfill_region_index()
+	from_date = getdate(from_dt)
+	to_date = getdate(to_dt)
+
+	window_data = compute_window_aggregates(from_date, to_date, region_index)
+
+	base_dt = datetime.datetime.combine(from_date, datetime.time.min)
+	hours = ((to_date - from_date).days + 1) * 24
+	sample = sorted(random.sample(range(hours), min(cint(sample_hours), hours)))
+
+	mismatches = []
+	for h in sample:
+		reading_dt = base_dt + datetime.timedelta(hours=h)
+		reading_date = truncate_reading_dt(reading_dt, "Daily")
+
+		for monitor_region in region_index.regions:
+			for timespan, key, data, expected in (
+				("Hourly", (monitor_region, reading_dt), window_data.hourly, get_hourly_aggregate_data(reading_dt, monitor_region)),
+				("Daily", (monitor_region, reading_date), window_data.daily, get_daily_aggregate_data(reading_date, monitor_region)),
+			):
+				actual = data.get(key) or aggregate_readings([])
+				for f in ("pm_2_5", "pm_2_5_sum", "pm_2_5_count", "pm_2_5_max", "pm_2_5_min"):
+					if abs(flt(actual.get(f)) - flt(expected.get(f))) > tolerance:
+						mismatches.append(frappe._dict({
+							"monitor_region": monitor_region,
+							"timespan": timespan,
+							"reading_dt": cstr(key[1]),
+							"field": f,
+							"backfill": actual.get(f),
+							"expected": expected.get(f),
+						}))
+
+	if mismatches:
+		print(_("{0} mismatches found").format(len(mismatches)))
+		for d in mismatches:
+			print(d)
+	else:
+		print(_("No mismatches found in {0} sample hours").format(len(sample)))
+
+	return mismatches
@@ -3,19 +3,53 @@
 
 import frappe
 from frappe import _
-from frappe.utils import cstr, getdate, combine_datetime, get_datetime
+from frappe.utils import cstr, getdate, combine_datetime, get_datetime, flt, cint, now_datetime, add_months, add_years
 from frappe.model.document import Document
-from aqp.air_quality.utils import get_order_by
+from aqp.air_quality.utils import (
+	get_order_by,
+	get_next_sequence_values,
+	bulk_upsert,
+	mark_latest_readings_changed,
+	invalidate_report_cache,
+)
 from aqp.air_quality.doctype.monitor_region.monitor_region import get_regions_bottom_up, get_root_region
+from aqp.air_quality.doctype.monitor_region.region_tree import get_region_index
 from aqp.air_quality.doctype.monitor_reading.monitor_reading import get_monitor_readings
-from aqp.air_quality.aqi import aggregate_readings, calculate_aqi, get_aqi_category
+from aqp.air_quality.doctype.monitor_reading.reading_archive import is_archived
+from aqp.air_quality.doctype.reading_aggregate_queue.reading_aggregate_queue import (
+	claim_queued_aggregation,
+	complete_queued_aggregation,
+	release_queued_aggregation,
+)
+from aqp.air_quality.doctype.monitor_reading.reading_realtime import queue_realtime_aggregates
+from aqp.air_quality.aqi import aggregate_readings, calculate_aqi, get_aqi_category, round_pollutant
 import datetime
+import time
+
+AGGREGATE_VALUE_FIELDS = ["pm_2_5", "pm_2_5_sum", "pm_2_5_count", "pm_2_5_max", "pm_2_5_min", "aqi_us", "aqi_category"]
+
+AGGREGATE_INSERT_FIELDS = [
+	"name", "creation", "modified", "owner", "modified_by", "docstatus", "idx",
+	"monitor_region", "timespan", "reading_dt",
+] + AGGREGATE_VALUE_FIELDS
+
+AGGREGATE_UPSERT_FIELDS = ["modified", "modified_by"] + AGGREGATE_VALUE_FIELDS
+
+TIMESPANS = ["Hourly", "Daily", "Weekly", "Monthly", "Yearly"]
+ROLLUP_TIMESPANS = ["Weekly", "Monthly", "Yearly"]
+
+# Timespans above Hourly merge the sum, count, min and max of the stored aggregates of a finer timespan
+ROLLUP_SOURCE_TIMESPAN = {
+	"Daily": "Hourly",
+	"Weekly": "Daily",
+	"Monthly": "Daily",
+	"Yearly": "Monthly",
+}
 
 
 class ReadingAggregate(Document):
 	def validate(self):
 		self.validate_reading_dt()
-		self.validate_duplicate()
 		self.set_aggregated_values()
 
 	def validate_reading_dt(self):
@@ -29,8 +63,8 @@ class ReadingAggregate(Document):
 		agg = None
 		if self.timespan == "Hourly":
 			agg = get_hourly_aggregate_data(self.reading_dt, monitor_region=self.monitor_region)
-		elif self.timespan == "Daily":
-			agg = get_daily_aggregate_data(self.reading_dt, monitor_region=self.monitor_region)
+		elif self.timespan in ROLLUP_SOURCE_TIMESPAN:
+			agg = get_rollup_aggregate_data(self.reading_dt, self.timespan, monitor_region=self.monitor_region)
 
 		if not agg:
 			return
@@ -47,14 +81,13 @@ class ReadingAggregate(Document):
 		# AQI
 		self.set_aqi(update=update, update_modified=update_modified)
 
-	def validate_duplicate(self):
-		existing = get_existing_aggregate(self.reading_dt, self.timespan, self.monitor_region,
-			exclude=self.name if not self.is_new() else None)
-		if existing:
-			frappe.throw(_("Reading Aggregate at {0} already exists ({1})").format(
-				frappe.bold(self.get_formatted("reading_dt")),
-				frappe.utils.get_link_to_form("Reading Aggregate", existing)
-			), exc=frappe.DuplicateEntryError)
+	def show_unique_validation_message(self, e):
+		# Duplicates are rejected by the unique (monitor_region, timespan, reading_dt) key instead of a lookup in validate
+		frappe.throw(_("{0} Reading Aggregate of Monitor Region {1} at {2} already exists").format(
+			self.timespan,
+			frappe.bold(self.monitor_region),
+			frappe.bold(self.get_formatted("reading_dt")),
+		), exc=frappe.DuplicateEntryError)
 
 	def set_aqi(self, update=False, update_modified=True):
 		self.aqi_us = calculate_aqi("PM2.5", self.pm_2_5)
@@ -75,7 +108,8 @@ class ReadingAggregate(Document):
 
 
 def on_doctype_update():
-	frappe.db.add_index("Reading Aggregate", ["monitor_region", "reading_dt", "timespan"])
+	frappe.db.add_unique("Reading Aggregate", ["monitor_region", "timespan", "reading_dt"],
+		constraint_name="unique_monitor_region_timespan_reading_dt")
 	frappe.db.add_index("Reading Aggregate", ["reading_dt", "timespan"])
 
 
@@ -86,13 +120,15 @@ def get_hourly_aggregate_data(reading_dt, monitor_region):
 	reading_dt = truncate_reading_dt(reading_dt, "Hourly")
 	from_dt, to_dt = get_reading_timerange(reading_dt, "Hourly")
 
-	region_doc = frappe.get_cached_doc("Monitor Region", monitor_region)
+	region_index = get_region_index()
+	if monitor_region not in region_index.ancestors:
+		frappe.throw(_("Monitor Region {0} not found").format(monitor_region), frappe.DoesNotExistError)
 
-	air_monitors = region_doc.get_direct_air_monitors()
+	air_monitors = region_index.monitors.get(monitor_region) or []
 	monitor_readings = get_monitor_readings(from_dt, to_dt, air_monitor=air_monitors)
 	agg = aggregate_readings(monitor_readings, use_accumulated_values=False)
 
-	child_regions = region_doc.get_child_regions()
+	child_regions = region_index.children.get(monitor_region) or []
 	child_aggregates = get_reading_aggregates(from_dt, to_dt, "Hourly", monitor_region=child_regions)
 	agg = aggregate_readings(child_aggregates, use_accumulated_values=True, agg=agg)
 
@@ -100,13 +136,18 @@ def get_hourly_aggregate_data(reading_dt, monitor_region):
 
 
 def get_daily_aggregate_data(reading_dt, monitor_region):
+	return get_rollup_aggregate_data(reading_dt, "Daily", monitor_region)
+
+
+def get_rollup_aggregate_data(reading_dt, timespan, monitor_region):
 	if not monitor_region:
 		frappe.throw(_("Monitor Region is required"))
 
-	from_dt, to_dt = get_reading_timerange(reading_dt, "Daily")
+	from_dt, to_dt = get_reading_timerange(reading_dt, timespan)
 
-	hourly_aggregates = get_reading_aggregates(from_dt, to_dt, "Hourly", monitor_region=monitor_region)
-	agg = aggregate_readings(hourly_aggregates, use_accumulated_values=True)
+	source_aggregates = get_reading_aggregates(from_dt, to_dt, ROLLUP_SOURCE_TIMESPAN[timespan],
+		monitor_region=monitor_region)
+	agg = aggregate_readings(source_aggregates, use_accumulated_values=True)
 
 	return agg
 
@@ -119,15 +160,25 @@ def aggregate_for_regions_timerange(
 	autocommit=False,
 	verbose=False,
 	publish_realtime=False,
+	set_based=False,
+	window_size=168,
 ):
 	reading_datetimes = get_reading_datetimes_for_timerange(from_dt, to_dt, timespan)
 	count = len(reading_datetimes)
+	window_size = cint(window_size) or 1
 
+	existing_aggregates = {}
 	for i, reading_dt in enumerate(reading_datetimes):
+		# Existing aggregates are loaded with one range scan per window of timestamps
+		if i % window_size == 0:
+			window = reading_datetimes[i:i + window_size]
+			existing_aggregates = get_existing_aggregates(window[0], window[-1], timespan)
+
 		if verbose:
 			print(f"Processing {timespan} Region aggregation for timestamp {frappe.format(reading_dt)}")
 
-		aggregate_for_regions(reading_dt, timespan, update_existing=update_existing)
+		aggregate_for_regions(reading_dt, timespan, update_existing=update_existing, set_based=set_based,
+			existing_aggregates=existing_aggregates)
 
 		if autocommit:
 			frappe.db.commit()
@@ -155,46 +206,480 @@ def publish_aggregation_progress(progress, total, timespan, reading_dt):
 		doctype="Reading Update Tool", docname="Reading Update Tool")
 
 
-def aggregate_for_regions(reading_dt, timespan, update_existing=True):
+def aggregate_for_regions(
+	reading_dt,
+	timespan,
+	update_existing=True,
+	set_based=False,
+	monitor_regions=None,
+	existing_aggregates=None,
+):
+	"""
+	existing_aggregates: optional map of (monitor_region, reading_dt) to existing aggregates
+	prefetched by get_existing_aggregates for a window including reading_dt
+	"""
 	reading_dt = truncate_reading_dt(reading_dt, timespan)
 
+	if existing_aggregates is None:
+		existing_aggregates = get_existing_aggregates(reading_dt, reading_dt, timespan)
+
+	# The set based query only reads the hot table, archived readings are read through get_monitor_readings
+	if set_based and timespan == "Hourly" and is_archived(get_reading_timerange(reading_dt, timespan)[0]):
+		set_based = False
+
+	if set_based:
+		aggregate_for_regions_set_based(reading_dt, timespan, update_existing=update_existing,
+			monitor_regions=monitor_regions, existing_aggregates=existing_aggregates)
+		return
+
 	regions = get_regions_bottom_up()
 	for monitor_region in regions:
-		existing = get_existing_aggregate(reading_dt, timespan, monitor_region)
-		if not existing:
-			create_reading_aggregate(reading_dt, timespan, monitor_region)
-		elif update_existing:
-			_update_reading_aggregate(existing)
+		if monitor_regions and monitor_region not in monitor_regions:
+			continue
+
+		aggregate_for_region(reading_dt, timespan, monitor_region, update_existing=update_existing,
+			existing_aggregates=existing_aggregates)
 
 
-def create_reading_aggregate(reading_dt, timespan, monitor_region):
+def aggregate_for_regions_set_based(
+	reading_dt,
+	timespan,
+	update_existing=True,
+	monitor_regions=None,
+	existing_aggregates=None,
+):
 	reading_dt = truncate_reading_dt(reading_dt, timespan)
 
-	doc = frappe.new_doc("Reading Aggregate")
-	doc.monitor_region = monitor_region
-	doc.reading_dt = reading_dt
-	doc.timespan = timespan
+	if timespan == "Hourly":
+		aggregate_data = get_hourly_aggregate_data_for_regions(reading_dt)
+	else:
+		aggregate_data = get_rollup_aggregate_data_for_regions(reading_dt, timespan)
+
+	if existing_aggregates is None:
+		existing_aggregates = get_existing_aggregates(reading_dt, reading_dt, timespan)
+
+	save_reading_aggregates(timespan, [reading_dt], aggregate_data, existing_aggregates,
+		update_existing=update_existing, monitor_regions=monitor_regions)
+
+
+def save_reading_aggregates(
+	timespan,
+	reading_datetimes,
+	aggregate_data,
+	existing_aggregates,
+	update_existing=True,
+	monitor_regions=None,
+	autocommit=False,
+):
+	# aggregate_data and existing_aggregates are keyed by (monitor_region, reading_dt)
+	regions = [r for r in get_regions_bottom_up() if not monitor_regions or r in monitor_regions]
+
+	to_upsert = []
+	for reading_dt in reading_datetimes:
+		for monitor_region in regions:
+			key = (monitor_region, reading_dt)
+
+			agg = aggregate_data.get(key) or aggregate_readings([])
+			set_aggregate_aqi(agg)
+
+			existing = existing_aggregates.get(key)
+			if existing:
+				if not update_existing or not has_aggregate_changed(existing, agg):
+					continue
+			elif not agg.pm_2_5_count:
+				continue
+
+			agg.monitor_region = monitor_region
+			agg.timespan = timespan
+			agg.reading_dt = reading_dt
+			to_upsert.append(agg)
+
+	upsert_reading_aggregates(to_upsert, update_existing=update_existing, autocommit=autocommit)
+
+
+def get_hourly_aggregate_data_for_regions(reading_dt):
+	reading_dt = truncate_reading_dt(reading_dt, "Hourly")
+	from_dt, to_dt = get_reading_timerange(reading_dt, "Hourly")
+
+	# A reading accumulates into every ancestor of its Air Monitor's region,
+	# unless a disabled region lies in between (disabled child regions are not accumulated)
+	data = frappe.db.sql("""
+		select mr.name as monitor_region,
+			sum(r.pm_2_5) as pm_2_5_sum,
+			count(r.pm_2_5) as pm_2_5_count,
+			max(r.pm_2_5) as pm_2_5_max,
+			min(r.pm_2_5) as pm_2_5_min
+		from `tabMonitor Reading` r
+		inner join `tabAir Monitor` m on m.name = r.air_monitor
+		inner join `tabMonitor Region` monitor_mr on monitor_mr.name = m.monitor_region
+		inner join `tabMonitor Region` mr on mr.lft <= monitor_mr.lft and mr.rgt >= monitor_mr.rgt
+		where r.reading_dt between %(from_dt)s and %(to_dt)s
+			and r.pm_2_5 > 0
+			and m.disabled = 0
+			and not exists(
+				select dmr.name
+				from `tabMonitor Region` dmr
+				where dmr.disabled = 1
+					and dmr.lft <= monitor_mr.lft and dmr.rgt >= monitor_mr.rgt
+					and dmr.lft > mr.lft and dmr.rgt < mr.rgt
+			)
+		group by mr.name
+	""", {"from_dt": from_dt, "to_dt": to_dt}, as_dict=1)
+
+	return get_aggregate_data_map(data, reading_dt)
+
+
+def get_rollup_aggregate_data_for_regions(reading_dt, timespan):
+	reading_dt = truncate_reading_dt(reading_dt, timespan)
+	from_dt, to_dt = get_reading_timerange(reading_dt, timespan)
+
+	data = frappe.db.sql("""
+		select ra.monitor_region,
+			sum(ra.pm_2_5_sum) as pm_2_5_sum,
+			sum(ra.pm_2_5_count) as pm_2_5_count,
+			max(ra.pm_2_5_max) as pm_2_5_max,
+			min(ra.pm_2_5_min) as pm_2_5_min
+		from `tabReading Aggregate` ra
+		inner join `tabMonitor Region` mr on mr.name = ra.monitor_region
+		where ra.reading_dt between %(from_dt)s and %(to_dt)s
+			and ra.timespan = %(source_timespan)s
+			and ra.pm_2_5 > 0
+			and mr.disabled = 0
+		group by ra.monitor_region
+	""", {"from_dt": from_dt, "to_dt": to_dt, "source_timespan": ROLLUP_SOURCE_TIMESPAN[timespan]}, as_dict=1)
+
+	return get_aggregate_data_map(data, reading_dt)
+
+
+def get_aggregate_data_map(data, reading_dt, key_field="monitor_region"):
+	aggregate_data = {}
+	for d in data:
+		agg = aggregate_readings([])
+		agg.pm_2_5_sum = flt(d.pm_2_5_sum)
+		agg.pm_2_5_count = cint(d.pm_2_5_count)
+		agg.pm_2_5_max = flt(d.pm_2_5_max)
+		agg.pm_2_5_min = flt(d.pm_2_5_min)
+		agg.pm_2_5 = round_pollutant("PM2.5", agg.pm_2_5_sum / agg.pm_2_5_count) if agg.pm_2_5_count else 0
+
+		aggregate_data[(d[key_field], reading_dt)] = agg
+
+	return aggregate_data
+
+
+def get_existing_aggregates(from_dt, to_dt, timespan, monitor_region=None):
+	filters = {
+		"reading_dt": ["between", [from_dt, to_dt]],
+		"timespan": timespan,
+	}
+	if monitor_region:
+		filters["monitor_region"] = monitor_region
+
+	existing = frappe.get_all("Reading Aggregate", filters=filters,
+		fields=["name", "monitor_region", "reading_dt"] + AGGREGATE_VALUE_FIELDS)
+
+	return {(d.monitor_region, get_datetime(d.reading_dt)): d for d in existing}
+
+
+def set_aggregate_aqi(agg):
+	agg.aqi_us = calculate_aqi("PM2.5", agg.pm_2_5)
+	agg.aqi_category = get_aqi_category(agg.aqi_us) if agg.pm_2_5 else "Not Available"
+
+
+def has_aggregate_changed(existing, agg):
+	for f in AGGREGATE_VALUE_FIELDS:
+		if f == "aqi_category":
+			if cstr(existing.get(f)) != cstr(agg.get(f)):
+				return True
+		elif flt(existing.get(f), 9) != flt(agg.get(f), 9):
+			return True
+
+	return False
+
+
+def upsert_reading_aggregates(rows, update_existing=True, batch_size=1000, autocommit=False):
+	"""
+	Write computed aggregate rows (monitor_region, timespan, reading_dt and aggregated values)
+	with multi-row INSERT ... ON DUPLICATE KEY UPDATE on the unique (monitor_region, timespan, reading_dt) key.
+	Existing aggregates are left untouched if update_existing is not set
+	"""
+	if not rows:
+		return
+
+	batch_size = cint(batch_size) or 1000
+	now = now_datetime()
+	user = frappe.session.user
+
+	# Names reserved for rows that turn out to be updates are left unused in the sequence
+	names = get_next_sequence_values("Reading Aggregate", len(rows))
+	values = [
+		(name, now, now, user, user, 0, 0, row.monitor_region, row.timespan, row.reading_dt)
+		+ tuple(row.get(f) for f in AGGREGATE_VALUE_FIELDS)
+		for name, row in zip(names, rows)
+	]
+
+	for i in range(0, len(values), batch_size):
+		bulk_upsert("Reading Aggregate", AGGREGATE_INSERT_FIELDS, values[i:i + batch_size],
+			update_fields=AGGREGATE_UPSERT_FIELDS if update_existing else None,
+			ignore_duplicates=not update_existing,
+			chunk_size=batch_size,
+		)
+
+		if autocommit:
+			frappe.db.commit()
+
+	hourly_rows = [row for row in rows if row.timespan == "Hourly" and row.pm_2_5_count]
+	update_last_hourly_aggregate_dt(hourly_rows)
+	reset_last_hourly_aggregate_dt([row for row in rows if row.timespan == "Hourly" and not row.pm_2_5_count])
+	queue_realtime_aggregates([(row.monitor_region, row.reading_dt) for row in hourly_rows])
+
+	if any(row.timespan == "Hourly" for row in rows):
+		mark_latest_readings_changed()
+
+	invalidate_report_cache([row.reading_dt for row in rows])
+
+
+def update_last_hourly_aggregate_dt(rows):
+	# Maintains the latest Hourly aggregate per region, read by get_latest_hourly_aggregates
+	last_hourly_aggregate_dt = {}
+	for row in rows:
+		reading_dt = get_datetime(row.reading_dt)
+		if reading_dt > last_hourly_aggregate_dt.get(row.monitor_region, datetime.datetime.min):
+			last_hourly_aggregate_dt[row.monitor_region] = reading_dt
+
+	for monitor_region, reading_dt in last_hourly_aggregate_dt.items():
+		frappe.db.sql("""
+			update `tabMonitor Region`
+			set last_hourly_aggregate_dt = greatest(ifnull(last_hourly_aggregate_dt, %(reading_dt)s), %(reading_dt)s)
+			where name = %(monitor_region)s
+		""", {"monitor_region": monitor_region, "reading_dt": reading_dt})
+
+
+def reset_last_hourly_aggregate_dt(rows):
+	# Regions whose latest Hourly aggregate became empty point to their previous non-empty aggregate
+	for monitor_region, reading_dt in {(row.monitor_region, get_datetime(row.reading_dt)) for row in rows}:
+		frappe.db.sql("""
+			update `tabMonitor Region` mr
+			set mr.last_hourly_aggregate_dt = (
+				select max(ra.reading_dt)
+				from `tabReading Aggregate` ra
+				where ra.monitor_region = mr.name
+					and ra.timespan = 'Hourly'
+					and ra.pm_2_5_count > 0
+			)
+			where mr.name = %(monitor_region)s
+				and mr.last_hourly_aggregate_dt = %(reading_dt)s
+		""", {"monitor_region": monitor_region, "reading_dt": reading_dt})
+
+
+def get_latest_hourly_aggregates(from_dt, to_dt, materialized=True, monitor_regions=None):
+	"""
+	Latest Hourly aggregate of each enabled region (all or monitor_regions) between from_dt and to_dt, latest first.
+	The aggregate at hh:00 covers readings up to hh:00, so the partial aggregate of the hour of to_dt is not included.
+	materialized is only valid if no reading is after to_dt. It reads the aggregate at each region's
+	last_hourly_aggregate_dt, or at the last complete hour for regions that already have an aggregate of the current hour,
+	otherwise the latest aggregate in the range is found with a loose index scan on the unique key
+	"""
+	if monitor_regions is not None:
+		monitor_regions = list(monitor_regions)
+		if not monitor_regions:
+			return []
+
+	if not materialized:
+		return _get_latest_hourly_aggregates(from_dt, to_dt, monitor_regions=monitor_regions)
+
+	aggregates = _get_latest_hourly_aggregates(from_dt, to_dt, materialized=True, monitor_regions=monitor_regions)
+
+	# Regions with an aggregate of the current hour but none at the last complete hour, e.g. after a gap in readings
+	found = {d.monitor_region for d in aggregates}
+	filters = {"disabled": 0, "last_hourly_aggregate_dt": [">", to_dt]}
+	if monitor_regions is not None:
+		filters["name"] = ["in", monitor_regions]
 
-	doc.validate()
-	doc.flags.ignore_validate = True
+	missing = [name for name in frappe.get_all("Monitor Region", filters=filters, pluck="name") if name not in found]
+	if missing:
+		aggregates += _get_latest_hourly_aggregates(from_dt, to_dt, monitor_regions=missing)
+		aggregates.sort(key=lambda d: (get_datetime(d.reading_dt), d.monitor_region), reverse=True)
 
-	if doc.has_data():
-		doc.insert()
+	return aggregates
 
-	return doc
+
+def _get_latest_hourly_aggregates(from_dt, to_dt, materialized=False, monitor_regions=None):
+	to_dt = get_datetime(to_dt)
+	args = {
+		"from_dt": from_dt,
+		"to_dt": to_dt,
+		"last_complete_hour": to_dt.replace(minute=0, second=0, microsecond=0),
+		"monitor_regions": monitor_regions,
+	}
+
+	region_condition = " and mr.name in %(monitor_regions)s" if monitor_regions else ""
+	aggregate_region_condition = " and monitor_region in %(monitor_regions)s" if monitor_regions else ""
+
+	if materialized:
+		# Single lookup per region on the unique key
+		latest_join = """
+			inner join `tabMonitor Region` mr on mr.name = ra.monitor_region
+				and ra.reading_dt = if(mr.last_hourly_aggregate_dt > %(to_dt)s,
+					%(last_complete_hour)s, mr.last_hourly_aggregate_dt)
+		"""
+		latest_condition = "ra.reading_dt between %(from_dt)s and %(to_dt)s and ra.pm_2_5_count > 0"
+	else:
+		latest_join = f"""
+			inner join (
+				select monitor_region, max(reading_dt) as reading_dt
+				from `tabReading Aggregate`
+				where timespan = 'Hourly' and reading_dt between %(from_dt)s and %(to_dt)s
+					{aggregate_region_condition}
+				group by monitor_region
+			) latest on latest.monitor_region = ra.monitor_region and latest.reading_dt = ra.reading_dt
+			inner join `tabMonitor Region` mr on mr.name = ra.monitor_region
+		"""
+		latest_condition = "ra.reading_dt between %(from_dt)s and %(to_dt)s"
+
+	return frappe.db.sql(f"""
+		select ra.name, ra.timespan, ra.reading_dt,
+			ra.monitor_region,
+			ra.pm_2_5, ra.pm_2_5_sum, ra.pm_2_5_count, ra.pm_2_5_max, ra.pm_2_5_min,
+			ra.aqi_us, ra.aqi_category
+		from `tabReading Aggregate` ra
+		{latest_join}
+		where {latest_condition}
+			and ra.timespan = 'Hourly'
+			and mr.disabled = 0
+			{region_condition}
+		order by ra.reading_dt desc, ra.monitor_region
+	""", args, as_dict=1)
 
 
-def update_reading_aggregate(reading_dt, timespan, monitor_region):
+def aggregate_for_region(reading_dt, timespan, monitor_region, update_existing=True, existing_aggregates=None):
 	reading_dt = truncate_reading_dt(reading_dt, timespan)
 
-	existing = get_existing_aggregate(reading_dt, timespan, monitor_region)
+	if existing_aggregates is None:
+		existing_aggregates = get_existing_aggregates(reading_dt, reading_dt, timespan, monitor_region=monitor_region)
+
+	existing = existing_aggregates.get((monitor_region, reading_dt))
+	if existing and not update_existing:
+		return
+
+	if timespan == "Hourly":
+		agg = get_hourly_aggregate_data(reading_dt, monitor_region=monitor_region)
+	else:
+		agg = get_rollup_aggregate_data(reading_dt, timespan, monitor_region=monitor_region)
+
+	set_aggregate_aqi(agg)
+
 	if existing:
-		_update_reading_aggregate(existing)
+		if not has_aggregate_changed(existing, agg):
+			return
+	elif not agg.pm_2_5_count:
+		return
 
+	agg.monitor_region = monitor_region
+	agg.timespan = timespan
+	agg.reading_dt = reading_dt
 
-def _update_reading_aggregate(name):
-	doc = frappe.get_doc("Reading Aggregate", name)
-	doc.set_aggregated_values(update=True)
+	# Written right away since parent regions accumulate the stored Hourly aggregates of their children
+	upsert_reading_aggregates([agg], update_existing=update_existing)
+
+
+def process_reading_aggregate_queue(batch_size=1000, max_duration=240):
+	from aqp.air_quality.doctype.monitor_aggregate.monitor_aggregate import aggregate_queued_monitors
+	from aqp.air_quality.doctype.monitor_aggregate_queue.monitor_aggregate_queue import (
+		claim_queued_monitor_aggregation,
+		complete_queued_monitor_aggregation,
+		release_queued_monitor_aggregation,
+	)
+
+	start = time.monotonic()
+
+	while not max_duration or time.monotonic() - start < max_duration:
+		# Claimed rows stay queued until the aggregates are committed, a killed job's claims expire
+		claim_token = frappe.generate_hash(length=10)
+		queued = claim_queued_aggregation(batch_size, claim_token)
+		queued_monitors = claim_queued_monitor_aggregation(batch_size, claim_token)
+		if not queued and not queued_monitors:
+			break
+
+		try:
+			aggregate_queued(queued)
+			aggregate_queued_monitors(queued_monitors)
+
+			complete_queued_aggregation(claim_token)
+			complete_queued_monitor_aggregation(claim_token)
+			frappe.db.commit()
+		except Exception:
+			frappe.db.rollback()
+			release_queued_aggregation(claim_token)
+			release_queued_monitor_aggregation(claim_token)
+			frappe.db.commit()
+			raise
+
+
+def enqueue_reading_aggregate_queue():
+	# Processes the queue now instead of at the next scheduled run, a job that is still queued or running is not enqueued again
+	frappe.enqueue(process_reading_aggregate_queue, queue="long", job_id="process_reading_aggregate_queue",
+		deduplicate=True)
+
+
+def get_pending_aggregation_hours():
+	return cint(frappe.db.sql("""
+		select count(*)
+		from (
+			select reading_dt from `tabReading Aggregate Queue`
+			union
+			select reading_dt from `tabMonitor Aggregate Queue`
+		) q
+	""")[0][0])
+
+
+def aggregate_queued(queued):
+	all_regions = set(get_regions_bottom_up())
+
+	regions_by_hour = {}
+	for d in queued:
+		if d.monitor_region in all_regions:
+			regions_by_hour.setdefault(get_datetime(d.reading_dt), set()).add(d.monitor_region)
+
+	# All regions of an hour are computed in a single pass, only the queued ones are written
+	regions_by_date = {}
+	for reading_dt in sorted(regions_by_hour):
+		regions = regions_by_hour[reading_dt]
+		aggregate_for_regions(reading_dt, "Hourly", set_based=True, monitor_regions=regions)
+		regions_by_date.setdefault(getdate(reading_dt), set()).update(regions)
+
+	for reading_date in sorted(regions_by_date):
+		aggregate_for_regions(reading_date, "Daily", set_based=True, monitor_regions=regions_by_date[reading_date])
+
+	aggregate_rollups(regions_by_date)
+
+
+def aggregate_rollups(regions_by_date, update_existing=True):
+	"""
+	Update Weekly, Monthly and Yearly aggregates of the regions whose Daily aggregates changed.
+	regions_by_date: map of date to the set of regions, or None for all regions
+	"""
+	regions_by_dt = regions_by_date
+	for timespan in ROLLUP_TIMESPANS:
+		rollup_regions_by_dt = {}
+		for reading_dt, regions in regions_by_dt.items():
+			rollup_dt = truncate_reading_dt(reading_dt, timespan)
+			if regions is None or rollup_regions_by_dt.get(rollup_dt, set()) is None:
+				rollup_regions_by_dt[rollup_dt] = None
+			else:
+				rollup_regions_by_dt.setdefault(rollup_dt, set()).update(regions)
+
+		for rollup_dt in sorted(rollup_regions_by_dt):
+			aggregate_for_regions(rollup_dt, timespan, update_existing=update_existing, set_based=True,
+				monitor_regions=rollup_regions_by_dt[rollup_dt])
+
+		# Yearly aggregates are built from Monthly aggregates
+		if timespan == "Monthly":
+			regions_by_dt = rollup_regions_by_dt
+
+
+def aggregate_rollups_for_timerange(from_dt, to_dt, update_existing=True):
+	dates = get_reading_datetimes_for_timerange(from_dt, to_dt, "Daily")
+	aggregate_rollups({reading_dt: None for reading_dt in dates}, update_existing=update_existing)
 
 
 def get_daily_reading_aggregates(from_date, to_date, monitor_region=None):
@@ -265,14 +750,27 @@ def get_reading_timerange(reading_dt, timespan):
 	if timespan == "Hourly":
 		to_dt = reading_dt
 		from_dt = to_dt - datetime.timedelta(hours=1) + datetime.datetime.resolution
-	elif timespan == "Daily":
-		reading_date = getdate(reading_dt)
-		from_dt = combine_datetime(reading_date, datetime.time.min)
-		to_dt = combine_datetime(reading_date, datetime.time.max)
+	else:
+		# Timespans of a day or longer are stamped at their start
+		from_dt = reading_dt
+		to_dt = get_next_reading_dt(reading_dt, timespan) - datetime.datetime.resolution
 
 	return from_dt, to_dt
 
 
+def get_next_reading_dt(reading_dt, timespan):
+	if timespan == "Hourly":
+		return reading_dt + datetime.timedelta(hours=1)
+	elif timespan == "Daily":
+		return reading_dt + datetime.timedelta(days=1)
+	elif timespan == "Weekly":
+		return reading_dt + datetime.timedelta(days=7)
+	elif timespan == "Monthly":
+		return add_months(reading_dt, 1)
+	elif timespan == "Yearly":
+		return add_years(reading_dt, 1)
+
+
 def get_reading_datetimes_for_timerange(from_dt, to_dt, timespan):
 	from_dt = truncate_reading_dt(from_dt, timespan)
 	to_dt = truncate_reading_dt(to_dt, timespan)
@@ -281,10 +779,7 @@ def get_reading_datetimes_for_timerange(from_dt, to_dt, timespan):
 	current_dt = from_dt
 	while current_dt <= to_dt:
 		reading_datetimes.append(current_dt)
-		if timespan == "Hourly":
-			current_dt = current_dt + datetime.timedelta(hours=1)
-		elif timespan == "Daily":
-			current_dt = current_dt + datetime.timedelta(days=1)
+		current_dt = get_next_reading_dt(current_dt, timespan)
 
 	return reading_datetimes
 
@@ -312,10 +807,56 @@ def truncate_reading_dt(reading_dt, timespan):
 		reading_dt = datetime.datetime(reading_dt.year, reading_dt.month, reading_dt.day, reading_dt.hour)
 	elif timespan == "Daily":
 		reading_dt = datetime.datetime(reading_dt.year, reading_dt.month, reading_dt.day)
+	elif timespan == "Weekly":
+		# Weeks start on Monday, as in Air Quality Analytics
+		reading_dt = datetime.datetime(reading_dt.year, reading_dt.month, reading_dt.day)
+		reading_dt -= datetime.timedelta(days=reading_dt.weekday())
+	elif timespan == "Monthly":
+		reading_dt = datetime.datetime(reading_dt.year, reading_dt.month, 1)
+	elif timespan == "Yearly":
+		reading_dt = datetime.datetime(reading_dt.year, 1, 1)
 
 	return reading_dt
 
 
+def get_timespan_segments(from_date, to_date, timespan):
+	"""
+	Split the dates from from_date to to_date into (timespan, from_dt, to_dt) segments, using whole periods
+	of timespan where they fit and the finer timespan it is built from for the partial periods at either end
+	"""
+	from_dt = combine_datetime(getdate(from_date), datetime.time.min)
+	to_dt = combine_datetime(getdate(to_date), datetime.time.max)
+
+	if timespan in ("Hourly", "Daily"):
+		return [(timespan, from_dt, to_dt)]
+
+	source_timespan = ROLLUP_SOURCE_TIMESPAN[timespan]
+
+	# Start of the first and end of the last whole period
+	period_from_dt = truncate_reading_dt(from_dt, timespan)
+	if period_from_dt < from_dt:
+		period_from_dt = get_next_reading_dt(period_from_dt, timespan)
+
+	period_to_dt = get_next_reading_dt(truncate_reading_dt(to_dt, timespan), timespan) - datetime.datetime.resolution
+	if period_to_dt > to_dt:
+		period_to_dt = truncate_reading_dt(to_dt, timespan) - datetime.datetime.resolution
+
+	if period_from_dt > period_to_dt:
+		return get_timespan_segments(from_dt, to_dt, source_timespan)
+
+	segments = []
+	if from_dt < period_from_dt:
+		segments += get_timespan_segments(from_dt, period_from_dt - datetime.datetime.resolution, source_timespan)
+
+	# Periods are stamped at their start
+	segments.append((timespan, period_from_dt, truncate_reading_dt(period_to_dt, timespan)))
+
+	if period_to_dt < to_dt:
+		segments += get_timespan_segments(period_to_dt + datetime.datetime.resolution, to_dt, source_timespan)
+
+	return segments
+
+
 def validate_timespan(timespan):
-	if timespan not in ("Hourly", "Daily"):
-		frappe.throw(_("Timespan must be either Hourly or Daily"))
+	if timespan not in TIMESPANS:
+		frappe.throw(_("Timespan must be one of {0}").format(", ".join(TIMESPANS)))
@@ -1,9 +1,239 @@
 # Copyright (c) 2024, ParaLogic and Contributors
 # See license.txt
 
-# import frappe
+import frappe
 from frappe.tests.utils import FrappeTestCase
+from frappe.utils.nestedset import get_root_of
+from aqp.air_quality.aqi import aggregate_readings
+from aqp.air_quality.doctype.reading_aggregate.reading_aggregate import (
+	AGGREGATE_VALUE_FIELDS,
+	aggregate_for_regions,
+	aggregate_rollups,
+	get_hourly_aggregate_data_for_regions,
+	get_latest_hourly_aggregates,
+	get_reading_timerange,
+	set_aggregate_aqi,
+	truncate_reading_dt,
+	upsert_reading_aggregates,
+)
+from aqp.air_quality.doctype.reading_aggregate.aggregate_backfill import (
+	compute_window_aggregates,
+	get_backfill_region_index,
+)
+from aqp.air_quality.doctype.monitor_aggregate.monitor_aggregate import aggregate_monitors
+import datetime
+
+TEST_HOUR = datetime.datetime(2023, 3, 14, 10)
+
+
+def make_test_region(region_name, parent_monitor_region=None, is_group=0, disabled=0):
+	doc = frappe.get_doc({
+		"doctype": "Monitor Region",
+		"monitor_region_name": region_name,
+		"parent_monitor_region": parent_monitor_region or get_root_of("Monitor Region"),
+		"type": "City",
+		"is_group": is_group,
+		"disabled": disabled,
+	})
+	return doc.insert().name
+
+
+def make_test_monitor(monitor_name, monitor_region=None):
+	doc = frappe.get_doc({
+		"doctype": "Air Monitor",
+		"monitor_name": monitor_name,
+		"country": "Pakistan",
+		"city": "Lahore",
+		"latitude": 31.5,
+		"longitude": 74.3,
+		"monitor_region": monitor_region,
+	})
+	return doc.insert().name
+
+
+def make_test_reading(air_monitor, reading_dt, pm_2_5):
+	doc = frappe.get_doc({
+		"doctype": "Monitor Reading",
+		"air_monitor": air_monitor,
+		"reading_dt": reading_dt,
+		"pm_2_5": pm_2_5,
+	})
+	return doc.insert().name
+
+
+def make_test_region_tree():
+	"""
+	Country with an enabled and a disabled City, Air Monitors in each region and one without a region.
+	Readings of each Air Monitor fall into the Hourly aggregate at TEST_HOUR, except for one at the previous hour
+	"""
+	out = frappe._dict()
+	out.country = make_test_region("_Test Aggregate Country", is_group=1)
+	out.city = make_test_region("_Test Aggregate City", out.country)
+	out.disabled_city = make_test_region("_Test Aggregate Disabled City", out.country, disabled=1)
+	out.regions = [out.city, out.disabled_city, out.country]
+
+	out.city_monitor = make_test_monitor("_Test Aggregate City Monitor", out.city)
+	out.disabled_city_monitor = make_test_monitor("_Test Aggregate Disabled City Monitor", out.disabled_city)
+	out.country_monitor = make_test_monitor("_Test Aggregate Country Monitor", out.country)
+	out.no_region_monitor = make_test_monitor("_Test Aggregate No Region Monitor")
+	out.air_monitors = [out.city_monitor, out.disabled_city_monitor, out.country_monitor, out.no_region_monitor]
+
+	previous_hour = TEST_HOUR - datetime.timedelta(hours=1)
+	for i, air_monitor in enumerate(out.air_monitors):
+		# The reading at hh:00 belongs to the aggregate at hh:00
+		make_test_reading(air_monitor, previous_hour, 500)
+		make_test_reading(air_monitor, previous_hour + datetime.timedelta(minutes=20), 10 + i)
+		make_test_reading(air_monitor, previous_hour + datetime.timedelta(minutes=40), 20 + i)
+		make_test_reading(air_monitor, TEST_HOUR, 30 + i)
+
+	return out
+
+
+def make_test_aggregate(monitor_region, timespan, reading_dt, pm_2_5, pm_2_5_count):
+	agg = aggregate_readings([])
+	agg.update({
+		"monitor_region": monitor_region, "timespan": timespan, "reading_dt": reading_dt,
+		"pm_2_5": pm_2_5, "pm_2_5_sum": pm_2_5 * pm_2_5_count, "pm_2_5_count": pm_2_5_count,
+		"pm_2_5_max": pm_2_5 if pm_2_5_count else 0, "pm_2_5_min": pm_2_5 if pm_2_5_count else 0,
+	})
+	set_aggregate_aqi(agg)
+	return agg
+
+
+def get_stored_aggregate(doctype, filters):
+	values = frappe.db.get_value(doctype, filters, AGGREGATE_VALUE_FIELDS, as_dict=1)
+	return values or aggregate_readings([])
 
 
 class TestReadingAggregate(FrappeTestCase):
-	pass
+	@classmethod
+	def setUpClass(cls):
+		super().setUpClass()
+		cls.fixture = make_test_region_tree()
+
+		# Stored aggregates of the recursive per-region path that the other engines are compared with
+		aggregate_for_regions(TEST_HOUR, "Hourly", monitor_regions=cls.fixture.regions)
+		aggregate_monitors(TEST_HOUR, "Hourly", air_monitors=cls.fixture.air_monitors)
+
+	def assertAggregateEqual(self, actual, expected, msg=None):
+		for f in ("pm_2_5", "pm_2_5_sum", "pm_2_5_count", "pm_2_5_max", "pm_2_5_min"):
+			self.assertAlmostEqual(actual.get(f) or 0, expected.get(f) or 0, msg=f"{msg}: {f}")
+
+	def assertMatchesStoredHourlyAggregates(self, aggregate_data):
+		for monitor_region in self.fixture.regions:
+			expected = get_stored_aggregate("Reading Aggregate", {
+				"monitor_region": monitor_region, "timespan": "Hourly", "reading_dt": TEST_HOUR,
+			})
+			actual = aggregate_data.get((monitor_region, TEST_HOUR)) or aggregate_readings([])
+			self.assertAggregateEqual(actual, expected, monitor_region)
+
+	def test_backfill_matches_per_region_aggregation(self):
+		fixture = self.fixture
+		window_data = compute_window_aggregates(TEST_HOUR.date(), TEST_HOUR.date(), get_backfill_region_index())
+
+		self.assertMatchesStoredHourlyAggregates(window_data.hourly)
+
+		for air_monitor in fixture.air_monitors:
+			expected = get_stored_aggregate("Monitor Aggregate", {
+				"air_monitor": air_monitor, "timespan": "Hourly", "reading_dt": TEST_HOUR,
+			})
+			actual = window_data.monitor_hourly.get((air_monitor, TEST_HOUR)) or aggregate_readings([])
+			self.assertAggregateEqual(actual, expected, air_monitor)
+
+		# Readings of the disabled City are not accumulated into the Country
+		country = window_data.hourly[(fixture.country, TEST_HOUR)]
+		self.assertEqual(country.pm_2_5_count, 6)
+		self.assertEqual(country.pm_2_5_max, 32)
+
+		# Air Monitors without a region only get Monitor Aggregates
+		self.assertEqual(window_data.monitor_hourly[(fixture.no_region_monitor, TEST_HOUR)].pm_2_5_count, 3)
+
+	def test_set_based_matches_per_region_aggregation(self):
+		aggregate_data = get_hourly_aggregate_data_for_regions(TEST_HOUR)
+		self.assertMatchesStoredHourlyAggregates(aggregate_data)
+
+		# The reading exactly at the previous hour is not part of this hour
+		city = aggregate_data[(self.fixture.city, TEST_HOUR)]
+		self.assertEqual((city.pm_2_5_count, city.pm_2_5_min, city.pm_2_5_max), (3, 10, 30))
+
+	def test_rollup_boundaries(self):
+		# Sunday and Monday of a week, the last day of a leap February and the first day of March
+		daily_counts = {
+			datetime.datetime(2024, 2, 25): 1,
+			datetime.datetime(2024, 2, 26): 2,
+			datetime.datetime(2024, 2, 29): 4,
+			datetime.datetime(2024, 3, 1): 8,
+		}
+
+		upsert_reading_aggregates([
+			make_test_aggregate(self.fixture.city, "Daily", reading_dt, 10, count)
+			for reading_dt, count in daily_counts.items()
+		])
+		aggregate_rollups({reading_dt: {self.fixture.city} for reading_dt in daily_counts})
+
+		expected_counts = {
+			("Weekly", datetime.datetime(2024, 2, 19)): 1,
+			("Weekly", datetime.datetime(2024, 2, 26)): 2 + 4 + 8,
+			("Monthly", datetime.datetime(2024, 2, 1)): 1 + 2 + 4,
+			("Monthly", datetime.datetime(2024, 3, 1)): 8,
+			("Yearly", datetime.datetime(2024, 1, 1)): 1 + 2 + 4 + 8,
+		}
+		for (timespan, reading_dt), count in expected_counts.items():
+			self.assertEqual(frappe.db.get_value("Reading Aggregate", {
+				"monitor_region": self.fixture.city, "timespan": timespan, "reading_dt": reading_dt,
+			}, "pm_2_5_count"), count, f"{timespan} {reading_dt}")
+
+		# Periods are stamped at their start and end just before the next period, weeks start on Monday
+		self.assertEqual(truncate_reading_dt(datetime.datetime(2024, 3, 3, 23), "Weekly"), datetime.datetime(2024, 2, 26))
+		self.assertEqual(get_reading_timerange(datetime.datetime(2024, 2, 29, 12), "Monthly"),
+			(datetime.datetime(2024, 2, 1), datetime.datetime(2024, 3, 1) - datetime.datetime.resolution))
+		self.assertEqual(get_reading_timerange(datetime.datetime(2024, 3, 3), "Weekly"),
+			(datetime.datetime(2024, 2, 26), datetime.datetime(2024, 3, 4) - datetime.datetime.resolution))
+
+	def test_latest_hourly_aggregates(self):
+		monitor_region = make_test_region("_Test Latest Aggregate City")
+		hour = datetime.datetime(2023, 3, 20, 10)
+		next_hour = hour + datetime.timedelta(hours=1)
+		from_dt = hour - datetime.timedelta(hours=2)
+
+		upsert_reading_aggregates([
+			make_test_aggregate(monitor_region, "Hourly", hour, 10, 1),
+			make_test_aggregate(monitor_region, "Hourly", next_hour, 20, 1),
+		])
+
+		def get_latest(to_dt, materialized):
+			aggregates = get_latest_hourly_aggregates(from_dt, to_dt, materialized=materialized,
+				monitor_regions=[monitor_region])
+			return [(d.reading_dt, d.pm_2_5) for d in aggregates]
+
+		for materialized in (True, False):
+			# The partial aggregate of the current hour is not shown until the hour is complete
+			self.assertEqual(get_latest(hour + datetime.timedelta(minutes=30), materialized), [(hour, 10)])
+			self.assertEqual(get_latest(next_hour, materialized), [(next_hour, 20)])
+
+		# The latest aggregate becoming empty moves the region back to its previous aggregate
+		upsert_reading_aggregates([make_test_aggregate(monitor_region, "Hourly", next_hour, 0, 0)])
+		self.assertEqual(frappe.db.get_value("Monitor Region", monitor_region, "last_hourly_aggregate_dt"), hour)
+		self.assertEqual(get_latest(next_hour, True), [(hour, 10)])
+
+	def test_upsert_reading_aggregates(self):
+		monitor_region = make_test_region("_Test Upsert Aggregate City")
+		reading_dt = datetime.datetime(2023, 3, 21)
+
+		def get_aggregates():
+			return frappe.get_all("Reading Aggregate", filters={"monitor_region": monitor_region, "timespan": "Daily"},
+				fields=["name", "pm_2_5", "pm_2_5_count", "aqi_us"])
+
+		upsert_reading_aggregates([make_test_aggregate(monitor_region, "Daily", reading_dt, 10, 2)])
+		aggregates = get_aggregates()
+		self.assertEqual(len(aggregates), 1)
+
+		# Existing aggregates are left untouched unless update_existing is set
+		upsert_reading_aggregates([make_test_aggregate(monitor_region, "Daily", reading_dt, 20, 4)], update_existing=False)
+		self.assertEqual(get_aggregates(), aggregates)
+
+		upsert_reading_aggregates([make_test_aggregate(monitor_region, "Daily", reading_dt, 20, 4)])
+		updated = get_aggregates()
+		self.assertEqual(len(updated), 1)
+		self.assertEqual(updated[0].name, aggregates[0].name)
+		self.assertEqual((updated[0].pm_2_5, updated[0].pm_2_5_count), (20, 4))
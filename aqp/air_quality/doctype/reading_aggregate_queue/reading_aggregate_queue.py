@@ -0,0 +1,117 @@
+# Copyright (c) 2024, ParaLogic and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.utils import get_datetime, now_datetime
+from frappe.utils.nestedset import get_ancestors_of
+from frappe.model.document import Document
+from aqp.air_quality.utils import (
+	bulk_upsert,
+	get_next_sequence_values,
+	claim_queue_rows,
+	complete_queue_claim,
+	release_queue_claim,
+)
+from aqp.air_quality.doctype.monitor_region.region_tree import get_region_index
+from aqp.air_quality.doctype.monitor_aggregate_queue.monitor_aggregate_queue import queue_monitor_aggregation
+import datetime
+
+QUEUE_FIELDS = [
+	"name", "creation", "modified", "owner", "modified_by", "docstatus", "idx",
+	"monitor_region", "reading_dt", "claim_token", "claimed_at",
+]
+
+# Claims older than the job timeout belong to a job that was killed
+QUEUE_CLAIM_STALE_AFTER = 60 * 15
+
+
+class ReadingAggregateQueue(Document):
+	pass
+
+
+def on_doctype_update():
+	frappe.db.add_unique("Reading Aggregate Queue", ["monitor_region", "reading_dt"],
+		constraint_name="unique_monitor_region_reading_dt")
+	frappe.db.add_index("Reading Aggregate Queue", ["claim_token"])
+
+
+def queue_reading_aggregation(readings):
+	# readings: iterable of (air_monitor, reading_dt)
+	hours_by_monitor = {}
+	for air_monitor, reading_dt in readings:
+		if air_monitor and reading_dt:
+			hours_by_monitor.setdefault(air_monitor, set()).add(get_aggregate_hour(reading_dt))
+
+	if not hours_by_monitor:
+		return
+
+	monitor_regions = dict(frappe.get_all("Air Monitor", filters={
+		"name": ["in", list(hours_by_monitor)],
+	}, fields=["name", "monitor_region"], as_list=1))
+
+	region_hours = set()
+	monitor_hours = set()
+	for air_monitor, hours in hours_by_monitor.items():
+		monitor_hours.update((air_monitor, hour) for hour in hours)
+
+		monitor_region = monitor_regions.get(air_monitor)
+		if not monitor_region:
+			continue
+
+		for region in get_region_with_ancestors(monitor_region):
+			region_hours.update((region, hour) for hour in hours)
+
+	queue_region_aggregation(region_hours)
+	queue_monitor_aggregation(monitor_hours)
+
+
+def queue_region_aggregation(region_hours):
+	# region_hours: iterable of (monitor_region, hourly reading_dt)
+	region_hours = sorted(set(region_hours))
+	if not region_hours:
+		return
+
+	now = now_datetime()
+	user = frappe.session.user
+
+	names = get_next_sequence_values("Reading Aggregate Queue", len(region_hours))
+	values = [
+		(name, now, now, user, user, 0, 0, monitor_region, reading_dt, None, None)
+		for name, (monitor_region, reading_dt) in zip(names, region_hours)
+	]
+
+	# A row queued again while it is being recomputed has its claim reset, so that it is recomputed once more
+	bulk_upsert("Reading Aggregate Queue", QUEUE_FIELDS, values, update_fields=["claim_token", "claimed_at"])
+
+
+def claim_queued_aggregation(limit, claim_token):
+	return claim_queue_rows("Reading Aggregate Queue", ["name", "monitor_region", "reading_dt"], limit, claim_token,
+		QUEUE_CLAIM_STALE_AFTER)
+
+
+def complete_queued_aggregation(claim_token):
+	# Not committed, the claimed rows are removed in the same transaction as the recomputed aggregates
+	complete_queue_claim("Reading Aggregate Queue", claim_token)
+
+
+def release_queued_aggregation(claim_token):
+	release_queue_claim("Reading Aggregate Queue", claim_token)
+
+
+def get_region_with_ancestors(monitor_region):
+	ancestors = get_region_index().ancestors.get(monitor_region)
+	if ancestors is None:
+		# Region not in the cached index yet
+		ancestors = get_ancestors_of("Monitor Region", monitor_region)
+
+	return [monitor_region] + ancestors
+
+
+def get_aggregate_hour(reading_dt):
+	# The Hourly aggregate at hh:00 covers readings after (hh - 1):00 up to and including hh:00
+	reading_dt = get_datetime(reading_dt)
+	aggregate_hour = reading_dt.replace(minute=0, second=0, microsecond=0)
+	if aggregate_hour != reading_dt:
+		aggregate_hour += datetime.timedelta(hours=1)
+
+	return aggregate_hour
@@ -0,0 +1,71 @@
+# Copyright (c) 2024, ParaLogic and Contributors
+# See license.txt
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from unittest.mock import patch
+from aqp.air_quality.doctype.monitor_reading.reading_ingest import _insert_readings
+from aqp.air_quality.doctype.reading_aggregate.reading_aggregate import process_reading_aggregate_queue
+from aqp.air_quality.doctype.reading_aggregate_queue.reading_aggregate_queue import (
+	claim_queued_aggregation,
+	queue_region_aggregation,
+)
+from aqp.air_quality.doctype.reading_aggregate.test_reading_aggregate import make_test_region, make_test_monitor
+import datetime
+
+
+class TestReadingAggregateQueue(FrappeTestCase):
+	@classmethod
+	def setUpClass(cls):
+		super().setUpClass()
+		cls.monitor_region = make_test_region("_Test Queue City")
+		cls.air_monitor = make_test_monitor("_Test Queue Monitor", cls.monitor_region)
+
+	def get_queued_hours(self):
+		return (
+			set(frappe.get_all("Reading Aggregate Queue", filters={"monitor_region": self.monitor_region},
+				pluck="reading_dt")),
+			set(frappe.get_all("Monitor Aggregate Queue", filters={"air_monitor": self.air_monitor},
+				pluck="reading_dt")),
+		)
+
+	def test_reading_write_queues_and_consumes_hours(self):
+		hour = datetime.datetime(2023, 3, 14, 10)
+		next_hour = hour + datetime.timedelta(hours=1)
+
+		_insert_readings([
+			{"air_monitor": self.air_monitor, "reading_dt": hour, "pm_2_5": 20},
+			{"air_monitor": self.air_monitor, "reading_dt": hour + datetime.timedelta(minutes=5), "pm_2_5": 30},
+		])
+
+		# A reading at hh:00 belongs to the Hourly aggregate at hh:00, later readings to the next hour
+		self.assertEqual(self.get_queued_hours(), ({hour, next_hour}, {hour, next_hour}))
+
+		# The queue processing job commits each batch, the test keeps it in its own transaction
+		with patch.object(frappe.db, "commit"), patch.object(frappe.db, "rollback"):
+			process_reading_aggregate_queue()
+
+		self.assertEqual(self.get_queued_hours(), (set(), set()))
+
+		for reading_dt, pm_2_5 in ((hour, 20), (next_hour, 30)):
+			self.assertEqual(frappe.db.get_value("Reading Aggregate", {
+				"monitor_region": self.monitor_region, "timespan": "Hourly", "reading_dt": reading_dt,
+			}, "pm_2_5"), pm_2_5)
+			self.assertEqual(frappe.db.get_value("Monitor Aggregate", {
+				"air_monitor": self.air_monitor, "timespan": "Hourly", "reading_dt": reading_dt,
+			}, "pm_2_5"), pm_2_5)
+
+	def test_requeue_resets_claim(self):
+		reading_dt = datetime.datetime(2023, 3, 15, 10)
+		queue_region_aggregation([(self.monitor_region, reading_dt)])
+
+		with patch.object(frappe.db, "commit"):
+			claimed = claim_queued_aggregation(10000, "_test_claim")
+
+		self.assertIn((self.monitor_region, reading_dt), [(d.monitor_region, d.reading_dt) for d in claimed])
+
+		# Queued again while it is being recomputed, so a running job does not remove it when it completes
+		queue_region_aggregation([(self.monitor_region, reading_dt)])
+		self.assertIsNone(frappe.db.get_value("Reading Aggregate Queue", {
+			"monitor_region": self.monitor_region, "reading_dt": reading_dt,
+		}, "claim_token"))
@@ -5,6 +5,7 @@ frappe.ui.form.on('Reading Update Tool', {
 	refresh(frm) {
 		frm.disable_save();
 		frm.events.setup_progressbar(frm);
+		frm.events.setup_import_progressbar(frm);
 	},
 
 	update_reading_aggregates(frm) {
@@ -19,6 +20,18 @@ frappe.ui.form.on('Reading Update Tool', {
 		});
 	},
 
+	import_readings(frm) {
+		return frm.call({
+			method: "enqueue_import_readings",
+			doc: frm.doc,
+			callback() {
+				frm.dashboard.progress_area.body.empty();
+				frm.dashboard.progress_area.hide();
+				frm.dashboard._progress_map = {};
+			}
+		});
+	},
+
 	setup_progressbar(frm) {
 		frappe.realtime.on("aggregate_for_regions_timerange_progress", (progress_data) => {
 			if (progress_data) {
@@ -29,4 +42,23 @@ frappe.ui.form.on('Reading Update Tool', {
 			}
 		});
 	},
+
+	setup_import_progressbar(frm) {
+		frappe.realtime.on("import_readings_progress", (progress_data) => {
+			if (progress_data) {
+				frm.dashboard.show_progress(__("Importing Readings"),
+					cint(progress_data.total) ? cint(progress_data.progress) / cint(progress_data.total) * 100 : 0,
+					progress_data.message || ""
+				);
+
+				if (progress_data.errors && progress_data.errors.length) {
+					frappe.msgprint({
+						title: __("Rejected Readings"),
+						message: progress_data.errors.join("<br>"),
+						indicator: "orange",
+					});
+				}
+			}
+		});
+	},
 });
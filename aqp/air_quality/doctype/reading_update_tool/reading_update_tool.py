@@ -4,7 +4,19 @@
 import frappe
 from frappe import _
 from frappe.model.document import Document
+from frappe.utils import getdate, add_days, cint, cstr, date_diff
 from frappe.utils.background_jobs import get_jobs
+from aqp.air_quality.utils import increment_cache_counter
+from aqp.air_quality.doctype.monitor_reading.reading_archive import validate_not_archived
+import json
+import time
+
+AGGREGATION_RUN_EXPIRY = 60 * 60 * 24
+AGGREGATION_LOCKS_KEY = "reading_aggregation_locks"
+# A run that has not completed a day for longer than the job timeout is considered dead
+AGGREGATION_LOCK_STALE_AFTER = 60 * 60 * 6
+# Unfinished shards of a run that has not completed a day for this long are enqueued again
+AGGREGATION_RESUME_AFTER = 60 * 30
 
 
 class ReadingUpdateTool(Document):
@@ -13,29 +25,321 @@ class ReadingUpdateTool(Document):
 		self.check_permission("write")
 		self._validate_mandatory()
 
+		if not self.from_dt or not self.to_dt:
+			frappe.throw(_("From Time and To Time are required"))
+
+		update_hourly = not self.daily_only
+		if update_hourly:
+			validate_not_archived(add_days(getdate(self.from_dt), -1))
+
+		run_id = frappe.generate_hash(length=10)
+
+		# Days are independent of each other, so day-aligned shards can run on separate workers.
+		# A day never spans two shards, so its Daily aggregate runs right after its own Hourly aggregates.
+		shards = get_aggregation_shards(self.from_dt, self.to_dt, self.days_per_job)
+
+		overlapping_run = acquire_aggregation_lock(run_id, self.from_dt, self.to_dt, update_hourly, shards)
+		if overlapping_run:
+			if overlapping_run.covers:
+				frappe.msgprint(_("Aggregation from {0} to {1} is already in progress").format(
+					overlapping_run.from_date, overlapping_run.to_date
+				), alert=True)
+				return
+
+			frappe.throw(_("Aggregation from {0} to {1} is already in progress and overlaps the selected time range").format(
+				overlapping_run.from_date, overlapping_run.to_date
+			))
+
+		set_aggregation_run_total(run_id, date_diff(self.to_dt, self.from_dt) + 1)
+
+		for from_date, to_date in shards:
+			enqueue_aggregation_shard(run_id, from_date, to_date, update_hourly)
+
+		frappe.msgprint(_("Aggregation process enqueued in {0} jobs").format(len(shards)), alert=True)
+
+	@frappe.whitelist()
+	def enqueue_import_readings(self):
+		self.check_permission("write")
+		frappe.has_permission("Monitor Reading", "create", throw=True)
+
+		if not self.import_file:
+			frappe.throw(_("Please attach a file to import"))
+
+		file_doc = frappe.get_doc("File", {"file_url": self.import_file})
+		file_path = file_doc.get_full_path()
+
 		queued_jobs = get_jobs(site=frappe.local.site, queue="long")[frappe.local.site]
-		if aggregate_for_regions_timerange in queued_jobs:
-			frappe.throw(_("Aggregation process is already in queue"))
+		if import_readings in queued_jobs:
+			frappe.throw(_("Import process is already in queue"))
 
-		aggregate_for_regions_timerange.enqueue(
-			from_dt=self.from_dt,
-			to_dt=self.to_dt,
-			update_hourly=not self.daily_only,
+		import_readings.enqueue(
+			file_path=file_path,
 			queue="long",
 		)
 
-		frappe.msgprint(_("Aggregation process enqueued"), alert=True)
+		frappe.msgprint(_("Import process enqueued"), alert=True)
 
 
 @frappe.task(timeout=60 * 60 * 6)
-def aggregate_for_regions_timerange(from_dt, to_dt, update_hourly=True):
-	from aqp.air_quality.doctype.reading_aggregate.reading_aggregate import aggregate_for_regions_timerange
+def aggregate_for_regions_timerange(from_dt, to_dt, update_hourly=True, run_id=None):
+	from aqp.air_quality.doctype.reading_aggregate.reading_aggregate import (
+		aggregate_for_regions,
+		aggregate_rollups_for_timerange,
+	)
+	from aqp.air_quality.doctype.reading_aggregate.aggregate_backfill import backfill_reading_aggregates
+	from aqp.air_quality.doctype.monitor_aggregate.monitor_aggregate import aggregate_monitors
 
-	if update_hourly:
-		aggregate_for_regions_timerange(
-			from_dt, to_dt, "Hourly", update_existing=True, autocommit=True, publish_realtime=True
-		)
+	timespan = get_aggregation_timespan(update_hourly)
+	from_date = getdate(from_dt)
+	to_date = getdate(to_dt)
+
+	# Resume after the last completed day if a previous attempt of this shard was interrupted
+	checkpoint_key = get_aggregation_checkpoint_key(run_id, from_date, to_date, timespan)
+	checkpoint = get_aggregation_checkpoint(checkpoint_key)
+
+	reading_date = from_date
+	if checkpoint.last_completed_date:
+		reading_date = add_days(checkpoint.last_completed_date, 1)
+
+	while reading_date <= to_date:
+		if update_hourly:
+			backfill_reading_aggregates(reading_date, reading_date, update_existing=True, autocommit=True, rollups=False)
+		else:
+			aggregate_for_regions(reading_date, "Daily", update_existing=True, set_based=True)
+			aggregate_monitors(reading_date, "Daily", update_existing=True)
+
+		# Checkpoint is committed with the day's aggregates
+		save_aggregation_checkpoint(checkpoint_key, reading_date, timespan)
+		frappe.db.commit()
+
+		publish_aggregation_run_progress(run_id, reading_date, update_hourly)
 
-	aggregate_for_regions_timerange(
-		from_dt, to_dt, "Daily", update_existing=True, autocommit=True, publish_realtime=True
+		reading_date = add_days(reading_date, 1)
+
+	# Rollups of a run are computed once all of its shards are done, see publish_aggregation_run_progress.
+	# Checkpoints of a run are kept until then to tell finished shards from interrupted ones
+	if not run_id:
+		aggregate_rollups_for_timerange(from_date, to_date)
+		clear_aggregation_checkpoint(checkpoint_key)
+
+	frappe.db.commit()
+
+
+def enqueue_aggregation_shard(run_id, from_date, to_date, update_hourly):
+	# A shard that is still queued or running is not enqueued again
+	aggregate_for_regions_timerange.enqueue(
+		from_dt=from_date,
+		to_dt=to_date,
+		update_hourly=update_hourly,
+		run_id=run_id,
+		queue="long",
+		job_id=f"reading_aggregation|{run_id}|{from_date}|{to_date}",
+		deduplicate=True,
 	)
+
+
+def get_aggregation_shards(from_dt, to_dt, days_per_job):
+	days_per_job = max(cint(days_per_job), 1)
+
+	from_date = getdate(from_dt)
+	to_date = getdate(to_dt)
+
+	shards = []
+	while from_date <= to_date:
+		shard_to_date = min(add_days(from_date, days_per_job - 1), to_date)
+		shards.append((from_date, shard_to_date))
+		from_date = add_days(shard_to_date, 1)
+
+	return shards
+
+
+def set_aggregation_run_total(run_id, total):
+	frappe.cache().set_value(f"reading_aggregation_run_total|{run_id}", total, expires_in_sec=AGGREGATION_RUN_EXPIRY)
+
+
+def publish_aggregation_run_progress(run_id, reading_date, update_hourly):
+	from aqp.air_quality.doctype.reading_aggregate.reading_aggregate import publish_aggregation_progress
+
+	if not run_id:
+		return
+
+	# Progress of all shards of a run is combined into a single counter of completed days
+	total = cint(frappe.cache().get_value(f"reading_aggregation_run_total|{run_id}"))
+	progress = increment_cache_counter(f"reading_aggregation_run_progress|{run_id}",
+		expires_in_sec=AGGREGATION_RUN_EXPIRY)
+
+	if progress >= total:
+		finish_aggregation_run(run_id)
+	else:
+		refresh_aggregation_lock(run_id)
+
+	publish_aggregation_progress(min(progress, total), total, get_aggregation_timespan(update_hourly), reading_date)
+
+
+def finish_aggregation_run(run_id):
+	# Shards may split a week or month, so Weekly, Monthly and Yearly aggregates wait for the last day of the run
+	enqueue_aggregation_run_rollups(run_id)
+	clear_aggregation_run_checkpoints(run_id)
+	release_aggregation_lock(run_id)
+	frappe.db.commit()
+
+
+def enqueue_aggregation_run_rollups(run_id):
+	lock = get_aggregation_lock(run_id)
+	if not lock:
+		return
+
+	frappe.enqueue("aqp.air_quality.doctype.reading_aggregate.reading_aggregate.aggregate_rollups_for_timerange",
+		queue="long", from_dt=lock["from_date"], to_dt=lock["to_date"])
+
+
+def resume_aggregation_runs():
+	"""
+	Enqueue the unfinished shards of runs that have not completed a day for a while again,
+	e.g. after a worker was restarted. Shards that are still queued or running are skipped.
+	Scheduled, can also be run with bench execute
+	"""
+	cache = frappe.cache()
+	locks_key = cache.make_key(AGGREGATION_LOCKS_KEY)
+
+	now = time.time()
+	for run_id, lock in get_live_aggregation_locks(cache, locks_key).items():
+		if now - lock.heartbeat < AGGREGATION_RESUME_AFTER or not lock.shards:
+			continue
+
+		timespan = get_aggregation_timespan(lock.update_hourly)
+
+		unfinished_shards = []
+		for from_date, to_date in lock.shards:
+			from_date = getdate(from_date)
+			to_date = getdate(to_date)
+
+			checkpoint = get_aggregation_checkpoint(get_aggregation_checkpoint_key(run_id, from_date, to_date, timespan))
+			last_completed_date = getdate(checkpoint.last_completed_date) if checkpoint.last_completed_date else None
+			if not last_completed_date or last_completed_date < to_date:
+				unfinished_shards.append((from_date, to_date))
+
+		# All days were completed but a shard was interrupted before the run was finished
+		if not unfinished_shards:
+			finish_aggregation_run(run_id)
+			continue
+
+		for from_date, to_date in unfinished_shards:
+			enqueue_aggregation_shard(run_id, from_date, to_date, lock.update_hourly)
+
+
+def get_aggregation_timespan(update_hourly):
+	return "Hourly and Daily" if update_hourly else "Daily"
+
+
+def acquire_aggregation_lock(run_id, from_dt, to_dt, update_hourly, shards=None):
+	"""
+	Register the date range and shards of a new run unless it overlaps a live run.
+	Returns the overlapping run, with covers set if it already includes the whole requested range
+	"""
+	from_date = getdate(from_dt)
+	to_date = getdate(to_dt)
+	timespan = get_aggregation_timespan(update_hourly)
+
+	cache = frappe.cache()
+	locks_key = cache.make_key(AGGREGATION_LOCKS_KEY)
+
+	# Serialize the check and set so that two requests cannot both see a free range
+	with cache.lock(f"{locks_key}|mutex", timeout=10, blocking_timeout=10):
+		now = time.time()
+		for lock in get_live_aggregation_locks(cache, locks_key).values():
+			lock.from_date = getdate(lock.from_date)
+			lock.to_date = getdate(lock.to_date)
+			if lock.from_date <= to_date and from_date <= lock.to_date:
+				# A Daily only request is covered by a run that also computes Daily aggregates
+				lock.covers = (lock.from_date <= from_date and to_date <= lock.to_date
+					and (lock.timespan == timespan or not update_hourly))
+				return lock
+
+		cache.hset(locks_key, run_id, json.dumps({
+			"from_date": cstr(from_date),
+			"to_date": cstr(to_date),
+			"timespan": timespan,
+			"update_hourly": cint(update_hourly),
+			"shards": [[cstr(shard_from_date), cstr(shard_to_date)] for shard_from_date, shard_to_date in shards or []],
+			"heartbeat": now,
+		}))
+
+
+def get_live_aggregation_locks(cache, locks_key):
+	# Runs without a completed day for longer than the job timeout are dropped together with their checkpoints
+	locks = {}
+	now = time.time()
+	for run_id, value in (cache.hgetall(locks_key) or {}).items():
+		run_id = frappe.safe_decode(run_id)
+		lock = frappe._dict(json.loads(value))
+		if now - lock.heartbeat > AGGREGATION_LOCK_STALE_AFTER:
+			cache.hdel(locks_key, run_id)
+			clear_aggregation_run_checkpoints(run_id, lock)
+			continue
+
+		locks[run_id] = lock
+
+	return locks
+
+
+def get_aggregation_lock(run_id):
+	cache = frappe.cache()
+	value = cache.hget(cache.make_key(AGGREGATION_LOCKS_KEY), run_id)
+	return frappe._dict(json.loads(value)) if value else None
+
+
+def refresh_aggregation_lock(run_id):
+	cache = frappe.cache()
+	locks_key = cache.make_key(AGGREGATION_LOCKS_KEY)
+
+	value = cache.hget(locks_key, run_id)
+	if value:
+		lock = json.loads(value)
+		lock["heartbeat"] = time.time()
+		cache.hset(locks_key, run_id, json.dumps(lock))
+
+
+def release_aggregation_lock(run_id):
+	cache = frappe.cache()
+	cache.hdel(cache.make_key(AGGREGATION_LOCKS_KEY), run_id)
+
+
+def get_aggregation_checkpoint_key(run_id, from_date, to_date, timespan):
+	# Checkpoints belong to a run, so that a later run over the same range starts from its first day
+	return f"reading_aggregation_checkpoint:{cstr(run_id)}:{frappe.scrub(timespan)}:{from_date}:{to_date}"
+
+
+def get_aggregation_checkpoint(checkpoint_key):
+	checkpoint = frappe.parse_json(frappe.db.get_global(checkpoint_key) or "{}")
+	checkpoint.setdefault("last_completed_date", None)
+	checkpoint.setdefault("timespan", None)
+	return checkpoint
+
+
+def save_aggregation_checkpoint(checkpoint_key, last_completed_date, timespan):
+	frappe.db.set_global(checkpoint_key, json.dumps({
+		"last_completed_date": cstr(last_completed_date),
+		"timespan": timespan,
+	}))
+
+
+def clear_aggregation_checkpoint(checkpoint_key):
+	frappe.defaults.clear_default(key=checkpoint_key, parent="__global")
+
+
+def clear_aggregation_run_checkpoints(run_id, lock=None):
+	lock = lock or get_aggregation_lock(run_id)
+	if not lock:
+		return
+
+	timespan = get_aggregation_timespan(lock.update_hourly)
+	for from_date, to_date in lock.shards or []:
+		clear_aggregation_checkpoint(get_aggregation_checkpoint_key(run_id, from_date, to_date, timespan))
+
+
+@frappe.task(timeout=60 * 60 * 6)
+def import_readings(file_path):
+	from aqp.air_quality.doctype.monitor_reading.reading_import import import_readings
+
+	import_readings(file_path, publish_realtime=True)
@@ -3,13 +3,53 @@
 
 import frappe
 from frappe import _, scrub
-from frappe.utils import getdate, flt, cint, add_to_date, add_days, combine_datetime
-from aqp.air_quality.aqi import calculate_aqi, round_pollutant
+from frappe.utils import getdate, flt, cint, cstr, add_to_date, add_days, combine_datetime, get_first_day
+from aqp.air_quality.aqi import calculate_aqi_batch, round_pollutant
+from aqp.air_quality.utils import get_report_data_version
+from aqp.air_quality.doctype.reading_aggregate.reading_aggregate import get_timespan_segments
 import datetime
+import hashlib
+import json
+
+# Coarsest Reading Aggregate timespan whose periods fall entirely within a single period of the range
+RANGE_TIMESPAN = {
+	"Daily": "Daily",
+	"Weekly": "Weekly",
+	"Monthly": "Monthly",
+	"Quarterly": "Monthly",
+	"Yearly": "Yearly",
+}
+
+
+CACHE_FILTERS = ["tree_type", "value_field", "from_date", "to_date", "range", "monitor_region"]
+CACHE_DATE_FILTERS = ["from_date", "to_date"]
+CACHE_EXPIRY = 60 * 60
+# Results only including months before the current month rarely change, they are kept longer
+CLOSED_PERIOD_CACHE_EXPIRY = 60 * 60 * 24 * 7
 
 
 def execute(filters=None):
-	return AirQualityAnalytics(filters).run()
+	filters = frappe._dict(filters or {})
+
+	# Results are cached per data version of the months in range, any aggregate change in them gives a new key
+	cache_key = get_cache_key(filters)
+	result = frappe.cache().get_value(cache_key)
+	if result is None:
+		result = AirQualityAnalytics(filters).run()
+
+		closed = getdate(filters.to_date) < get_first_day(getdate())
+		frappe.cache().set_value(cache_key, result,
+			expires_in_sec=CLOSED_PERIOD_CACHE_EXPIRY if closed else CACHE_EXPIRY)
+
+	return result
+
+
+def get_cache_key(filters):
+	normalized = {f: cstr(getdate(filters.get(f)) if f in CACHE_DATE_FILTERS else filters.get(f)) for f in CACHE_FILTERS}
+	normalized["lang"] = frappe.local.lang
+	normalized["version"] = get_report_data_version(filters.from_date, filters.to_date)
+
+	return "air_quality_analytics|" + hashlib.sha1(json.dumps(normalized, sort_keys=True).encode()).hexdigest()
 
 
 class AirQualityAnalytics(object):
@@ -54,8 +94,7 @@ class AirQualityAnalytics(object):
 			"width": 80
 		})
 
-		for end_date in self.periodic_daterange:
-			period = self.get_period(end_date)
+		for period in self.periods:
 			self.columns.append({
 				"label": _(period),
 				"fieldname": scrub(period),
@@ -74,43 +113,74 @@ class AirQualityAnalytics(object):
 			self.get_regions()
 			self.get_rows_by_region()
 
+		if self.filters.value_field == "AQI (US)":
+			self.convert_values_to_aqi()
+
+	def convert_values_to_aqi(self):
+		value_fields = ["average"] + [scrub(period) for period in self.periods]
+
+		# Convert all cells in a single batch
+		values = [row.get(f) for row in self.data for f in value_fields]
+		aqi_values = iter(calculate_aqi_batch("PM2.5", values))
+
+		for row in self.data:
+			for f in value_fields:
+				row[f] = next(aqi_values)
+
 	def get_entries(self, entity_field, entity_name_field=None):
 		filter_conditions = self.get_conditions()
 
-		entity_name_field = "{0} as entity_name, ".format(entity_name_field) if entity_name_field else ""
+		entity_name_field = "max({0}) as entity_name, ".format(entity_name_field) if entity_name_field else ""
 
 		air_monitor_join = ""
-		if self.filters.doctype == "Monitor Reading" and self.filters.monitor_region:
+		if self.filters.doctype == "Monitor Aggregate" and self.filters.monitor_region:
 			air_monitor_join = "left join `tabAir Monitor` m on m.name = r.air_monitor"
 
-		sum_field = "pm_2_5_sum" if self.filters.doctype == "Reading Aggregate" else "pm_2_5"
-		count_field = "pm_2_5_count" if self.filters.doctype == "Reading Aggregate" else "1"
+		# Weekly aggregates are stamped on Monday, but week columns are labelled by their last day
+		date_field = "DATE(r.reading_dt)"
+		if self.filters.doctype == "Reading Aggregate":
+			date_field = "if(r.timespan = 'Weekly', DATE(r.reading_dt) + interval 6 day, DATE(r.reading_dt))"
 
+		# One row per entity and period, any date of the period gives the same get_period
 		self.entries = frappe.db.sql("""
 			select
 				{entity_field} as entity,
 				{entity_name_field}
-				DATE(r.reading_dt) as date,
-				{sum_field} as sum,
-				{count_field} as count
+				min({date_field}) as date,
+				sum(r.pm_2_5_sum) as sum,
+				sum(r.pm_2_5_count) as count
 			from `tab{doctype}` r
 			{air_monitor_join}
 			where r.reading_dt between %(from_dt)s and %(to_dt)s
 				{filter_conditions}
+			group by {entity_field}, {period_field}
 		""".format(
 			doctype=self.filters.doctype,
 			entity_field=entity_field,
 			entity_name_field=entity_name_field,
 			filter_conditions=filter_conditions,
 			air_monitor_join=air_monitor_join,
-			sum_field=sum_field,
-			count_field=count_field,
+			date_field=date_field,
+			period_field=self.get_period_field(date_field),
 		), self.filters, as_dict=1)
 
 		if entity_name_field:
 			for d in self.entries:
 				self.entity_names.setdefault(d.entity, d.entity_name)
 
+	def get_period_field(self, date_field):
+		# SQL equivalent of get_period, WEEK mode 5 numbers Monday weeks from 0 like %W
+		if self.filters.range == 'Daily':
+			return date_field
+		elif self.filters.range == 'Weekly':
+			return "year({0}), week({0}, 5)".format(date_field)
+		elif self.filters.range == 'Monthly':
+			return "year({0}), month({0})".format(date_field)
+		elif self.filters.range == 'Quarterly':
+			return "year({0}), quarter({0})".format(date_field)
+		else:
+			return "year({0})".format(date_field)
+
 	def get_value_fieldtype(self):
 		filter_to_field = {
 			"PM2.5": "Float",
@@ -122,11 +192,14 @@ class AirQualityAnalytics(object):
 		conditions = []
 
 		self.filters.from_dt = combine_datetime(self.filters.from_date, datetime.time.min)
-		self.filters.to_dt = combine_datetime(self.filters.to_dt, datetime.time.max)
+		self.filters.to_dt = combine_datetime(self.filters.to_date, datetime.time.max)
 
-		self.filters.doctype = "Monitor Reading" if self.filters.tree_type == "Air Monitor" else "Reading Aggregate"
-		if self.filters.doctype == "Reading Aggregate":
+		if self.filters.tree_type == "Air Monitor":
+			self.filters.doctype = "Monitor Aggregate"
 			conditions.append("r.timespan = 'Daily'")
+		else:
+			self.filters.doctype = "Reading Aggregate"
+			conditions.append(self.get_timespan_condition())
 
 		if self.filters.monitor_region:
 			self.filters.monitor_regions = frappe.get_all("Monitor Region", filters={
@@ -142,6 +215,22 @@ class AirQualityAnalytics(object):
 
 		return "and {}".format(" and ".join(conditions)) if conditions else ""
 
+	def get_timespan_condition(self):
+		# Whole periods are read from rollup aggregates, partial periods at either end from Daily aggregates
+		timespan = RANGE_TIMESPAN.get(self.filters.range, "Daily")
+		segments = get_timespan_segments(self.filters.from_date, self.filters.to_date, timespan)
+
+		segment_conditions = []
+		for i, (segment_timespan, from_dt, to_dt) in enumerate(segments):
+			self.filters[f"segment_{i}_timespan"] = segment_timespan
+			self.filters[f"segment_{i}_from_dt"] = from_dt
+			self.filters[f"segment_{i}_to_dt"] = to_dt
+
+			segment_conditions.append(f"(r.timespan = %(segment_{i}_timespan)s"
+				f" and r.reading_dt between %(segment_{i}_from_dt)s and %(segment_{i}_to_dt)s)")
+
+		return "({0})".format(" or ".join(segment_conditions))
+
 	def get_rows_by_monitors(self):
 		self.data = []
 		self.get_periodic_data()
@@ -158,15 +247,11 @@ class AirQualityAnalytics(object):
 				"count": 0,
 			})
 
-			for end_date in self.periodic_daterange:
-				period = self.get_period(end_date)
-
+			for period in self.periods:
 				amount = flt(period_data.get(period, {}).get("sum"))
 				count = cint(period_data.get(period, {}).get("count"))
 
 				row[scrub(period)] = round_pollutant("PM2.5", amount / count) if count else 0
-				if self.filters.value_field == "AQI (US)":
-					row[scrub(period)] = calculate_aqi("PM2.5", row[scrub(period)])
 
 				# Accumulate for entity row
 				row.sum += amount
@@ -185,26 +270,18 @@ class AirQualityAnalytics(object):
 
 			# Entity average
 			row["average"] = round_pollutant("PM2.5", row.sum / row.count) if row.count else 0
-			if self.filters.value_field == "AQI (US)":
-				row["average"] = calculate_aqi("PM2.5", row["average"])
 
 			self.data.append(row)
 
 		# Total row averages
 		total_row["average"] = round_pollutant("PM2.5", total_row["sum"] / total_row["count"]) \
 			if total_row["count"] else 0
-		if self.filters.value_field == "AQI (US)":
-			total_row["average"] = calculate_aqi("PM2.5", total_row["average"])
-
-		for end_date in self.periodic_daterange:
-			period = self.get_period(end_date)
 
+		for period in self.periods:
 			amount = flt(total_row.get(scrub(period) + "_sum"))
 			count = cint(total_row.get(scrub(period) + "_count"))
 
 			total_row[scrub(period)] = round_pollutant("PM2.5", amount / count) if count else 0
-			if self.filters.value_field == "AQI (US)":
-				total_row[scrub(period)] = calculate_aqi("PM2.5", total_row[scrub(period)])
 
 	def get_regions(self):
 		self.depth_map = frappe._dict()
@@ -232,15 +309,11 @@ class AirQualityAnalytics(object):
 				"count": 0,
 			})
 
-			for end_date in self.periodic_daterange:
-				period = self.get_period(end_date)
-
+			for period in self.periods:
 				amount = flt(self.entity_periodic_data.get(d.name, {}).get(period, frappe._dict()).get("sum"))
 				count = cint(self.entity_periodic_data.get(d.name, {}).get(period, frappe._dict()).get("count"))
 
 				row[scrub(period)] = round_pollutant("PM2.5", amount / count) if count else 0
-				if self.filters.value_field == "AQI (US)":
-					row[scrub(period)] = calculate_aqi("PM2.5", row[scrub(period)])
 
 				# Accumulate for entity row
 				row.sum += amount
@@ -248,8 +321,6 @@ class AirQualityAnalytics(object):
 
 			# Entity average
 			row["average"] = round_pollutant("PM2.5", row.sum / row.count) if row.count else 0
-			if self.filters.value_field == "AQI (US)":
-				row["average"] = calculate_aqi("PM2.5", row["average"])
 
 			out = [row] + out
 
@@ -265,8 +336,8 @@ class AirQualityAnalytics(object):
 			}))
 
 			if d.sum:
-				self.entity_periodic_data[d.entity][period]["sum"] += d.sum
-				self.entity_periodic_data[d.entity][period]["count"] += d.count
+				self.entity_periodic_data[d.entity][period]["sum"] += flt(d.sum)
+				self.entity_periodic_data[d.entity][period]["count"] += cint(d.count)
 
 	def get_period(self, posting_date):
 		if self.filters.range == 'Daily':
@@ -317,6 +388,9 @@ class AirQualityAnalytics(object):
 			if period_end_date >= to_date:
 				break
 
+		# Period labels are computed once instead of for every row and cell
+		self.periods = [self.get_period(end_date) for end_date in self.periodic_daterange]
+
 	def get_chart_data(self):
 		labels = [d.get("label") for d in self.columns if d.get("period_column")]
 		self.chart = {
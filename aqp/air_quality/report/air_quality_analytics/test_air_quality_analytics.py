@@ -0,0 +1,90 @@
+# Copyright (c) 2024, ParaLogic and Contributors
+# See license.txt
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from aqp.air_quality.aqi import aggregate_readings
+from aqp.air_quality.doctype.reading_aggregate.reading_aggregate import (
+	aggregate_rollups,
+	set_aggregate_aqi,
+	upsert_reading_aggregates,
+)
+from aqp.air_quality.doctype.reading_aggregate.test_reading_aggregate import make_test_region
+from aqp.air_quality.report.air_quality_analytics.air_quality_analytics import AirQualityAnalytics
+import datetime
+
+# Crosses a year boundary and a week numbered 0 by %W, 2023-01-01 is a Sunday
+FROM_DATE = datetime.date(2022, 12, 20)
+TO_DATE = datetime.date(2023, 1, 10)
+
+
+def get_python_grouped_data(report):
+	# Previous implementation: every aggregate row is read and grouped into periods by get_period
+	conditions = report.get_conditions()
+	entries = frappe.db.sql("""
+		select r.monitor_region as entity,
+			if(r.timespan = 'Weekly', DATE(r.reading_dt) + interval 6 day, DATE(r.reading_dt)) as date,
+			r.pm_2_5_sum as sum,
+			r.pm_2_5_count as count
+		from `tabReading Aggregate` r
+		where r.reading_dt between %(from_dt)s and %(to_dt)s
+			{0}
+	""".format(conditions), report.filters, as_dict=1)
+
+	data = {}
+	for d in entries:
+		period_data = data.setdefault(d.entity, {}).setdefault(report.get_period(d.date), {"sum": 0, "count": 0})
+		if d.sum:
+			period_data["sum"] += d.sum
+			period_data["count"] += d.count
+
+	return data
+
+
+class TestAirQualityAnalytics(FrappeTestCase):
+	@classmethod
+	def setUpClass(cls):
+		super().setUpClass()
+		cls.monitor_region = make_test_region("_Test Analytics City")
+
+		rows = []
+		reading_date = FROM_DATE
+		while reading_date <= TO_DATE:
+			i = (reading_date - FROM_DATE).days
+
+			agg = aggregate_readings([])
+			agg.update({
+				"monitor_region": cls.monitor_region, "timespan": "Daily",
+				"reading_dt": datetime.datetime.combine(reading_date, datetime.time.min),
+				"pm_2_5_sum": (10 + i) * (i + 1), "pm_2_5_count": i + 1,
+				"pm_2_5": 10 + i, "pm_2_5_max": 10 + i, "pm_2_5_min": 10 + i,
+			})
+			set_aggregate_aqi(agg)
+			rows.append(agg)
+
+			reading_date += datetime.timedelta(days=1)
+
+		upsert_reading_aggregates(rows)
+		aggregate_rollups({d.reading_dt: {cls.monitor_region} for d in rows})
+
+	def test_grouping_matches_python_grouping(self):
+		for period_range in ("Daily", "Weekly", "Monthly", "Quarterly", "Yearly"):
+			report = AirQualityAnalytics({
+				"tree_type": "Monitor Region",
+				"value_field": "PM2.5",
+				"from_date": FROM_DATE,
+				"to_date": TO_DATE,
+				"range": period_range,
+				"monitor_region": self.monitor_region,
+			})
+			report.run()
+
+			expected = get_python_grouped_data(report)
+			actual = {
+				entity: {period: {"sum": d.sum, "count": d.count} for period, d in period_data.items()}
+				for entity, period_data in report.entity_periodic_data.items()
+			}
+			self.assertEqual(actual, expected, period_range)
+
+			# Every period with data is one of the report's columns
+			self.assertTrue(set(actual[self.monitor_region]).issubset(report.periods), period_range)
@@ -0,0 +1,59 @@
+# Copyright (c) 2024, ParaLogic and Contributors
+# See license.txt
+
+import numpy as np
+from frappe.tests.utils import FrappeTestCase
+from aqp.air_quality.aqi import (
+	POLLUTANT_TO_AQI_POLLUTANT,
+	POLLUTANT_PRECISION,
+	POLLUTANT_MAX_RANGE,
+	calculate_aqi,
+	calculate_aqi_batch,
+	round_pollutant,
+	_calculate_aqi,
+)
+
+
+def calculate_aqi_without_lookup(pollutant_type, pollutant_value):
+	pollutant_value = round_pollutant(pollutant_type, pollutant_value)
+
+	max_limit, limit_aqi = POLLUTANT_MAX_RANGE[pollutant_type]
+	if pollutant_value >= max_limit:
+		return limit_aqi
+
+	return _calculate_aqi(pollutant_type, pollutant_value)
+
+
+class TestAQI(FrappeTestCase):
+	def get_test_values(self, pollutant_type):
+		scale = 10 ** POLLUTANT_PRECISION[pollutant_type]
+		max_limit = POLLUTANT_MAX_RANGE[pollutant_type][0]
+		max_step = int(max_limit * scale) + 10
+
+		rng = np.random.default_rng(0)
+
+		values = [step / scale for step in range(max_step)]
+		values += [step / scale - 1e-9 for step in range(1, max_step)]
+		values += list(rng.uniform(0, max_limit * 1.1, 5000))
+		values += list(np.round(rng.uniform(0, max_limit, 5000), POLLUTANT_PRECISION[pollutant_type] + 1))
+		return values
+
+	def test_lookup_matches_python_aqi(self):
+		for pollutant_type in POLLUTANT_TO_AQI_POLLUTANT:
+			for value in self.get_test_values(pollutant_type):
+				self.assertEqual(calculate_aqi(pollutant_type, value),
+					calculate_aqi_without_lookup(pollutant_type, value),
+					msg=f"{pollutant_type} {value!r}")
+
+	def test_batch_matches_python_aqi(self):
+		for pollutant_type in POLLUTANT_TO_AQI_POLLUTANT:
+			values = self.get_test_values(pollutant_type)
+			expected = [calculate_aqi_without_lookup(pollutant_type, value) for value in values]
+
+			self.assertEqual(calculate_aqi_batch(pollutant_type, values), expected, msg=pollutant_type)
+			self.assertEqual(calculate_aqi_batch(pollutant_type, np.array(values)).tolist(), expected, msg=pollutant_type)
+
+	def test_batch_empty_and_missing_values(self):
+		self.assertEqual(calculate_aqi_batch("PM2.5", []), [])
+		self.assertEqual(calculate_aqi_batch("PM2.5", [None, 0]), [0, 0])
+		self.assertEqual(calculate_aqi_batch("PM2.5", [600, 500.5]), [500, 500])
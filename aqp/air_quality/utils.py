@@ -1,6 +1,15 @@
 import frappe
-from frappe import _
-from frappe.utils import cstr
+from frappe import _, scrub
+from frappe.utils import cstr, cint, getdate, add_months, now_datetime
+import datetime
+
+# Changes whenever data returned by get_latest_readings may have changed
+LATEST_READINGS_VERSION_KEY = "latest_readings_version"
+# Set by frequent writes of readings and aggregates, the version is advanced once per minute if set
+LATEST_READINGS_CHANGED_KEY = "latest_readings_changed"
+
+# Changes whenever Air Monitors or Monitor Regions change, with a separate counter per month for aggregate changes
+REPORT_DATA_VERSION_KEY = "report_data_version"
 
 
 def get_order_by(doctype, sort_by, sort_order, fields=None):
@@ -24,3 +33,199 @@ def get_order_by(doctype, sort_by, sort_order, fields=None):
 		), exc=frappe.db.InvalidColumnName)
 
 	return f"{sort_by} {sort_order}"
+
+
+def get_next_sequence_values(doctype, count):
+	"""Reserve names for an autoincrement doctype in a single query"""
+	count = cint(count)
+	if count <= 0:
+		return []
+
+	sequence_name = scrub(doctype + "_id_seq")
+	return [cint(d[0]) for d in frappe.db.sql(f"""
+		select nextval(`{sequence_name}`)
+		from seq_1_to_{count}
+	""")]
+
+
+def push_to_buffer(key, values):
+	if not values:
+		return
+
+	cache = frappe.cache()
+	with cache.pipeline() as pipe:
+		pipe.rpush(cache.make_key(key), *values)
+		pipe.execute()
+
+
+def pop_buffer(key):
+	cache = frappe.cache()
+	redis_key = cache.make_key(key)
+
+	with cache.pipeline() as pipe:
+		pipe.lrange(redis_key, 0, -1)
+		pipe.delete(redis_key)
+		values, _deleted = pipe.execute()
+
+	return [frappe.safe_decode(v) for v in values]
+
+
+def claim_queue_rows(doctype, fields, limit, claim_token, stale_after):
+	"""
+	Mark up to limit unclaimed rows of a queue doctype, or rows claimed longer than stale_after seconds ago,
+	with claim_token and commit. Claimed rows are only removed by complete_queue_claim
+	once the work is done, so rows of a killed job are claimed again after stale_after
+	"""
+	stale_before = now_datetime() - datetime.timedelta(seconds=stale_after)
+
+	queued = frappe.db.sql(f"""
+		select {", ".join(f"`{f}`" for f in fields)}
+		from `tab{doctype}`
+		where claim_token is null or claimed_at < %(stale_before)s
+		order by reading_dt
+		limit %(limit)s
+		for update skip locked
+	""", {"stale_before": stale_before, "limit": limit}, as_dict=1)
+
+	if queued:
+		frappe.db.sql(f"""
+			update `tab{doctype}`
+			set claim_token = %(claim_token)s, claimed_at = %(now)s
+			where name in %(names)s
+		""", {"claim_token": claim_token, "now": now_datetime(), "names": [d.name for d in queued]})
+
+	frappe.db.commit()
+	return queued
+
+
+def complete_queue_claim(doctype, claim_token):
+	# Rows queued again while claimed have their claim reset and are kept
+	frappe.db.sql(f"""
+		delete from `tab{doctype}`
+		where claim_token = %s
+	""", claim_token)
+
+
+def release_queue_claim(doctype, claim_token):
+	frappe.db.sql(f"""
+		update `tab{doctype}`
+		set claim_token = null, claimed_at = null
+		where claim_token = %s
+	""", claim_token)
+
+
+def bulk_upsert(doctype, fields, values, update_fields=None, ignore_duplicates=False, chunk_size=1000):
+	"""Multi-row INSERT that either updates or ignores rows violating a unique key"""
+	if not values:
+		return
+
+	columns = ", ".join(f"`{f}`" for f in fields)
+	row_placeholder = "({0})".format(", ".join(["%s"] * len(fields)))
+
+	insert = "insert ignore" if ignore_duplicates and not update_fields else "insert"
+
+	on_duplicate = ""
+	if update_fields:
+		on_duplicate = "on duplicate key update {0}".format(
+			", ".join(f"`{f}` = values(`{f}`)" for f in update_fields)
+		)
+
+	for i in range(0, len(values), chunk_size):
+		chunk = values[i:i + chunk_size]
+		frappe.db.sql(f"""
+			{insert} into `tab{doctype}` ({columns})
+			values {", ".join([row_placeholder] * len(chunk))}
+			{on_duplicate}
+		""", [v for row in chunk for v in row])
+
+
+def increment_cache_counter(key, amount=1, expires_in_sec=None):
+	cache = frappe.cache()
+	redis_key = cache.make_key(key)
+
+	with cache.pipeline() as pipe:
+		pipe.incrby(redis_key, amount)
+		if expires_in_sec:
+			pipe.expire(redis_key, expires_in_sec)
+
+		value = pipe.execute()[0]
+
+	return cint(value)
+
+
+def get_cache_counter(key):
+	cache = frappe.cache()
+	return cint(cache.get(cache.make_key(key)))
+
+
+def invalidate_latest_readings_cache():
+	# Bumped right away for changes that are already committed and again once the current transaction commits
+	increment_cache_counter(LATEST_READINGS_VERSION_KEY)
+	frappe.db.after_commit.add(lambda: increment_cache_counter(LATEST_READINGS_VERSION_KEY))
+
+
+def mark_latest_readings_changed(committed=False):
+	"""
+	Defer invalidation for writes that happen continuously during ingest, so that the version and
+	the ETag of the latest readings API change at most once per minute, see flush_latest_readings_changes
+	"""
+	def set_changed():
+		cache = frappe.cache()
+		cache.set(cache.make_key(LATEST_READINGS_CHANGED_KEY), 1)
+
+	if committed:
+		set_changed()
+	else:
+		frappe.db.after_commit.add(set_changed)
+
+
+def flush_latest_readings_changes():
+	# Scheduled every minute, independent of the map snapshot that reads the version
+	cache = frappe.cache()
+	if cache.delete(cache.make_key(LATEST_READINGS_CHANGED_KEY)):
+		increment_cache_counter(LATEST_READINGS_VERSION_KEY)
+
+
+def invalidate_report_cache(reading_datetimes=None):
+	"""
+	Advance the data version of the months of reading_datetimes, or of all months if not given,
+	so that cached report results including them are recomputed
+	"""
+	if reading_datetimes is None:
+		keys = [REPORT_DATA_VERSION_KEY]
+	else:
+		keys = sorted({get_report_data_version_key(reading_dt) for reading_dt in reading_datetimes})
+
+	if not keys:
+		return
+
+	def increment():
+		for key in keys:
+			increment_cache_counter(key)
+
+	# Bumped right away for changes that are already committed and again once the current transaction commits
+	increment()
+	frappe.db.after_commit.add(increment)
+
+
+def get_report_data_version(from_date, to_date):
+	"""Combined data version of all months from from_date to to_date"""
+	keys = [REPORT_DATA_VERSION_KEY]
+
+	month_start = getdate(from_date).replace(day=1)
+	while month_start <= getdate(to_date):
+		keys.append(get_report_data_version_key(month_start))
+		month_start = add_months(month_start, 1)
+
+	cache = frappe.cache()
+	with cache.pipeline() as pipe:
+		for key in keys:
+			pipe.get(cache.make_key(key))
+
+		values = pipe.execute()
+
+	return ".".join(cstr(cint(v)) for v in values)
+
+
+def get_report_data_version_key(reading_dt):
+	return f"{REPORT_DATA_VERSION_KEY}:{getdate(reading_dt).strftime('%Y-%m')}"
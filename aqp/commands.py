@@ -0,0 +1,38 @@
+import click
+from frappe.commands import pass_context, get_site
+
+
+@click.command("import-monitor-readings")
+@click.argument("file_path")
+@click.option("--format", "file_format", type=click.Choice(["csv", "ndjson"]), help="Defaults to the file extension")
+@click.option("--chunk-size", default=1000, type=int, help="Readings inserted and committed per chunk")
+@click.option("--on-duplicate", default="Ignore", type=click.Choice(["Reject", "Ignore", "Update"]))
+@click.option("--restart", is_flag=True, default=False, help="Ignore the checkpoint of a previous interrupted import")
+@click.option("--skip-aggregation", is_flag=True, default=False, help="Leave the imported hours to the scheduled aggregation job")
+@pass_context
+def import_monitor_readings(context, file_path, file_format, chunk_size, on_duplicate, restart, skip_aggregation):
+	"Import Monitor Readings from a CSV or newline delimited JSON file"
+	import frappe
+	from aqp.air_quality.doctype.monitor_reading.reading_import import import_readings
+
+	site = get_site(context)
+	frappe.init(site=site)
+	frappe.connect()
+
+	try:
+		import_readings(
+			file_path,
+			file_format=file_format,
+			chunk_size=chunk_size,
+			on_duplicate=on_duplicate,
+			restart=restart,
+			aggregate=not skip_aggregation,
+			verbose=True,
+		)
+	finally:
+		frappe.destroy()
+
+
+commands = [
+	import_monitor_readings,
+]
@@ -12,7 +12,9 @@ after_install = "aqp.install.after_install"
 override_whitelisted_methods = {
 	"monitors.get_monitors": "aqp.air_quality.doctype.air_monitor.air_monitor.get_monitors",
 	"regions.get_regions": "aqp.air_quality.doctype.monitor_region.monitor_region.get_regions",
-	"readings.get_latest_readings": "aqp.air_quality.doctype.monitor_reading.monitor_reading.get_latest_readings",
+	"readings.get_latest_readings": "aqp.air_quality.doctype.monitor_reading.latest_readings.get_latest_readings_response",
+	"readings.get_latest_readings_delta": "aqp.air_quality.doctype.monitor_reading.latest_readings.get_latest_readings_delta",
+	"readings.insert_readings": "aqp.air_quality.doctype.monitor_reading.reading_ingest.insert_readings",
 }
 
 # Includes in <head>
@@ -137,6 +139,27 @@ override_whitelisted_methods = {
 # Scheduled Tasks
 # ---------------
 
+scheduler_events = {
+	"cron": {
+		"* * * * *": [
+			"aqp.air_quality.doctype.air_monitor.air_monitor.flush_first_last_reading_updates",
+			"aqp.air_quality.doctype.air_monitor.air_monitor.flush_nowcast_updates",
+			"aqp.air_quality.utils.flush_latest_readings_changes",
+			"aqp.air_quality.doctype.monitor_reading.latest_readings.update_map_snapshot",
+			"aqp.air_quality.doctype.monitor_reading.reading_realtime.publish_realtime_updates",
+		],
+		"*/5 * * * *": [
+			"aqp.air_quality.doctype.reading_aggregate.reading_aggregate.process_reading_aggregate_queue",
+		],
+		"*/15 * * * *": [
+			"aqp.air_quality.doctype.reading_update_tool.reading_update_tool.resume_aggregation_runs",
+		],
+	},
+	"daily_long": [
+		"aqp.air_quality.doctype.monitor_reading.reading_archive.archive_readings",
+	],
+}
+
 # scheduler_events = {
 #	"all": [
 #		"aqp.tasks.all"
@@ -0,0 +1,13 @@
+import frappe
+from aqp.air_quality.doctype.reading_aggregate.reading_aggregate import aggregate_rollups_for_timerange
+
+
+def execute():
+	from_dt, to_dt = frappe.db.sql("""
+		select min(reading_dt), max(reading_dt)
+		from `tabReading Aggregate`
+		where timespan = 'Daily'
+	""")[0]
+
+	if from_dt and to_dt:
+		aggregate_rollups_for_timerange(from_dt, to_dt)
@@ -0,0 +1,21 @@
+import frappe
+
+
+def execute():
+	# Keep the oldest of duplicate readings so that the unique key can be added
+	frappe.db.sql("""
+		delete r
+		from `tabMonitor Reading` r
+		inner join (
+			select air_monitor, reading_dt, min(name) as keep_name
+			from `tabMonitor Reading`
+			group by air_monitor, reading_dt
+			having count(*) > 1
+		) d on d.air_monitor = r.air_monitor and d.reading_dt = r.reading_dt
+		where r.name != d.keep_name
+	""")
+
+	frappe.db.add_unique("Monitor Reading", ["air_monitor", "reading_dt"], constraint_name="unique_air_monitor_reading_dt")
+
+	if frappe.db.has_index("tabMonitor Reading", "air_monitor_reading_dt_index"):
+		frappe.db.sql_ddl("alter table `tabMonitor Reading` drop index `air_monitor_reading_dt_index`")
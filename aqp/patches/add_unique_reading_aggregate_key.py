@@ -0,0 +1,26 @@
+import frappe
+
+
+def execute():
+	# Runs before model sync, which adds the unique key in on_doctype_update and would fail on duplicates
+	if not frappe.db.table_exists("Reading Aggregate"):
+		return
+
+	# Keep the latest of duplicate aggregates so that the unique key can be added
+	frappe.db.sql("""
+		delete ra
+		from `tabReading Aggregate` ra
+		inner join (
+			select monitor_region, timespan, reading_dt, max(name) as keep_name
+			from `tabReading Aggregate`
+			group by monitor_region, timespan, reading_dt
+			having count(*) > 1
+		) d on d.monitor_region = ra.monitor_region and d.timespan = ra.timespan and d.reading_dt = ra.reading_dt
+		where ra.name != d.keep_name
+	""")
+
+	frappe.db.add_unique("Reading Aggregate", ["monitor_region", "timespan", "reading_dt"],
+		constraint_name="unique_monitor_region_timespan_reading_dt")
+
+	if frappe.db.has_index("tabReading Aggregate", "monitor_region_reading_dt_timespan_index"):
+		frappe.db.sql_ddl("alter table `tabReading Aggregate` drop index `monitor_region_reading_dt_timespan_index`")
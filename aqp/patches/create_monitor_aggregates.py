@@ -0,0 +1,15 @@
+import frappe
+from frappe.utils import now_datetime
+
+
+def execute():
+	# Aggregates of every hour since the first Hourly Reading Aggregate, which also covers archived readings
+	from_dt = frappe.db.sql("""
+		select min(reading_dt)
+		from `tabReading Aggregate`
+		where timespan = 'Hourly'
+	""")[0][0]
+
+	if from_dt:
+		frappe.enqueue("aqp.air_quality.doctype.monitor_aggregate.monitor_aggregate.backfill_monitor_aggregates",
+			queue="long", timeout=60 * 60 * 24, from_dt=from_dt, to_dt=now_datetime())
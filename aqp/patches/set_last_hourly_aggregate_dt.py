@@ -0,0 +1,14 @@
+import frappe
+
+
+def execute():
+	frappe.db.sql("""
+		update `tabMonitor Region` mr
+		set mr.last_hourly_aggregate_dt = (
+			select max(ra.reading_dt)
+			from `tabReading Aggregate` ra
+			where ra.monitor_region = mr.name
+				and ra.timespan = 'Hourly'
+				and ra.pm_2_5_count > 0
+		)
+	""")
@@ -1,8 +1,10 @@
 import frappe
-from aqp.air_quality.doctype.monitor_reading.monitor_reading import get_latest_readings
+from aqp.air_quality.doctype.monitor_reading.latest_readings import get_map_snapshot, get_map_snapshot_url
 
 sitemap = 1
 
 
 def get_context(context):
-	context.latest_readings = get_latest_readings()
+	# Served from the snapshot written by the scheduler instead of querying readings on every page view
+	context.latest_readings = get_map_snapshot()
+	context.latest_readings_url = get_map_snapshot_url()